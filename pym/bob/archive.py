@@ -19,33 +19,81 @@ it must not be overwritten. The backend should make sure that even on
 concurrent uploads the artifact must appear atomically for unrelated readers.
 """
 
-from .errors import BuildError
+from .audit import exportAudit
+from .errors import BuildError, ParseError
 from .tty import stepAction, SKIPPED, EXECUTED, WARNING, INFO, TRACE, ERROR
-from .utils import asHexStr, removePath, isWindows
+from .utils import asHexStr, removePath, isWindows, hashDirectory, \
+    getHashAlgorithm, HASH_ALGORITHMS
 from pipes import quote
-from tempfile import mkstemp, NamedTemporaryFile, TemporaryFile
+from tempfile import mkdtemp, mkstemp, NamedTemporaryFile, TemporaryFile
 import argparse
 import asyncio
 import concurrent.futures
 import concurrent.futures.process
+import errno
+import glob
 import gzip
 import hashlib
 import http.client
+import io
+import json
 import os
 import os.path
+import shutil
 import signal
 import ssl
+import stat
+import struct
 import subprocess
+import sys
 import tarfile
 import textwrap
+import threading
+import time
 import urllib.parse
+import zlib
+
+try:
+    import fcntl
+except ImportError:
+    fcntl = None
 
 ARCHIVE_GENERATION = '-1'
 ARTIFACT_SUFFIX = ".tgz"
 BUILDID_SUFFIX = ".buildid"
 
-def buildIdToName(bid):
-    return asHexStr(bid) + ARCHIVE_GENERATION
+# Archive format version and generation of the compression methods. Gzip
+# compressed artifacts are readable by every Bob version. Zstd compressed
+# artifacts are stored as a separate generation so that older Bob versions
+# will never see them.
+COMPRESSION_FORMATS = {
+    # name  : (bob-archive-vsn, generation, default level)
+    'gzip'  : ("1", ARCHIVE_GENERATION, 6),
+    'zstd'  : ("2", '-2', 3),
+}
+SUPPORTED_ARCHIVE_VERSIONS = frozenset(v[0] for v in COMPRESSION_FORMATS.values())
+
+ZSTD_MAGIC = b'\x28\xb5\x2f\xfd'
+
+def buildIdToName(bid, generation=ARCHIVE_GENERATION):
+    return asHexStr(bid) + generation
+
+def archiveGeneration(algorithm, compression='gzip'):
+    """Get the archive generation for a hash algorithm and compression.
+
+    Build-ids of different hash algorithms must never be mixed. The algorithm
+    is thus part of the archive generation. For sha1 it is empty to stay
+    compatible with existing archives.
+    """
+    return COMPRESSION_FORMATS[compression][1] + HASH_ALGORITHMS[algorithm][2]
+
+def importZstd():
+    try:
+        import zstandard
+    except ImportError:
+        raise BuildError("zstandard Python3 library not installed!",
+            help="Zstd compressed artifacts require the 'zstandard' package.")
+    return zstandard
 
 def readFileOrHandle(name, fileobj):
     if fileobj is not None:
@@ -76,6 +124,411 @@ def artifactSuffixJenkins(fingerprintFile):
         return "-$(< " + quote(fingerprintFile) + ")" + ARTIFACT_SUFFIX
 
 
+class _HashingReader:
+    """File object wrapper that hashes everything that is read."""
+
+    def __init__(self, fileobj, hasher):
+        self.__fileobj = fileobj
+        self.__hasher = hasher
+
+    def read(self, size=-1):
+        buf = self.__fileobj.read(size)
+        self.__hasher.update(buf)
+        return buf
+
+    def seek(self, pos):
+        return self.__fileobj.seek(pos)
+
+    def tell(self):
+        return self.__fileobj.tell()
+
+class _HashingTarFile(tarfile.TarFile):
+    """Tar file that calculates the digest of regular files while extracting.
+
+    The digests are collected in 'digests', indexed by the member name. They
+    are identical to what the DirHasher would calculate by reading the files
+    again. Sparse files are not hashed.
+    """
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.digests = {}
+        self.hasher = None
+
+    def makefile(self, tarinfo, targetpath):
+        if self.hasher is None or tarinfo.sparse is not None:
+            return super().makefile(tarinfo, targetpath)
+
+        source = self.fileobj
+        hasher = self.hasher()
+        self.fileobj = _HashingReader(source, hasher)
+        try:
+            super().makefile(tarinfo, targetpath)
+        finally:
+            self.fileobj = source
+        self.digests[tarinfo.name] = hasher.digest()
+
+    def makelink(self, tarinfo, targetpath):
+        super().makelink(tarinfo, targetpath)
+        if tarinfo.islnk():
+            # Hard links have the content of their target
+            digest = self.digests.get(tarinfo.linkname)
+            if digest is not None: self.digests[tarinfo.name] = digest
+
+def extractPackage(tar, audit, content):
+    if tar.pax_headers.get('bob-archive-vsn', "0") not in SUPPORTED_ARCHIVE_VERSIONS:
+        raise BuildError("Unsupported binary artifact")
+
+    f = tar.next()
+    while f is not None:
+        if f.name.startswith("content/"):
+            if f.islnk():
+                if not f.linkname.startswith("content/"):
+                    raise BuildError("invalid hard link in archive: '{}' -> '{}'"
+                                        .format(f.name, f.linkname))
+                f.linkname = f.linkname[8:]
+            f.name = f.name[8:]
+            try:
+                tar.extract(f, content)
+            except UnicodeError:
+                raise BuildError("File name encoding error while extracting '{}'".format(f.name),
+                                 help="Your locale(7) probably does not (fully) support unicode.")
+        elif f.name == "meta/audit.json.gz":
+            f.name = audit
+            tar.extract(f)
+        elif f.name == "content" or f.name == "meta":
+            pass
+        else:
+            raise BuildError("Binary artifact contained unknown file: " + f.name)
+        f = tar.next()
+
+def unpackPackage(name, fileobj, audit, content, hashIndex=None, algorithm='sha1'):
+    """Unpack artifact into 'content' and the audit trail to 'audit'.
+
+    If 'hashIndex' is given the files are hashed while they are extracted.
+    The workspace is then hashed with these digests so that 'hashIndex' holds
+    all files afterwards. Hashing the workspace again will not read any file
+    content.
+    """
+    with ArtifactReader(name, fileobj, _HashingTarFile) as tar:
+        if hashIndex is not None:
+            tar.hasher = getHashAlgorithm(algorithm)
+        removePath(audit)
+        removePath(content)
+        os.makedirs(content)
+        extractPackage(tar, audit, content)
+
+    if hashIndex is not None:
+        digests = { os.fsencode(n.replace("/", os.sep)) : d
+                    for (n, d) in tar.digests.items() }
+        hashDirectory(content, hashIndex, algorithm=algorithm, digests=digests)
+
+def unpackStore(name, entry, algorithm='sha1'):
+    """Unpack artifact 'name' into the unpacked store directory 'entry'.
+
+    The content and the audit trail are stored together with the digests and
+    the original modes of all files. The write permission of all files is
+    removed because they might be shared with workspaces by hard links. The
+    size and modification time of the artifact are recorded to detect
+    outdated entries, along with the unpacked size of the entry.
+    """
+    st = os.stat(name)
+    content = os.path.join(entry, "content")
+    with ArtifactReader(name, None, _HashingTarFile) as tar:
+        tar.hasher = getHashAlgorithm(algorithm)
+        os.makedirs(content)
+        extractPackage(tar, os.path.join(entry, "audit.json.gz"), content)
+
+    modes = {}
+    size = 0
+    for (root, dirs, files) in os.walk(content):
+        for f in files:
+            f = os.path.join(root, f)
+            fst = os.lstat(f)
+            size += fst.st_size
+            if stat.S_ISREG(fst.st_mode):
+                mode = stat.S_IMODE(fst.st_mode)
+                modes[os.path.relpath(f, content).replace(os.sep, "/")] = mode
+                os.chmod(f, mode & ~0o222)
+    with open(os.path.join(entry, "digests.json"), "w") as f:
+        json.dump({ n : asHexStr(d) for (n, d) in tar.digests.items() }, f)
+    with open(os.path.join(entry, "modes.json"), "w") as f:
+        json.dump(modes, f)
+    with open(os.path.join(entry, "artifact.json"), "w") as f:
+        json.dump({ "artifact" : [st.st_size, st.st_mtime_ns], "size" : size }, f)
+
+def readStoreInfo(entry):
+    """Read the artifact information of an unpacked store entry.
+
+    Returns an empty dict if the entry is incomplete or does not exist.
+    """
+    try:
+        with open(os.path.join(entry, "artifact.json")) as f:
+            return json.load(f)
+    except (OSError, ValueError):
+        return {}
+
+def materializePackage(entry, audit, content, hashIndex=None, algorithm='sha1',
+                       link=False):
+    """Populate 'content' and 'audit' from an unpacked store entry.
+
+    Files are reflinked if possible and copied otherwise. They get their
+    original mode back. If 'link' is True files are hard linked in favour of
+    copying them. Hard linked files stay read-only and share their inode with
+    the store. If 'hashIndex' is given the workspace is hashed with the
+    digests that were recorded when the entry was created.
+    """
+    try:
+        with open(os.path.join(entry, "modes.json")) as f:
+            modes = json.load(f)
+    except FileNotFoundError:
+        modes = {}
+    removePath(audit)
+    removePath(content)
+    _TreeCloner(modes, link).clone(os.path.join(entry, "content"), content)
+    shutil.copyfile(os.path.join(entry, "audit.json.gz"), audit)
+
+    if hashIndex is not None:
+        with open(os.path.join(entry, "digests.json")) as f:
+            digests = { os.fsencode(n.replace("/", os.sep)) : bytes.fromhex(d)
+                        for (n, d) in json.load(f).items() }
+        hashDirectory(content, hashIndex, algorithm=algorithm, digests=digests)
+
+class _TreeCloner:
+    """Clone a directory tree as cheaply as possible.
+
+    Regular files are reflinked (Linux only) or, if 'link' is True, hard
+    linked. If the file system does not support a method it is not tried
+    again for the rest of the tree. Files are copied as last resort.
+
+    The 'modes' of regular files, indexed by their "/" separated path relative
+    to the tree, are applied to reflinked and copied files. Hard links share
+    the mode of the source.
+    """
+
+    FICLONE = 0x40049409
+
+    def __init__(self, modes=None, link=False):
+        self.__reflink = fcntl is not None and sys.platform.startswith("linux")
+        self.__link = link and hasattr(os, "link")
+        self.__modes = modes or {}
+
+    def clone(self, src, dst, prefix=""):
+        os.makedirs(dst)
+        for entry in os.scandir(src):
+            s = os.path.join(src, entry.name)
+            d = os.path.join(dst, entry.name)
+            if entry.is_symlink():
+                os.symlink(os.readlink(s), d)
+            elif entry.is_dir():
+                self.clone(s, d, prefix + entry.name + "/")
+            elif entry.is_file():
+                self.__cloneFile(s, d, prefix + entry.name)
+            elif stat.S_ISFIFO(entry.stat(follow_symlinks=False).st_mode):
+                os.mkfifo(d)
+                shutil.copystat(s, d, follow_symlinks=False)
+            else:
+                raise OSError(errno.ENOTSUP, "Cannot clone special file", s)
+        shutil.copystat(src, dst)
+
+    def __cloneFile(self, src, dst, name):
+        if self.__reflink:
+            try:
+                with open(src, "rb") as s:
+                    fd = os.open(dst, os.O_WRONLY | os.O_CREAT | os.O_EXCL)
+                    try:
+                        fcntl.ioctl(fd, _TreeCloner.FICLONE, s.fileno())
+                    finally:
+                        os.close(fd)
+                self.__copyStat(src, dst, name)
+                return
+            except OSError:
+                self.__reflink = False
+                if os.path.lexists(dst): os.unlink(dst)
+
+        if self.__link:
+            try:
+                os.link(src, dst)
+                return
+            except OSError as e:
+                if e.errno in (errno.EXDEV, errno.EPERM, errno.ENOTSUP):
+                    self.__link = False
+                elif e.errno != errno.EMLINK:
+                    raise
+
+        shutil.copyfile(src, dst)
+        self.__copyStat(src, dst, name)
+
+    def __copyStat(self, src, dst, name):
+        shutil.copystat(src, dst)
+        mode = self.__modes.get(name)
+        if mode is not None: os.chmod(dst, mode)
+
+class _PrefixedReader:
+    """Read from 'prefix' first and then from 'fileobj'."""
+
+    def __init__(self, prefix, fileobj):
+        self.__prefix = prefix
+        self.__fileobj = fileobj
+
+    def read(self, size=-1):
+        if not self.__prefix:
+            return self.__fileobj.read(size)
+        if size < 0:
+            ret = self.__prefix + self.__fileobj.read()
+            self.__prefix = b''
+        else:
+            ret = self.__prefix[:size]
+            self.__prefix = self.__prefix[size:]
+        return ret
+
+class ArtifactReader:
+    """Open artifact for streaming read.
+
+    Yields a tar file object. The compression is detected from the content.
+    Besides all formats that are supported by the tarfile module this
+    includes zstd.
+    """
+
+    def __init__(self, name, fileobj, tarClass=tarfile.TarFile):
+        self.__name = name
+        self.__fileobj = fileobj
+        self.__tarClass = tarClass
+        self.__files = []
+
+    def __enter__(self):
+        try:
+            fileobj = self.__fileobj
+            if fileobj is None:
+                fileobj = open(self.__name, "rb")
+                self.__files.append(fileobj)
+            magic = fileobj.read(len(ZSTD_MAGIC))
+            fileobj = _PrefixedReader(magic, fileobj)
+            if magic == ZSTD_MAGIC:
+                fileobj = importZstd().ZstdDecompressor().stream_reader(fileobj)
+                self.__files.append(fileobj)
+                self.__tar = self.__tarClass.open(None, "r|", fileobj=fileobj,
+                                                  errorlevel=1)
+            else:
+                self.__tar = self.__tarClass.open(None, "r|*", fileobj=fileobj,
+                                                  errorlevel=1)
+        except:
+            self.__close()
+            raise
+        return self.__tar
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        try:
+            self.__tar.close()
+        finally:
+            self.__close()
+        return False
+
+    def __close(self):
+        for f in reversed(self.__files): f.close()
+        self.__files = []
+
+class ParallelGzipWriter:
+    """Gzip compressor that uses multiple threads.
+
+    The input is split into blocks that are compressed independently by a
+    thread pool. Each block is primed with the tail of the previous block as
+    dictionary and ends on a byte boundary. The concatenated blocks form a
+    single, regular gzip stream that can be read by every gzip implementation.
+    zlib releases the GIL while compressing so the blocks are really
+    compressed in parallel.
+    """
+
+    BLOCK_SIZE = 1024 * 1024
+    DICT_SIZE = 32 * 1024
+
+    def __init__(self, fileobj, level, threads):
+        self.__fileobj = fileobj
+        self.__level = level
+        self.__executor = concurrent.futures.ThreadPoolExecutor(max_workers=threads)
+        self.__maxPending = threads * 2
+        self.__pending = []
+        self.__buf = []
+        self.__bufLen = 0
+        self.__dict = b''
+        self.__crc = 0
+        self.__size = 0
+        self.__fileobj.write(struct.pack("<4sLBB", b'\x1f\x8b\x08\x00',
+            int(time.time()), 0, 255))
+
+    @staticmethod
+    def _compress(level, block, zdict, last):
+        if zdict:
+            c = zlib.compressobj(level, zlib.DEFLATED, -zlib.MAX_WBITS, zdict=zdict)
+        else:
+            c = zlib.compressobj(level, zlib.DEFLATED, -zlib.MAX_WBITS)
+        return c.compress(block) + c.flush(zlib.Z_FINISH if last else zlib.Z_SYNC_FLUSH)
+
+    def __submit(self, last=False):
+        block = b''.join(self.__buf)
+        self.__buf = []
+        self.__bufLen = 0
+        self.__crc = zlib.crc32(block, self.__crc)
+        self.__size += len(block)
+        self.__pending.append(self.__executor.submit(ParallelGzipWriter._compress,
+            self.__level, block, self.__dict, last))
+        self.__dict = block[-ParallelGzipWriter.DICT_SIZE:]
+        while len(self.__pending) > (0 if last else self.__maxPending):
+            self.__fileobj.write(self.__pending.pop(0).result())
+
+    def write(self, data):
+        self.__buf.append(bytes(data))
+        self.__bufLen += len(data)
+        if self.__bufLen >= ParallelGzipWriter.BLOCK_SIZE:
+            self.__submit()
+        return len(data)
+
+    def tell(self):
+        return self.__size + self.__bufLen
+
+    def close(self):
+        if self.__executor is None: return
+        try:
+            self.__submit(True)
+            self.__fileobj.write(struct.pack("<LL", self.__crc & 0xffffffff,
+                                             self.__size & 0xffffffff))
+        finally:
+            self.__executor.shutdown()
+            self.__executor = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        if exc_type is None:
+            self.close()
+        elif self.__executor is not None:
+            for f in self.__pending: f.cancel()
+            self.__executor.shutdown()
+            self.__executor = None
+        return False
+
+def copyThrottled(src, dst, rateLimit):
+    """Copy file object 'src' to 'dst' with at most 'rateLimit' bytes/s.
+
+    The copy is aborted if 'dst' was unlinked in the meantime. Returns False
+    in this case.
+    """
+    start = time.monotonic()
+    copied = 0
+    while True:
+        buf = src.read(64*1024)
+        if not buf: break
+        dst.write(buf)
+        copied += len(buf)
+        if os.fstat(dst.fileno()).st_nlink == 0:
+            return False
+        if rateLimit:
+            delay = copied / rateLimit - (time.monotonic() - start)
+            if delay > 0: time.sleep(delay)
+    return True
+
+
 class DummyArchive:
     """Archive that does nothing"""
 
@@ -85,6 +538,9 @@ class DummyArchive:
     def wantUpload(self, enable):
         pass
 
+    def setHashAlgorithm(self, algorithm):
+        pass
+
     def canDownloadLocal(self):
         return False
 
@@ -98,11 +554,24 @@ class DummyArchive:
         return False
 
     async def uploadPackage(self, step, buildId, fingerprint, audit, content):
-        pass
+        return False
+
+    async def downloadPackage(self, step, buildId, fingerprint, audit, content,
+                              hashIndex=None):
+        return False
+
+    async def prefetchPackage(self, step, buildId, fingerprint, fileName, executor, rateLimit):
+        return False
 
-    async def downloadPackage(self, step, buildId, fingerprint, audit, content):
+    async def probePackage(self, buildId, fingerprint, executor=None):
         return False
 
+    async def probeLocalLiveBuildId(self, liveBuildId, executor=None):
+        return False
+
+    async def probePackages(self, artifacts, executor=None):
+        return [False] * len(artifacts)
+
     def upload(self, step, buildIdFile, fingerprintFile, tgzFile):
         return ""
 
@@ -132,6 +601,10 @@ class ArtifactUploadError(Exception):
     def __init__(self, reason):
         self.reason = reason
 
+class ArtifactStreamError(Exception):
+    """Streaming upload failed. It may be retried with a regular upload."""
+    pass
+
 class BaseArchive:
     def __init__(self, spec):
         flags = spec.get("flags", ["upload", "download"])
@@ -142,6 +615,15 @@ class BaseArchive:
         self.__useJenkins = "nojenkins" not in flags
         self.__wantDownload = False
         self.__wantUpload = False
+        self.__compression = spec.get("compression", "gzip")
+        self.__compressionLevel = spec.get("compressionLevel",
+            COMPRESSION_FORMATS[self.__compression][2])
+        self.__compressionThreads = spec.get("compressionThreads", 1)
+        if self.__compression == "zstd": importZstd()
+        self._generation = archiveGeneration('sha1', self.__compression)
+        # Jenkins always packs gzip compressed artifacts
+        self._jenkinsGeneration = archiveGeneration('sha1')
+        self._hashAlgorithm = 'sha1'
 
     def _ignoreErrors(self):
         return self.__ignoreErrors
@@ -152,6 +634,11 @@ class BaseArchive:
     def wantUpload(self, enable):
         self.__wantUpload = enable
 
+    def setHashAlgorithm(self, algorithm):
+        self._generation = archiveGeneration(algorithm, self.__compression)
+        self._jenkinsGeneration = archiveGeneration(algorithm)
+        self._hashAlgorithm = algorithm
+
     def canDownloadLocal(self):
         return self.__wantDownload and self.__useDownload and self.__useLocal
 
@@ -164,37 +651,41 @@ class BaseArchive:
     def canUploadJenkins(self):
         return self.__wantUpload and self.__useUpload and self.__useJenkins
 
-    def __extractPackage(self, tar, audit, content):
-        if tar.pax_headers.get('bob-archive-vsn', "0") != "1":
-            raise BuildError("Unsupported binary artifact")
+    def _downloadGenerations(self):
+        """Get the archive generations that are looked up on downloads.
 
-        f = tar.next()
-        while f is not None:
-            if f.name.startswith("content/"):
-                if f.islnk():
-                    if not f.linkname.startswith("content/"):
-                        raise BuildError("invalid hard link in archive: '{}' -> '{}'"
-                                            .format(f.name, f.linkname))
-                    f.linkname = f.linkname[8:]
-                f.name = f.name[8:]
-                try:
-                    tar.extract(f, content)
-                except UnicodeError:
-                    raise BuildError("File name encoding error while extracting '{}'".format(f.name),
-                                     help="Your locale(7) probably does not (fully) support unicode.")
-            elif f.name == "meta/audit.json.gz":
-                f.name = audit
-                tar.extract(f)
-            elif f.name == "content" or f.name == "meta":
-                pass
-            else:
-                raise BuildError("Binary artifact contained unknown file: " + f.name)
-            f = tar.next()
+        Jenkins always uploads gzip compressed artifacts. If the archive uses
+        a different compression these artifacts are used as fallback.
+        """
+        if self._generation == self._jenkinsGeneration:
+            return (self._generation,)
+        else:
+            return (self._generation, self._jenkinsGeneration)
 
-    def _openDownloadFile(self, buildId, suffix):
+    def _openDownloadFile(self, buildId, suffix, generation):
         raise ArtifactNotFoundError()
 
-    async def downloadPackage(self, step, buildId, fingerprint, audit, content):
+    def __openDownload(self, buildId, suffix):
+        error = None
+        for generation in self._downloadGenerations():
+            try:
+                return self._openDownloadFile(buildId, suffix, generation)
+            except ArtifactNotFoundError:
+                pass
+            except ArtifactDownloadError as e:
+                # Custom download commands cannot tell missing artifacts
+                # apart from other errors. Try the next generation anyway.
+                if error is None: error = e
+        if error is not None: raise error
+        raise ArtifactNotFoundError()
+
+    async def downloadPackage(self, step, buildId, fingerprint, audit, content,
+                              hashIndex=None):
+        """Download and unpack an artifact.
+
+        If 'hashIndex' is given, the content is hashed while it is unpacked
+        and the digests are stored in this index (see unpackPackage()).
+        """
         if not self.canDownloadLocal():
             return False
 
@@ -204,23 +695,18 @@ class BaseArchive:
         with stepAction(step, "DOWNLOAD", content, details=details) as a:
             try:
                 ret, msg, kind = await loop.run_in_executor(None, BaseArchive._downloadPackage,
-                    self, buildId, suffix, audit, content)
+                    self, buildId, suffix, audit, content, hashIndex)
                 if not ret: a.fail(msg, kind)
                 return ret
             except (concurrent.futures.CancelledError, concurrent.futures.process.BrokenProcessPool):
                 raise BuildError("Download of package interrupted.")
 
-    def _downloadPackage(self, buildId, suffix, audit, content):
+    def _downloadPackage(self, buildId, suffix, audit, content, hashIndex=None):
         # restore signals to default so that Ctrl+C kills us
         signal.signal(signal.SIGINT, signal.SIG_DFL)
 
         try:
-            with self._openDownloadFile(buildId, suffix) as (name, fileobj):
-                with tarfile.open(name, "r|*", fileobj=fileobj, errorlevel=1) as tar:
-                    removePath(audit)
-                    removePath(content)
-                    os.makedirs(content)
-                    self.__extractPackage(tar, audit, content)
+            self._extractPackage(buildId, suffix, audit, content, hashIndex)
             return (True, None, None)
         except ArtifactNotFoundError:
             return (False, "not found", WARNING)
@@ -233,6 +719,121 @@ class BaseArchive:
         except tarfile.TarError as e:
             raise BuildError("Error extracting binary artifact: " + str(e))
 
+    def _extractPackage(self, buildId, suffix, audit, content, hashIndex):
+        with self.__openDownload(buildId, suffix) as (name, fileobj):
+            unpackPackage(name, fileobj, audit, content, hashIndex,
+                          self._hashAlgorithm)
+
+    async def prefetchPackage(self, step, buildId, fingerprint, fileName, executor, rateLimit):
+        """Download the raw artifact into 'fileName'.
+
+        Returns True if the artifact was stored, False if it does not exist
+        and None if the download failed for other reasons. Errors are not
+        reported because the regular download will handle them. The download
+        is aborted if the partial file is deleted.
+        """
+        if not self.canDownloadLocal():
+            return False
+
+        loop = asyncio.get_event_loop()
+        return await loop.run_in_executor(executor, BaseArchive._prefetchPackage,
+            self, buildId, artifactSuffixLocal(fingerprint), fileName, rateLimit)
+
+    def _prefetchPackage(self, buildId, suffix, fileName, rateLimit):
+        # Runs in a thread. Download into a temporary file that is renamed
+        # only if the download was successful.
+        tmpName = fileName + ".part"
+        try:
+            with self.__openDownload(buildId, suffix) as (name, fileobj):
+                with open(tmpName, "wb") as dst:
+                    if fileobj is None:
+                        with open(name, "rb") as src:
+                            ok = copyThrottled(src, dst, rateLimit)
+                    else:
+                        ok = copyThrottled(fileobj, dst, rateLimit)
+            if not ok:
+                return None
+            os.rename(tmpName, fileName)
+            return True
+        except ArtifactNotFoundError:
+            return False
+        except (ArtifactDownloadError, BuildError, OSError, http.client.HTTPException):
+            pass
+        try:
+            os.unlink(tmpName)
+        except OSError:
+            pass
+        return None
+
+    def _probeDownloadFile(self, buildId, suffix, generation):
+        """Check if a file exists without downloading it.
+
+        Returns None if the backend cannot tell cheaply.
+        """
+        return None
+
+    async def probePackage(self, buildId, fingerprint, executor=None):
+        """Check if an artifact exists in the archive.
+
+        Returns True or False, or None if the backend cannot tell or the check
+        failed. Errors are not reported because the actual download will
+        handle them.
+        """
+        if not self.canDownloadLocal():
+            return False
+
+        loop = asyncio.get_event_loop()
+        return await loop.run_in_executor(executor, BaseArchive._probe, self,
+            buildId, artifactSuffixLocal(fingerprint))
+
+    async def probeLocalLiveBuildId(self, liveBuildId, executor=None):
+        """Check if a live-build-id exists like probePackage() does."""
+        if not self.canDownloadLocal():
+            return False
+
+        loop = asyncio.get_event_loop()
+        return await loop.run_in_executor(executor, BaseArchive._probe, self,
+            liveBuildId, BUILDID_SUFFIX)
+
+    def _probe(self, buildId, suffix):
+        ret = False
+        for generation in self._downloadGenerations():
+            try:
+                found = self._probeDownloadFile(buildId, suffix, generation)
+            except (ArtifactDownloadError, BuildError, OSError, http.client.HTTPException):
+                found = None
+            if found: return True
+            if found is None: ret = None
+        return ret
+
+    def _probeDownloadFiles(self, files):
+        """Check the existence of many files at once.
+
+        Takes a list of (buildId, suffix) tuples. Backends should override
+        this if they can batch the checks.
+        """
+        return [ self._probe(buildId, suffix) for (buildId, suffix) in files ]
+
+    async def probePackages(self, artifacts, executor=None):
+        """Check which artifacts exist in the archive.
+
+        Takes a list of (buildId, fingerprint) tuples and returns a list with
+        the result of probePackage() for each artifact.
+        """
+        if not self.canDownloadLocal():
+            return [False] * len(artifacts)
+
+        loop = asyncio.get_event_loop()
+        return await loop.run_in_executor(executor, BaseArchive._probeMany, self,
+            [ (buildId, artifactSuffixLocal(fingerprint))
+              for (buildId, fingerprint) in artifacts ])
+
+    def _probeMany(self, files):
+        try:
+            return self._probeDownloadFiles(files)
+        except (ArtifactDownloadError, BuildError, OSError, http.client.HTTPException):
+            return [None] * len(files)
+
     async def downloadLocalLiveBuildId(self, step, liveBuildId):
         if not self.canDownloadLocal():
             return None
@@ -252,7 +853,7 @@ class BaseArchive:
         signal.signal(signal.SIGINT, signal.SIG_DFL)
 
         try:
-            with self._openDownloadFile(liveBuildId, BUILDID_SUFFIX) as (name, fileobj):
+            with self.__openDownload(liveBuildId, BUILDID_SUFFIX) as (name, fileobj):
                 ret = readFileOrHandle(name, fileobj)
             return (ret, None, None)
         except ArtifactNotFoundError:
@@ -268,8 +869,13 @@ class BaseArchive:
         raise ArtifactUploadError("not implemented")
 
     async def uploadPackage(self, step, buildId, fingerprint, audit, content):
+        """Pack and upload an artifact.
+
+        Returns True if the artifact was uploaded, False if it was already in
+        the archive and None if the upload failed but errors are ignored.
+        """
         if not self.canUploadLocal():
-            return
+            return False
 
         loop = asyncio.get_event_loop()
         suffix = artifactSuffixLocal(fingerprint)
@@ -279,6 +885,7 @@ class BaseArchive:
                 msg, kind = await loop.run_in_executor(None, BaseArchive._uploadPackage,
                     self, buildId, suffix, audit, content)
                 a.setResult(msg, kind)
+                return { EXECUTED : True, SKIPPED : False }.get(kind)
             except (concurrent.futures.CancelledError, concurrent.futures.process.BrokenProcessPool):
                 raise BuildError("Upload of package interrupted.")
 
@@ -287,22 +894,57 @@ class BaseArchive:
         signal.signal(signal.SIGINT, signal.SIG_DFL)
 
         try:
-            with self._openUploadFile(buildId, suffix) as (name, fileobj):
-                pax = { 'bob-archive-vsn' : "1" }
-                with gzip.open(name or fileobj, 'wb', 6) as gzf:
-                    with tarfile.open(name, "w", fileobj=gzf,
-                                      format=tarfile.PAX_FORMAT, pax_headers=pax) as tar:
-                        tar.add(audit, "meta/" + os.path.basename(audit))
-                        tar.add(content, arcname="content")
+            try:
+                self.__uploadPackage(buildId, suffix, audit, content)
+            except ArtifactStreamError:
+                # The backend could not stream the artifact. It will fall
+                # back to a regular upload on the second try.
+                self.__uploadPackage(buildId, suffix, audit, content)
         except ArtifactExistsError:
             return ("skipped ({} exists in archive)".format(content), SKIPPED)
-        except (ArtifactUploadError, tarfile.TarError, OSError) as e:
+        except (ArtifactUploadError, ParseError, tarfile.TarError, OSError) as e:
             if self.__ignoreErrors:
                 return ("error ("+str(e)+")", ERROR)
             else:
                 raise BuildError("Cannot upload artifact: " + str(e))
         return ("ok", EXECUTED)
 
+    def __uploadPackage(self, buildId, suffix, audit, content):
+        with self._openUploadFile(buildId, suffix) as (name, fileobj):
+            if fileobj is None:
+                with open(name, "wb") as f:
+                    self.__packPackage(f, audit, content)
+            else:
+                self.__packPackage(fileobj, audit, content)
+
+    def __openCompressor(self, fileobj):
+        if self.__compression == "zstd":
+            zstd = importZstd()
+            return zstd.ZstdCompressor(level=self.__compressionLevel,
+                threads=self.__compressionThreads).stream_writer(fileobj,
+                closefd=False)
+        elif self.__compressionThreads > 1:
+            return ParallelGzipWriter(fileobj, self.__compressionLevel,
+                                      self.__compressionThreads)
+        else:
+            return gzip.GzipFile(fileobj=fileobj, mode='wb',
+                                 compresslevel=self.__compressionLevel)
+
+    def __packPackage(self, fileobj, audit, content):
+        pax = { 'bob-archive-vsn' : COMPRESSION_FORMATS[self.__compression][0] }
+        with self.__openCompressor(fileobj) as compressor:
+            with tarfile.open(None, "w", fileobj=compressor,
+                              format=tarfile.PAX_FORMAT, pax_headers=pax) as tar:
+                # Artifacts always carry a self-contained audit trail
+                auditData = exportAudit(audit)
+                if auditData is None:
+                    tar.add(audit, "meta/" + os.path.basename(audit))
+                else:
+                    info = tar.gettarinfo(audit, "meta/" + os.path.basename(audit))
+                    info.size = len(auditData)
+                    tar.addfile(info, io.BytesIO(auditData))
+                tar.add(content, arcname="content")
+
     async def uploadLocalLiveBuildId(self, step, liveBuildId, buildId):
         if not self.canUploadLocal():
             return
@@ -333,12 +975,20 @@ class BaseArchive:
 
 
 class LocalArchive(BaseArchive):
+    # Leftovers of interrupted unpacks are removed after this time
+    STALE_TIME = 24 * 60 * 60
+
     def __init__(self, spec):
         super().__init__(spec)
         self.__basePath = os.path.abspath(spec["path"])
-
-    def _getPath(self, buildId, suffix):
-        packageResultId = buildIdToName(buildId)
+        unpackedPath = spec.get("unpackedPath")
+        self.__unpackedPath = os.path.abspath(unpackedPath) if unpackedPath else None
+        self.__unpackedSize = spec.get("unpackedSize")
+        self.__unpackedLink = spec.get("unpackedLink", False)
+
+    def _getPath(self, buildId, suffix, generation=None):
+        if generation is None: generation = self._generation
+        packageResultId = buildIdToName(buildId, generation)
         packageResultPath = os.path.join(self.__basePath, packageResultId[0:2],
                                          packageResultId[2:4])
         packageResultFile = os.path.join(packageResultPath,
@@ -348,13 +998,186 @@ class LocalArchive(BaseArchive):
     def _remoteName(self, buildId, suffix):
         return self._getPath(buildId, suffix)[1]
 
-    def _openDownloadFile(self, buildId, suffix):
-        (packageResultPath, packageResultFile) = self._getPath(buildId, suffix)
+    def _openDownloadFile(self, buildId, suffix, generation):
+        (packageResultPath, packageResultFile) = self._getPath(buildId, suffix, generation)
         if os.path.isfile(packageResultFile):
             return LocalArchiveDownloader(packageResultFile)
         else:
             raise ArtifactNotFoundError()
 
+    def _probeDownloadFile(self, buildId, suffix, generation):
+        return os.path.isfile(self._getPath(buildId, suffix, generation)[1])
+
+    def __getUnpacked(self, buildId, suffix):
+        """Get the unpacked store entry of an artifact.
+
+        An entry is only used if it was created from the current artifact
+        file. Otherwise the artifact is unpacked into a temporary directory
+        first that is renamed atomically. Concurrent Bob instances may race to
+        create the same entry. The loser just drops its copy. Every new entry
+        triggers the pruning of the store.
+        """
+        for generation in self._downloadGenerations():
+            packageResultFile = self._getPath(buildId, suffix, generation)[1]
+            try:
+                st = os.stat(packageResultFile)
+                break
+            except FileNotFoundError:
+                pass
+        else:
+            raise ArtifactNotFoundError()
+
+        packageResultId = buildIdToName(buildId, generation)
+        entry = os.path.join(self.__unpackedPath, packageResultId[0:2],
+            packageResultId[2:4], packageResultId[4:] + suffix[:-len(ARTIFACT_SUFFIX)])
+        artifact = [st.st_size, st.st_mtime_ns]
+        if readStoreInfo(entry).get("artifact") == artifact:
+            try:
+                os.utime(entry) # mark as recently used
+            except OSError:
+                pass
+            return entry
+
+        os.makedirs(os.path.dirname(entry), exist_ok=True)
+        tmp = mkdtemp(dir=os.path.dirname(entry), suffix=".tmp")
+        try:
+            os.chmod(tmp, 0o755)
+            unpackStore(packageResultFile, tmp, self._hashAlgorithm)
+            try:
+                os.rename(tmp, entry)
+            except OSError:
+                # Either lost the race or an outdated entry is in the way
+                if readStoreInfo(entry).get("artifact") != artifact:
+                    LocalArchive.__removeEntry(entry)
+                    os.rename(tmp, entry)
+        finally:
+            if os.path.isdir(tmp): shutil.rmtree(tmp, ignore_errors=True)
+
+        try:
+            LocalArchive._pruneUnpacked(self.__basePath, self.__unpackedPath,
+                                        self.__unpackedSize, entry)
+        except OSError:
+            pass
+        return entry
+
+    @staticmethod
+    def __removeEntry(entry):
+        # Move the entry out of the way first. Nobody must see a partially
+        # removed entry.
+        trash = "{}.{}.tmp".format(entry, asHexStr(os.urandom(8)))
+        try:
+            os.rename(entry, trash)
+        except FileNotFoundError:
+            return
+        shutil.rmtree(trash, ignore_errors=True)
+
+    @staticmethod
+    def _pruneUnpacked(basePath, unpackedPath, maxSize, keep=None):
+        """Remove outdated and least recently used unpacked store entries.
+
+        Entries whose artifact was removed from the archive or replaced are
+        always removed. If 'maxSize' is given the least recently used entries
+        are removed too until the store holds at most 'maxSize' bytes. The
+        'keep' entry is never removed. Concurrent prunes are serialized by a
+        lock file.
+        """
+        with open(os.path.join(unpackedPath, ".lock"), "a") as lock:
+            if fcntl is not None:
+                fcntl.flock(lock.fileno(), fcntl.LOCK_EX)
+            entries = []
+            total = 0
+            now = time.time()
+            for entry in glob.glob(os.path.join(glob.escape(unpackedPath), "??", "??", "*")):
+                try:
+                    mtime = os.stat(entry).st_mtime
+                except OSError:
+                    continue
+                if entry.endswith(".tmp"):
+                    # Only leftovers of crashed processes are removed
+                    if now - mtime > LocalArchive.STALE_TIME:
+                        shutil.rmtree(entry, ignore_errors=True)
+                    continue
+
+                info = readStoreInfo(entry)
+                try:
+                    st = os.stat(os.path.join(basePath,
+                        os.path.relpath(entry, unpackedPath)) + ARTIFACT_SUFFIX)
+                    current = info.get("artifact") == [st.st_size, st.st_mtime_ns]
+                except OSError:
+                    current = False
+                if not current and entry != keep:
+                    LocalArchive.__removeEntry(entry)
+                    continue
+
+                size = info.get("size", 0)
+                total += size
+                if entry != keep: entries.append((mtime, entry, size))
+
+            if maxSize is None: return
+            entries.sort()
+            for (mtime, entry, size) in entries:
+                if total <= maxSize: break
+                LocalArchive.__removeEntry(entry)
+                total -= size
+
+    def _extractPackage(self, buildId, suffix, audit, content, hashIndex):
+        if self.__unpackedPath is not None:
+            try:
+                entry = self.__getUnpacked(buildId, suffix)
+                materializePackage(entry, audit, content, hashIndex,
+                                   self._hashAlgorithm, self.__unpackedLink)
+                return
+            except OSError:
+                # The store might not be writable or the entry was removed
+                # concurrently. The store is just an optimization. Unpack the
+                # artifact instead.
+                pass
+        super()._extractPackage(buildId, suffix, audit, content, hashIndex)
+
+    async def prefetchPackage(self, step, buildId, fingerprint, fileName, executor, rateLimit):
+        if self.__unpackedPath is None or not self.canDownloadLocal():
+            return await super().prefetchPackage(step, buildId, fingerprint,
+                fileName, executor, rateLimit)
+
+        # Copying the artifact would be pointless. Fill the unpacked store
+        # instead. The regular download will materialize it from there.
+        loop = asyncio.get_event_loop()
+        return await loop.run_in_executor(executor, LocalArchive._prefetchUnpacked,
+            self, buildId, artifactSuffixLocal(fingerprint))
+
+    def _prefetchUnpacked(self, buildId, suffix):
+        try:
+            self.__getUnpacked(buildId, suffix)
+        except ArtifactNotFoundError:
+            return False
+        except (BuildError, OSError, tarfile.TarError):
+            pass
+        return None
+
+    def _probeDownloadFiles(self, files):
+        # Artifacts are spread over few directories. List each directory only
+        # once instead of looking up every file individually.
+        listings = {}
+        ret = []
+        for (buildId, suffix) in files:
+            found = False
+            for generation in self._downloadGenerations():
+                (packageResultPath, packageResultFile) = self._getPath(buildId,
+                    suffix, generation)
+                entries = listings.get(packageResultPath)
+                if entries is None:
+                    try:
+                        entries = set(e.name for e in os.scandir(packageResultPath)
+                                      if e.is_file())
+                    except FileNotFoundError:
+                        entries = set()
+                    listings[packageResultPath] = entries
+                if os.path.basename(packageResultFile) in entries:
+                    found = True
+                    break
+            ret.append(found)
+        return ret
+
     def _openUploadFile(self, buildId, suffix):
         (packageResultPath, packageResultFile) = self._getPath(buildId, suffix)
         if os.path.isfile(packageResultFile):
@@ -398,7 +1221,7 @@ class LocalArchive(BaseArchive):
                 ){FIXUP}
             fi""".format(DIR=self.__basePath, BUILDID=quote(buildIdFile), RESULT=quote(resultFile),
                          FIXUP=" || echo Upload failed: $?" if self._ignoreErrors() else "",
-                         GEN=ARCHIVE_GENERATION, SUFFIX=suffix))
+                         GEN=self._jenkinsGeneration, SUFFIX=suffix))
 
     def upload(self, step, buildIdFile, fingerprintFile, tgzFile):
         return self.__uploadJenkins(step, buildIdFile, tgzFile,
@@ -415,7 +1238,7 @@ class LocalArchive(BaseArchive):
                 cp "$BOB_DOWNLOAD_FILE" {RESULT} || echo Download failed: $?
             fi
             """.format(DIR=self.__basePath, BUILDID=quote(buildIdFile), RESULT=quote(tgzFile),
-                       GEN=ARCHIVE_GENERATION, SUFFIX=artifactSuffixJenkins(fingerprintFile)))
+                       GEN=self._jenkinsGeneration, SUFFIX=artifactSuffixJenkins(fingerprintFile)))
 
     def uploadJenkinsLiveBuildId(self, step, liveBuildId, buildId):
         return self.__uploadJenkins(step, liveBuildId, buildId, BUILDID_SUFFIX)
@@ -462,12 +1285,94 @@ class LocalArchiveUploader:
         return False
 
 
+class HttpConnectionPool:
+    """Pool of persistent keep-alive connections to a HTTP server.
+
+    The transfers of the archive backends run in the worker processes of the
+    executor. Every worker process keeps one pool per server so that
+    connections are reused across transfers. Idle connections are closed
+    after IDLE_TIMEOUT seconds.
+    """
+
+    IDLE_TIMEOUT = 30
+
+    def __init__(self, url, sslVerify, maxConnections):
+        self.__url = url
+        self.__sslVerify = sslVerify
+        self.__idle = []
+        self.__lock = threading.Lock()
+        self.__slots = threading.BoundedSemaphore(maxConnections)
+        # Cleared if a streaming upload to the server failed
+        self.streamingUploads = True
+
+    def __connect(self):
+        url = self.__url
+        if url.scheme == 'http':
+            return http.client.HTTPConnection(url.hostname, url.port)
+        elif url.scheme == 'https':
+            ctx = None if self.__sslVerify else ssl.SSLContext(ssl.PROTOCOL_SSLv23)
+            return http.client.HTTPSConnection(url.hostname, url.port,
+                                               context=ctx)
+        else:
+            raise BuildError("Unsupported URL scheme: '{}'".format(url.scheme))
+
+    def acquire(self):
+        """Get an idle connection or open a new one.
+
+        Blocks if the maximum number of connections is in use.
+        """
+        self.__slots.acquire()
+        try:
+            with self.__lock:
+                deadline = time.monotonic() - HttpConnectionPool.IDLE_TIMEOUT
+                while self.__idle and self.__idle[0][0] < deadline:
+                    self.__idle.pop(0)[1].close()
+                if self.__idle:
+                    return self.__idle.pop()[1]
+            return self.__connect()
+        except:
+            self.__slots.release()
+            raise
+
+    def discardIdle(self):
+        with self.__lock:
+            idle = self.__idle
+            self.__idle = []
+        for (_, connection) in idle: connection.close()
+
+    def release(self, connection, reuse=True):
+        """Give back connection to pool.
+
+        Connections are only reused if the last response was read completely
+        and no error happened.
+        """
+        if reuse:
+            with self.__lock:
+                self.__idle.append((time.monotonic(), connection))
+        else:
+            connection.close()
+        self.__slots.release()
+
+# Connection pools of the current process
+_httpPools = {}
+
+def getHttpConnectionPool(url, sslVerify, maxConnections):
+    key = (url.scheme, url.netloc, sslVerify)
+    (pid, pool) = _httpPools.get(key, (None, None))
+    if pid != os.getpid():
+        # Never share connections with a forked parent process
+        pool = HttpConnectionPool(url, sslVerify, maxConnections)
+        _httpPools[key] = (os.getpid(), pool)
+    return pool
+
+
 class SimpleHttpArchive(BaseArchive):
     def __init__(self, spec, secureSSL):
         super().__init__(spec)
         self.__url = urllib.parse.urlparse(spec["url"])
-        self.__connection = None
         self.__sslVerify = spec.get("sslVerify", secureSSL)
+        self.__maxConnections = spec.get("maxConnections", 4)
+        self.__chunkedUpload = spec.get("chunkedUpload", False)
 
     def __retry(self, request):
         retry = True
@@ -475,12 +1380,14 @@ class SimpleHttpArchive(BaseArchive):
             try:
                 return (True, request())
             except (http.client.HTTPException, OSError) as e:
-                self._resetConnection()
+                # Other idle connections are probably stale too
+                self._getConnectionPool().discardIdle()
                 if not retry: return (False, e)
                 retry = False
 
-    def _makeUrl(self, buildId, suffix):
-        packageResultId = buildIdToName(buildId)
+    def _makeUrl(self, buildId, suffix, generation=None):
+        if generation is None: generation = self._generation
+        packageResultId = buildIdToName(buildId, generation)
         return "/".join([self.__url.path, packageResultId[0:2], packageResultId[2:4],
             packageResultId[4:] + suffix])
 
@@ -488,49 +1395,70 @@ class SimpleHttpArchive(BaseArchive):
         url = self.__url
         return urllib.parse.urlunparse((url.scheme, url.netloc, self._makeUrl(buildId, suffix), '', '', ''))
 
-    def _getConnection(self):
-        if self.__connection is not None:
-            return self.__connection
-
-        url = self.__url
-        if url.scheme == 'http':
-            connection = http.client.HTTPConnection(url.hostname, url.port)
-        elif url.scheme == 'https':
-            ctx = None if self.__sslVerify else ssl.SSLContext(ssl.PROTOCOL_SSLv23)
-            connection = http.client.HTTPSConnection(url.hostname, url.port,
-                                                     context=ctx)
-        else:
-            raise BuildError("Unsupported URL scheme: '{}'".format(url.schema))
-
-        self.__connection = connection
-        return connection
+    def _getConnectionPool(self):
+        return getHttpConnectionPool(self.__url, self.__sslVerify,
+                                     self.__maxConnections)
 
-    def _resetConnection(self):
-        if self.__connection is not None:
-            self.__connection.close()
-            self.__connection = None
+    def __request(self, method, url, body=None, headers={}):
+        """Do request on pooled connection and read the whole response."""
+        pool = self._getConnectionPool()
+        connection = pool.acquire()
+        try:
+            connection.request(method, url, body, headers=headers)
+            response = connection.getresponse()
+            response.read()
+        except:
+            pool.release(connection, False)
+            raise
+        pool.release(connection, not response.will_close)
+        return response
 
-    def _openDownloadFile(self, buildId, suffix):
-        (ok, result) = self.__retry(lambda: self.__openDownloadFile(buildId, suffix))
+    def _openDownloadFile(self, buildId, suffix, generation):
+        (ok, result) = self.__retry(lambda: self.__openDownloadFile(buildId,
+            suffix, generation))
         if ok:
             return result
         else:
             raise ArtifactDownloadError(str(result))
 
-    def __openDownloadFile(self, buildId, suffix):
-        connection = self._getConnection()
-        url = self._makeUrl(buildId, suffix)
-        connection.request("GET", url)
-        response = connection.getresponse()
-        if response.status == 200:
-            return SimpleHttpDownloader(self, response)
-        else:
+    def __openDownloadFile(self, buildId, suffix, generation):
+        pool = self._getConnectionPool()
+        connection = pool.acquire()
+        url = self._makeUrl(buildId, suffix, generation)
+        try:
+            connection.request("GET", url)
+            response = connection.getresponse()
+            if response.status == 200:
+                return SimpleHttpDownloader(pool, connection, response)
             response.read()
-            if response.status == 404:
-                raise ArtifactNotFoundError()
-            else:
-                raise ArtifactDownloadError("{} {}".format(response.status,
-                                                           response.reason))
+        except:
+            pool.release(connection, False)
+            raise
+        pool.release(connection, not response.will_close)
+        if response.status == 404:
+            raise ArtifactNotFoundError()
+        else:
+            raise ArtifactDownloadError("{} {}".format(response.status,
+                                                       response.reason))
+
+    def _probeDownloadFile(self, buildId, suffix, generation):
+        url = self._makeUrl(buildId, suffix, generation)
+        (ok, result) = self.__retry(lambda: self.__request("HEAD", url))
+        if not ok:
+            raise ArtifactDownloadError(str(result))
+        if result.status == 200:
+            return True
+        elif result.status == 404:
+            return False
+        else:
+            raise ArtifactDownloadError("HEAD {} {}".format(result.status, result.reason))
+
+    def _probeDownloadFiles(self, files):
+        # http.client cannot pipeline requests. Instead issue the HEAD
+        # requests concurrently on the pooled keep-alive connections.
+        with concurrent.futures.ThreadPoolExecutor(
+                max_workers=self.__maxConnections) as executor:
+            return list(executor.map(lambda f: self._probe(*f), files))
 
     def _openUploadFile(self, buildId, suffix):
         (ok, result) = self.__retry(lambda: self.__openUploadFile(buildId, suffix))
@@ -540,20 +1468,22 @@ class SimpleHttpArchive(BaseArchive):
             raise ArtifactUploadError(str(result))
 
     def __openUploadFile(self, buildId, suffix):
-        connection = self._getConnection()
         url = self._makeUrl(buildId, suffix)
 
         # check if already there
-        connection.request("HEAD", url)
-        response = connection.getresponse()
-        response.read()
+        response = self.__request("HEAD", url)
         if response.status == 200:
             raise ArtifactExistsError()
         elif response.status != 404:
             raise ArtifactUploadError("HEAD {} {}".format(response.status, response.reason))
 
-        # create temporary file
-        return SimpleHttpUploader(self, url)
+        # Stream artifacts directly to the server if possible. Otherwise
+        # create temporary file.
+        pool = self._getConnectionPool()
+        if self.__chunkedUpload and pool.streamingUploads and suffix != BUILDID_SUFFIX:
+            return SimpleHttpStreamUploader(pool, url)
+        else:
+            return SimpleHttpUploader(self, url)
 
     def _putUploadFile(self, url, tmp):
         (ok, result) = self.__retry(lambda: self.__putUploadFile(url, tmp))
@@ -568,11 +1498,8 @@ class SimpleHttpArchive(BaseArchive):
         tmp.seek(0, os.SEEK_END)
         length = str(tmp.tell())
         tmp.seek(0)
-        connection = self._getConnection()
-        connection.request("PUT", url, tmp, headers={ 'Content-Length' : length,
+        response = self.__request("PUT", url, tmp, headers={ 'Content-Length' : length,
             'If-None-Match' : '*' })
-        response = connection.getresponse()
-        response.read()
         if response.status == 412:
             # precondition failed -> lost race with other upload
             raise ArtifactExistsError()
@@ -598,7 +1525,7 @@ class SimpleHttpArchive(BaseArchive):
                 fi
             fi""".format(URL=self.__url.geturl(), BUILDID=quote(buildIdFile), RESULT=quote(tgzFile),
                          FAIL="" if self._ignoreErrors() else "; exit 1",
-                         GEN=ARCHIVE_GENERATION, SUFFIX=artifactSuffixJenkins(fingerprintFile),
+                         GEN=self._jenkinsGeneration, SUFFIX=artifactSuffixJenkins(fingerprintFile),
                          INSECURE=insecure))
 
     def download(self, step, buildIdFile, fingerprintFile, tgzFile):
@@ -614,7 +1541,7 @@ class SimpleHttpArchive(BaseArchive):
                 curl -sSg {INSECURE} --fail -o {RESULT} "$BOB_DOWNLOAD_URL" || echo Download failed: $?
             fi
             """.format(URL=self.__url.geturl(), BUILDID=quote(buildIdFile), RESULT=quote(tgzFile),
-                       GEN=ARCHIVE_GENERATION, SUFFIX=artifactSuffixJenkins(fingerprintFile),
+                       GEN=self._jenkinsGeneration, SUFFIX=artifactSuffixJenkins(fingerprintFile),
                        INSECURE=insecure))
 
     def uploadJenkinsLiveBuildId(self, step, liveBuildId, buildId):
@@ -636,19 +1563,118 @@ class SimpleHttpArchive(BaseArchive):
             """.format(URL=self.__url.geturl(), LIVEBUILDID=quote(liveBuildId),
                        BUILDID=quote(buildId),
                        FAIL="" if self._ignoreErrors() else "; exit 1",
-                       GEN=ARCHIVE_GENERATION, SUFFIX=BUILDID_SUFFIX,
+                       GEN=self._jenkinsGeneration, SUFFIX=BUILDID_SUFFIX,
                        INSECURE=insecure))
 
 class SimpleHttpDownloader:
-    def __init__(self, archiver, response):
-        self.archiver = archiver
+    def __init__(self, pool, connection, response):
+        self.pool = pool
+        self.connection = connection
         self.response = response
     def __enter__(self):
         return (None, self.response)
     def __exit__(self, exc_type, exc_value, traceback):
-        # reset connection on abnormal termination
-        if exc_type is not None:
-            self.archiver._resetConnection()
+        # Drop connection on abnormal termination. Otherwise consume trailing
+        # data so that the connection can be reused.
+        reuse = False
+        if exc_type is None:
+            try:
+                self.response.read()
+                reuse = not self.response.will_close
+            except (http.client.HTTPException, OSError):
+                pass
+        self.pool.release(self.connection, reuse)
+        return False
+
+class SimpleHttpStreamUploader:
+    """Upload with chunked transfer encoding while the artifact is packed.
+
+    A concurrent upload is detected by the 'If-None-Match' header like on
+    regular uploads. If the server rejects the chunked request or the
+    transfer breaks, streaming is disabled for the server and an
+    ArtifactStreamError is raised.
+    """
+
+    CHUNK_SIZE = 64 * 1024
+
+    # Servers that need a Content-Length or do not implement chunked requests
+    REJECTED = frozenset([400, 405, 411, 413, 415, 501, 505])
+
+    def __init__(self, pool, url):
+        self.pool = pool
+        self.url = url
+        self.connection = None
+        self.buf = []
+        self.bufLen = 0
+        self.broken = False
+
+    def __enter__(self):
+        self.connection = self.pool.acquire()
+        try:
+            self.connection.putrequest("PUT", self.url)
+            self.connection.putheader("Transfer-Encoding", "chunked")
+            self.connection.putheader("If-None-Match", "*")
+            self.connection.endheaders()
+        except (http.client.HTTPException, OSError) as e:
+            self.pool.release(self.connection, False)
+            self.__fail(str(e))
+        except:
+            self.pool.release(self.connection, False)
+            raise
+        return (None, self)
+
+    def __fail(self, reason):
+        self.pool.streamingUploads = False
+        raise ArtifactStreamError(reason)
+
+    def __send(self, data):
+        try:
+            self.connection.send(data)
+        except (http.client.HTTPException, OSError):
+            self.broken = True
+            raise
+
+    def __flush(self):
+        if not self.bufLen: return
+        data = b''.join(self.buf)
+        self.buf = []
+        self.bufLen = 0
+        self.__send("{:x}\r\n".format(len(data)).encode("ascii") + data + b"\r\n")
+
+    def write(self, data):
+        self.buf.append(bytes(data))
+        self.bufLen += len(data)
+        if self.bufLen >= SimpleHttpStreamUploader.CHUNK_SIZE:
+            self.__flush()
+        return len(data)
+
+    def flush(self):
+        pass
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        reuse = False
+        try:
+            if exc_type is None:
+                try:
+                    self.__flush()
+                    self.__send(b"0\r\n\r\n")
+                    response = self.connection.getresponse()
+                    response.read()
+                except (http.client.HTTPException, OSError) as e:
+                    self.__fail(str(e))
+                reuse = not response.will_close
+                if response.status == 412:
+                    # precondition failed -> lost race with other upload
+                    raise ArtifactExistsError()
+                elif response.status in SimpleHttpStreamUploader.REJECTED:
+                    self.__fail("PUT {} {}".format(response.status, response.reason))
+                elif response.status not in [200, 201, 204]:
+                    raise ArtifactUploadError("PUT {} {}".format(response.status,
+                                                                 response.reason))
+            elif self.broken:
+                self.__fail(str(exc_value))
+        finally:
+            self.pool.release(self.connection, reuse)
         return False
 
 class SimpleHttpUploader:
@@ -677,8 +1703,9 @@ class CustomArchive(BaseArchive):
         self.__uploadCmd = spec.get("upload")
         self.__whiteList = whiteList
 
-    def _makeUrl(self, buildId, suffix):
-        packageResultId = buildIdToName(buildId)
+    def _makeUrl(self, buildId, suffix, generation=None):
+        if generation is None: generation = self._generation
+        packageResultId = buildIdToName(buildId, generation)
         return "/".join([packageResultId[0:2], packageResultId[2:4],
             packageResultId[4:] + suffix])
 
@@ -697,9 +1724,9 @@ class CustomArchive(BaseArchive):
     def canUploadJenkins(self):
         return super().canUploadJenkins() and (self.__uploadCmd is not None)
 
-    def _openDownloadFile(self, buildId, suffix):
+    def _openDownloadFile(self, buildId, suffix, generation):
         (tmpFd, tmpName) = mkstemp()
-        url = self._makeUrl(buildId, suffix)
+        url = self._makeUrl(buildId, suffix, generation)
         try:
             os.close(tmpFd)
             env = { k:v for (k,v) in os.environ.items() if k in self.__whiteList }
@@ -740,7 +1767,7 @@ class CustomArchive(BaseArchive):
             BOB_LOCAL_ARTIFACT={RESULT}
             BOB_REMOTE_ARTIFACT="${{BOB_UPLOAD_BID:0:2}}/${{BOB_UPLOAD_BID:2:2}}/${{BOB_UPLOAD_BID:4}}{SUFFIX}"
             """.format(BUILDID=quote(buildIdFile), RESULT=quote(tgzFile),
-                       GEN=ARCHIVE_GENERATION, SUFFIX=suffix)) + cmd
+                       GEN=self._jenkinsGeneration, SUFFIX=suffix)) + cmd
 
     def upload(self, step, buildIdFile, fingerprintFile, tgzFile):
         return self.__uploadJenkins(step, buildIdFile, tgzFile, artifactSuffixJenkins(fingerprintFile))
@@ -758,7 +1785,7 @@ if [[ ! -e {RESULT} ]] ; then
     {CMD}
 fi
 """.format(CMD=self.__downloadCmd, BUILDID=quote(buildIdFile), RESULT=quote(tgzFile),
-           GEN=ARCHIVE_GENERATION, SUFFIX=artifactSuffixJenkins(fingerprintFile))
+           GEN=self._jenkinsGeneration, SUFFIX=artifactSuffixJenkins(fingerprintFile))
 
     def uploadJenkinsLiveBuildId(self, step, liveBuildId, buildId):
         return self.__uploadJenkins(step, liveBuildId, buildId, BUILDID_SUFFIX)
@@ -813,22 +1840,22 @@ class AzureArchive(BaseArchive):
             account_key=self.__key, sas_token=self.__sasToken, socket_timeout=6000)
 
     @staticmethod
-    def __makeBlobName(buildId, suffix):
-        packageResultId = buildIdToName(buildId)
+    def __makeBlobName(buildId, suffix, generation=ARCHIVE_GENERATION):
+        packageResultId = buildIdToName(buildId, generation)
         return "/".join([packageResultId[0:2], packageResultId[2:4],
             packageResultId[4:] + suffix])
 
     def _remoteName(self, buildId, suffix):
         return "https://{}.blob.core.windows.net/{}/{}".format(self.__account,
-            self.__container, self.__makeBlobName(buildId, suffix))
+            self.__container, self.__makeBlobName(buildId, suffix, self._generation))
 
-    def _openDownloadFile(self, buildId, suffix):
+    def _openDownloadFile(self, buildId, suffix, generation):
         from azure.common import AzureException, AzureMissingResourceHttpError
         (tmpFd, tmpName) = mkstemp()
         try:
             os.close(tmpFd)
             self.__service.get_blob_to_path(self.__container,
-                self.__makeBlobName(buildId, suffix), tmpName)
+                self.__makeBlobName(buildId, suffix, generation), tmpName)
             ret = tmpName
             tmpName = None
             return AzureDownloader(ret)
@@ -839,10 +1866,18 @@ class AzureArchive(BaseArchive):
         finally:
             if tmpName is not None: os.unlink(tmpName)
 
+    def _probeDownloadFile(self, buildId, suffix, generation):
+        from azure.common import AzureException
+        try:
+            return self.__service.exists(self.__container,
+                self.__makeBlobName(buildId, suffix, generation))
+        except AzureException as e:
+            raise ArtifactDownloadError(str(e))
+
     def _openUploadFile(self, buildId, suffix):
         from azure.common import AzureException
 
-        blobName = self.__makeBlobName(buildId, suffix)
+        blobName = self.__makeBlobName(buildId, suffix, self._generation)
         try:
             if self.__service.exists(self.__container, blobName):
                 raise ArtifactExistsError()
@@ -859,6 +1894,8 @@ class AzureArchive(BaseArchive):
         args = []
         if self.__key: args.append("--key=" + self.__key)
         if self.__sasToken: args.append("--sas-token=" + self.__sasToken)
+        if self._jenkinsGeneration != ARCHIVE_GENERATION:
+            args.append("--generation=" + self._jenkinsGeneration)
 
         return "\n" + textwrap.dedent("""\
             # upload artifact
@@ -877,6 +1914,8 @@ class AzureArchive(BaseArchive):
         args = []
         if self.__key: args.append("--key=" + self.__key)
         if self.__sasToken: args.append("--sas-token=" + self.__sasToken)
+        if self._jenkinsGeneration != ARCHIVE_GENERATION:
+            args.append("--generation=" + self._jenkinsGeneration)
 
         return "\n" + textwrap.dedent("""\
             if [[ ! -e {RESULT} ]] ; then
@@ -893,6 +1932,8 @@ class AzureArchive(BaseArchive):
         args = []
         if self.__key: args.append("--key=" + self.__key)
         if self.__sasToken: args.append("--sas-token=" + self.__sasToken)
+        if self._jenkinsGeneration != ARCHIVE_GENERATION:
+            args.append("--generation=" + self._jenkinsGeneration)
 
         return "\n" + textwrap.dedent("""\
             # upload live build-id
@@ -944,6 +1985,7 @@ class AzureArchive(BaseArchive):
         parser.add_argument('file')
         parser.add_argument('--key')
         parser.add_argument('--sas-token')
+        parser.add_argument('--generation', default=ARCHIVE_GENERATION)
         args = parser.parse_args(args)
 
         try:
@@ -956,7 +1998,8 @@ class AzureArchive(BaseArchive):
 
         try:
             with open(args.buildid, 'rb') as f:
-                remoteBlob = AzureArchive.__makeBlobName(f.read(), args.suffix)
+                remoteBlob = AzureArchive.__makeBlobName(f.read(), args.suffix,
+                                                         args.generation)
         except OSError as e:
             raise BuildError(str(e))
 
@@ -1001,8 +2044,86 @@ class AzureUploader:
 
 
 class MultiArchive:
+    """Combination of multiple archive backends.
+
+    Uploads go to all backends. For downloads the existence of an artifact
+    is checked on all backends concurrently. The artifact is then taken from
+    the backend that confirmed it first, and the checks that are still
+    running are cancelled. Backends that cannot check cheaply, or whose
+    download fails, are tried afterwards in the configured order. The
+    latency of every backend is tracked so that the fastest backends are
+    probed first.
+    """
+
+    # Weight of the last probe in the moving latency average
+    LATENCY_WEIGHT = 0.3
+
     def __init__(self, archives):
         self.__archives = archives
+        self.__latencies = {}
+        self.__executor = None
+
+    def getLatencies(self):
+        """Return the average probe latency in seconds of the backends."""
+        return [ self.__latencies.get(i) for i in self.__archives ]
+
+    def __updateLatency(self, archive, latency):
+        old = self.__latencies.get(archive)
+        if old is not None:
+            latency = old + (latency - old) * MultiArchive.LATENCY_WEIGHT
+        self.__latencies[archive] = latency
+
+    def __getExecutor(self):
+        if self.__executor is None:
+            self.__executor = concurrent.futures.ThreadPoolExecutor(
+                max_workers=len(self.__archives) * 4)
+        return self.__executor
+
+    async def __hedge(self, probe):
+        """Probe all download backends concurrently.
+
+        Returns the backend that confirmed the artifact first (or None) and
+        the list of backends that must be tried in order otherwise. The list
+        is sorted by the measured latency of the backends.
+        """
+        candidates = [ i for i in self.__archives if i.canDownloadLocal() ]
+        if len(candidates) <= 1:
+            return (None, candidates)
+
+        loop = asyncio.get_event_loop()
+        executor = self.__getExecutor()
+        start = time.monotonic()
+        pending = {}
+        for i in sorted(candidates, key=lambda a: self.__latencies.get(a, 0.0)):
+            pending[loop.create_task(probe(i, executor))] = i
+
+        winner = None
+        missing = set()
+        try:
+            while pending and (winner is None):
+                done, _ = await asyncio.wait(pending, return_when=asyncio.FIRST_COMPLETED)
+                now = time.monotonic()
+                for task in done:
+                    archive = pending.pop(task)
+                    found = task.result()
+                    if found is None: continue
+                    self.__updateLatency(archive, now - start)
+                    if not found:
+                        missing.add(archive)
+                    elif winner is None:
+                        winner = archive
+        finally:
+            # The losers were at least as slow as the winner
+            now = time.monotonic()
+            for (task, archive) in pending.items():
+                task.cancel()
+                self.__updateLatency(archive, now - start)
+
+        # Try the remaining backends fastest first. Backends without measured
+        # latency are tried last in their configured order.
+        others = [ i for i in candidates if (i is not winner) and (i not in missing) ]
+        others.sort(key=lambda a: self.__latencies.get(a, float("inf")))
+        return (winner, others)
 
     def wantDownload(self, enable):
         for i in self.__archives: i.wantDownload(enable)
@@ -1010,6 +2131,9 @@ class MultiArchive:
     def wantUpload(self, enable):
         for i in self.__archives: i.wantUpload(enable)
 
+    def setHashAlgorithm(self, algorithm):
+        for i in self.__archives: i.setHashAlgorithm(algorithm)
+
     def canDownloadLocal(self):
         return any(i.canDownloadLocal() for i in self.__archives)
 
@@ -1023,16 +2147,59 @@ class MultiArchive:
         return any(i.canUploadJenkins() for i in self.__archives)
 
     async def uploadPackage(self, step, buildId, fingerprint, audit, content):
+        ret = False
         for i in self.__archives:
             if not i.canUploadLocal(): continue
-            await i.uploadPackage(step, buildId, fingerprint, audit, content)
+            uploaded = await i.uploadPackage(step, buildId, fingerprint, audit, content)
+            if uploaded is None:
+                ret = None
+            elif uploaded and ret is not None:
+                ret = True
+        return ret
 
-    async def downloadPackage(self, step, buildId, fingerprint, audit, content):
-        for i in self.__archives:
-            if not i.canDownloadLocal(): continue
-            if await i.downloadPackage(step, buildId, fingerprint, audit, content): return True
+    async def downloadPackage(self, step, buildId, fingerprint, audit, content,
+                              hashIndex=None):
+        (winner, others) = await self.__hedge(
+            lambda archive, probeExecutor: archive.probePackage(buildId, fingerprint, probeExecutor))
+        if winner is None and not others and self.canDownloadLocal():
+            with stepAction(step, "DOWNLOAD", content) as a:
+                a.fail("not found", WARNING)
+            return False
+        for i in ([winner] if winner is not None else []) + others:
+            if await i.downloadPackage(step, buildId, fingerprint, audit, content,
+                                       hashIndex):
+                return True
         return False
 
+    async def prefetchPackage(self, step, buildId, fingerprint, fileName, executor, rateLimit):
+        (winner, others) = await self.__hedge(
+            lambda archive, probeExecutor: archive.probePackage(buildId, fingerprint, probeExecutor))
+        ret = False
+        for i in ([winner] if winner is not None else []) + others:
+            found = await i.prefetchPackage(step, buildId, fingerprint, fileName,
+                                            executor, rateLimit)
+            if found: return True
+            if found is None: ret = None
+        return ret
+
+    async def probePackages(self, artifacts, executor=None):
+        candidates = [ i for i in self.__archives if i.canDownloadLocal() ]
+        if not candidates:
+            return [False] * len(artifacts)
+
+        executor = self.__getExecutor()
+        results = await asyncio.gather(*(i.probePackages(artifacts, executor)
+                                         for i in candidates))
+        ret = []
+        for found in zip(*results):
+            if any(found):
+                ret.append(True)
+            elif all(f is False for f in found):
+                ret.append(False)
+            else:
+                ret.append(None)
+        return ret
+
     def upload(self, step, buildIdFile, fingerprintFile, tgzFile):
         return "\n".join(
             i.upload(step, buildIdFile, fingerprintFile, tgzFile) for i in self.__archives
@@ -1049,9 +2216,10 @@ class MultiArchive:
             await i.uploadLocalLiveBuildId(step, liveBuildId, buildId)
 
     async def downloadLocalLiveBuildId(self, step, liveBuildId):
+        (winner, others) = await self.__hedge(
+            lambda archive, probeExecutor: archive.probeLocalLiveBuildId(liveBuildId, probeExecutor))
         ret = None
-        for i in self.__archives:
-            if not i.canDownloadLocal(): continue
+        for i in ([winner] if winner is not None else []) + others:
             ret = await i.downloadLocalLiveBuildId(step, liveBuildId)
             if ret is not None: break
         return ret
@@ -1062,20 +2230,473 @@ class MultiArchive:
             for i in self.__archives if i.canUploadJenkins())
 
 
+class ArtifactPrefetcher:
+    """Download artifacts ahead of time into a staging directory.
+
+    Prefetches are scheduled while the build proceeds and run in parallel in
+    a dedicated thread pool. The number of concurrent downloads and the
+    overall bandwidth are limited independently of the build jobs. When the
+    builder reaches a package it takes the staged artifact and merely needs
+    to unpack it.
+    """
+
+    def __init__(self, archive, jobs, rateLimit=0, algorithm='sha1'):
+        self.__archive = archive
+        self.__algorithm = algorithm
+        self.__jobs = jobs
+        self.__rateLimit = rateLimit / jobs if rateLimit else 0
+        self.__downloads = {}
+        self.__tasks = set()
+        self.__executor = None
+        self.__staging = None
+
+    def start(self):
+        self.__staging = mkdtemp(prefix=".bob-prefetch-", dir=".")
+        self.__executor = concurrent.futures.ThreadPoolExecutor(
+            max_workers=self.__jobs)
+
+    async def stop(self):
+        """Cancel all pending prefetches and remove staged artifacts.
+
+        Deleting the staging directory aborts running transfers too.
+        """
+        tasks = list(self.__tasks)
+        tasks.extend(t for t in self.__downloads.values() if t is not None)
+        for t in tasks: t.cancel()
+        if tasks:
+            await asyncio.gather(*tasks, return_exceptions=True)
+        self.__tasks.clear()
+        self.__downloads.clear()
+        if self.__executor is not None:
+            self.__executor.shutdown(wait=False)
+            self.__executor = None
+        if self.__staging is not None:
+            removePath(self.__staging)
+            self.__staging = None
+
+    def spawn(self, coro):
+        """Run a coroutine that is cancelled when the prefetcher stops."""
+        task = asyncio.get_event_loop().create_task(coro)
+        self.__tasks.add(task)
+        task.add_done_callback(self.__tasks.discard)
+        return task
+
+    async def prefetch(self, step, buildId, fingerprint):
+        """Prefetch an artifact.
+
+        Returns True if the artifact was staged, False if it is not in the
+        archive and None if it was not (or could not be) prefetched.
+        """
+        key = (buildId, fingerprint)
+        if key in self.__downloads: return None
+        fileName = os.path.join(self.__staging,
+            asHexStr(buildId) + artifactSuffixLocal(fingerprint))
+        task = asyncio.get_event_loop().create_task(self.__archive.prefetchPackage(
+            step, buildId, fingerprint, fileName, self.__executor,
+            self.__rateLimit))
+        self.__downloads[key] = task
+        return await asyncio.shield(task)
+
+    async def take(self, buildId, fingerprint):
+        """Take a prefetched artifact.
+
+        Waits for a running prefetch. Returns the name of the staged file,
+        False if the artifact is known to be missing or None if it was not
+        prefetched. In the latter case the artifact must be downloaded
+        regularly. It will not be prefetched anymore.
+        """
+        key = (buildId, fingerprint)
+        task = self.__downloads.get(key)
+        self.__downloads[key] = None
+        if task is None: return None
+        ret = await asyncio.shield(task)
+        if ret:
+            return os.path.join(self.__staging,
+                asHexStr(buildId) + artifactSuffixLocal(fingerprint))
+        return ret
+
+    async def unpack(self, step, prefetched, audit, content, hashIndex=None):
+        """Unpack a taken artifact like BaseArchive.downloadPackage() does."""
+        loop = asyncio.get_event_loop()
+        with stepAction(step, "DOWNLOAD", content, details="(prefetched)") as a:
+            if not prefetched:
+                a.fail("not found", WARNING)
+                return False
+            try:
+                await loop.run_in_executor(None, ArtifactPrefetcher._unpack,
+                    prefetched, audit, content, hashIndex, self.__algorithm)
+            except (concurrent.futures.CancelledError, concurrent.futures.process.BrokenProcessPool):
+                raise BuildError("Download of package interrupted.")
+            finally:
+                removePath(prefetched)
+        return True
+
+    @staticmethod
+    def _unpack(fileName, audit, content, hashIndex, algorithm):
+        # restore signals to default so that Ctrl+C kills us
+        signal.signal(signal.SIGINT, signal.SIG_DFL)
+
+        try:
+            unpackPackage(fileName, None, audit, content, hashIndex, algorithm)
+        except BuildError as e:
+            raise
+        except OSError as e:
+            raise BuildError("Cannot unpack artifact: " + str(e))
+        except tarfile.TarError as e:
+            raise BuildError("Error extracting binary artifact: " + str(e))
+
+
+class UploadQueue:
+    """Upload artifacts in the background.
+
+    Packages need not wait for the upload of their artifacts. At most 'jobs'
+    uploads run concurrently. Failed uploads are retried up to 'retries'
+    times with an exponential backoff. The queue must be drained before the
+    build finishes. The outcome of the uploads is counted in the
+    'artifactsUploaded', 'artifactsUploadSkipped' and 'artifactsUploadFailed'
+    attributes of 'statistic' if given.
+    """
+
+    BACKOFF = 1.0
+
+    def __init__(self, archive, jobs, retries=2, statistic=None):
+        self.__archive = archive
+        self.__slots = asyncio.BoundedSemaphore(jobs)
+        self.__retries = retries
+        self.__statistic = statistic
+        self.__tasks = set()
+        self.__errors = []
+        self.__cancelled = False
+
+    def __count(self, uploaded):
+        if self.__statistic is None: return
+        if uploaded:
+            self.__statistic.artifactsUploaded += 1
+        elif uploaded is None:
+            self.__statistic.artifactsUploadFailed += 1
+        else:
+            self.__statistic.artifactsUploadSkipped += 1
+
+    async def upload(self, step, buildId, fingerprint, audit, content):
+        """Upload an artifact and wait for the result.
+
+        Raises the BuildError of the last try if all tries failed.
+        """
+        delay = UploadQueue.BACKOFF
+        for retry in range(self.__retries, -1, -1):
+            try:
+                async with self.__slots:
+                    uploaded = await self.__archive.uploadPackage(step, buildId,
+                        fingerprint, audit, content)
+                break
+            except BuildError:
+                # An interrupted upload is reported as BuildError too
+                if not retry or self.__cancelled:
+                    self.__count(None)
+                    raise
+            # Do not occupy an upload slot while backing off
+            await asyncio.sleep(delay)
+            delay *= 2
+        self.__count(uploaded)
+        return uploaded
+
+    def put(self, step, buildId, fingerprint, audit, content):
+        """Queue an artifact for upload without waiting for it."""
+        task = asyncio.get_event_loop().create_task(self.__uploadBackground(
+            step, buildId, fingerprint, audit, content))
+        self.__tasks.add(task)
+        task.add_done_callback(self.__tasks.discard)
+
+    async def __uploadBackground(self, step, buildId, fingerprint, audit, content):
+        try:
+            await self.upload(step, buildId, fingerprint, audit, content)
+        except BuildError as e:
+            if self.__cancelled: return
+            e.setStack(step.getPackage().getStack())
+            self.__errors.append(e)
+        except concurrent.futures.CancelledError:
+            pass
+
+    async def drain(self):
+        """Wait for all queued uploads.
+
+        Returns the errors of all failed uploads.
+        """
+        while self.__tasks:
+            await asyncio.wait(list(self.__tasks))
+        return self.__errors
+
+    def cancel(self):
+        """Cancel all outstanding uploads.
+
+        The queue still needs to be drained to reap the cancelled uploads.
+        Returns the number of dropped uploads.
+        """
+        self.__cancelled = True
+        tasks = [ t for t in self.__tasks if not t.done() ]
+        for t in tasks: t.cancel()
+        return len(tasks)
+
+
+class ArtifactCache:
+    """Node-wide read-through cache in front of another archive.
+
+    Downloaded artifacts are kept in a local directory that can be shared by
+    all workspaces and concurrently running Bob processes of a host. The
+    cache is keyed by build-id and fingerprint. Artifacts are hard linked
+    into place atomically. Every hit bumps the modification time of the
+    cached file. If the cache grows beyond 'maxSize' bytes the least
+    recently used artifacts are evicted. Evictions are serialized by a lock
+    file. Readers never take the lock. Instead they hard link the cached
+    artifact to a private name first so that it cannot vanish while it is
+    unpacked.
+
+    If 'statistic' is given, its 'artifactCacheHits' and
+    'artifactCacheMisses' counters are updated.
+    """
+
+    LOCK_FILE = ".lock"
+    STALE_TIME = 24 * 60 * 60
+
+    def __init__(self, archive, path, maxSize, algorithm='sha1', statistic=None):
+        self.__archive = archive
+        self.__path = os.path.abspath(os.path.expanduser(path))
+        self.__maxSize = maxSize
+        self.__algorithm = algorithm
+        self.__statistic = statistic
+
+    def wantDownload(self, enable):
+        self.__archive.wantDownload(enable)
+
+    def wantUpload(self, enable):
+        self.__archive.wantUpload(enable)
+
+    def setHashAlgorithm(self, algorithm):
+        self.__archive.setHashAlgorithm(algorithm)
+        self.__algorithm = algorithm
+
+    def canDownloadLocal(self):
+        return self.__archive.canDownloadLocal()
+
+    def canUploadLocal(self):
+        return self.__archive.canUploadLocal()
+
+    def canDownloadJenkins(self):
+        return self.__archive.canDownloadJenkins()
+
+    def canUploadJenkins(self):
+        return self.__archive.canUploadJenkins()
+
+    def __getPath(self, buildId, fingerprint):
+        packageResultId = buildIdToName(buildId, archiveGeneration(self.__algorithm))
+        return os.path.join(self.__path, packageResultId[0:2], packageResultId[2:4],
+            packageResultId[4:] + artifactSuffixLocal(fingerprint))
+
+    def __count(self, hit):
+        if self.__statistic is None: return
+        if hit:
+            self.__statistic.artifactCacheHits += 1
+        else:
+            self.__statistic.artifactCacheMisses += 1
+
+    @staticmethod
+    def __tempName(fileName):
+        return "{}.{}.tmp".format(fileName, asHexStr(os.urandom(8)))
+
+    @staticmethod
+    def _link(src, dst):
+        """Atomically link 'src' at 'dst' unless it already exists.
+
+        Falls back to a copy if both are on different file systems. Returns
+        False if 'src' does not exist.
+        """
+        os.makedirs(os.path.dirname(dst), exist_ok=True)
+        try:
+            os.link(src, dst)
+            return True
+        except FileExistsError:
+            return True # lost race
+        except FileNotFoundError:
+            return False
+        except OSError:
+            pass
+
+        # Replacing an existing file is harmless here because the content of
+        # an artifact is immutable.
+        tmp = ArtifactCache.__tempName(dst)
+        try:
+            shutil.copyfile(src, tmp)
+            os.replace(tmp, dst)
+            return True
+        except FileNotFoundError:
+            return False
+        finally:
+            if os.path.exists(tmp): os.unlink(tmp)
+
+    @staticmethod
+    def _evict(path, maxSize):
+        """Remove least recently used artifacts until the cache fits again."""
+        os.makedirs(path, exist_ok=True)
+        with open(os.path.join(path, ArtifactCache.LOCK_FILE), "a") as lock:
+            if fcntl is not None:
+                fcntl.flock(lock.fileno(), fcntl.LOCK_EX)
+            entries = []
+            inodes = set()
+            total = 0
+            now = time.time()
+            for (root, dirs, files) in os.walk(path):
+                for f in files:
+                    if f == ArtifactCache.LOCK_FILE: continue
+                    name = os.path.join(root, f)
+                    try:
+                        st = os.lstat(name)
+                    except OSError:
+                        continue
+                    # Pinned artifacts and running downloads must be kept.
+                    # Only leftovers of crashed processes are removed.
+                    if (".tmp" not in f) or (now - st.st_mtime > ArtifactCache.STALE_TIME):
+                        entries.append((st.st_mtime, name, st.st_size))
+                    # pinned artifacts are hard links of cached ones
+                    if (st.st_dev, st.st_ino) not in inodes:
+                        inodes.add((st.st_dev, st.st_ino))
+                        total += st.st_size
+
+            entries.sort()
+            for (mtime, name, size) in entries:
+                if total <= maxSize: break
+                try:
+                    os.unlink(name)
+                    total -= size
+                except OSError:
+                    pass
+
+    def __pin(self, cached):
+        """Pin a cached artifact to a private name and mark it as used.
+
+        Returns the private name or None if the artifact is not cached.
+        """
+        pinned = self.__tempName(cached)
+        try:
+            os.link(cached, pinned)
+            os.utime(cached)
+        except OSError:
+            return None
+        return pinned
+
+    async def downloadPackage(self, step, buildId, fingerprint, audit, content,
+                              hashIndex=None):
+        if not self.canDownloadLocal():
+            return False
+
+        loop = asyncio.get_event_loop()
+        cached = self.__getPath(buildId, fingerprint)
+        pinned = self.__pin(cached)
+        hit = pinned is not None
+        self.__count(hit)
+        if not hit:
+            pinned = self.__tempName(cached)
+            os.makedirs(os.path.dirname(cached), exist_ok=True)
+            found = await self.__archive.prefetchPackage(step, buildId, fingerprint,
+                pinned, None, 0)
+            if found is None:
+                # Let the archive report the problem
+                return await self.__archive.downloadPackage(step, buildId,
+                    fingerprint, audit, content, hashIndex)
+            elif not found:
+                with stepAction(step, "DOWNLOAD", content, details="(cache miss)") as a:
+                    a.fail("not found", WARNING)
+                return False
+
+        try:
+            if not hit:
+                try:
+                    await loop.run_in_executor(None, ArtifactCache._link, pinned, cached)
+                    await loop.run_in_executor(None, ArtifactCache._evict,
+                        self.__path, self.__maxSize)
+                except OSError:
+                    pass # the cache is just an optimization
+            with stepAction(step, "DOWNLOAD", content,
+                            details="(cached)" if hit else "(cache miss)"):
+                await loop.run_in_executor(None, ArtifactPrefetcher._unpack,
+                    pinned, audit, content, hashIndex, self.__algorithm)
+        except (concurrent.futures.CancelledError, concurrent.futures.process.BrokenProcessPool):
+            raise BuildError("Download of package interrupted.")
+        finally:
+            removePath(pinned)
+        return True
+
+    async def prefetchPackage(self, step, buildId, fingerprint, fileName, executor, rateLimit):
+        if not self.canDownloadLocal():
+            return False
+
+        loop = asyncio.get_event_loop()
+        cached = self.__getPath(buildId, fingerprint)
+        try:
+            hit = await loop.run_in_executor(executor, ArtifactCache._link,
+                                             cached, fileName)
+            if hit:
+                os.utime(cached)
+        except OSError:
+            hit = False
+        self.__count(hit)
+        if hit: return True
+
+        found = await self.__archive.prefetchPackage(step, buildId, fingerprint,
+            fileName, executor, rateLimit)
+        if found:
+            try:
+                await loop.run_in_executor(executor, ArtifactCache._link, fileName, cached)
+                await loop.run_in_executor(executor, ArtifactCache._evict,
+                    self.__path, self.__maxSize)
+            except OSError:
+                pass # the cache is just an optimization
+        return found
+
+    async def probePackages(self, artifacts, executor=None):
+        ret = [ True if os.path.isfile(self.__getPath(buildId, fingerprint)) else None
+                for (buildId, fingerprint) in artifacts ]
+        missing = [ i for (i, found) in enumerate(ret) if not found ]
+        if missing:
+            found = await self.__archive.probePackages([ artifacts[i] for i in missing ],
+                                                       executor)
+            for (i, f) in zip(missing, found): ret[i] = f
+        return ret
+
+    async def uploadPackage(self, step, buildId, fingerprint, audit, content):
+        return await self.__archive.uploadPackage(step, buildId, fingerprint, audit, content)
+
+    def upload(self, step, buildIdFile, fingerprintFile, tgzFile):
+        return self.__archive.upload(step, buildIdFile, fingerprintFile, tgzFile)
+
+    def download(self, step, buildIdFile, fingerprintFile, tgzFile):
+        return self.__archive.download(step, buildIdFile, fingerprintFile, tgzFile)
+
+    async def uploadLocalLiveBuildId(self, step, liveBuildId, buildId):
+        await self.__archive.uploadLocalLiveBuildId(step, liveBuildId, buildId)
+
+    async def downloadLocalLiveBuildId(self, step, liveBuildId):
+        return await self.__archive.downloadLocalLiveBuildId(step, liveBuildId)
+
+    def uploadJenkinsLiveBuildId(self, step, liveBuildId, buildId):
+        return self.__archive.uploadJenkinsLiveBuildId(step, liveBuildId, buildId)
+
+
 def getSingleArchiver(recipes, archiveSpec):
     archiveBackend = archiveSpec.get("backend", "none")
     if archiveBackend == "file":
-        return LocalArchive(archiveSpec)
+        ret = LocalArchive(archiveSpec)
     elif archiveBackend == "http":
-        return SimpleHttpArchive(archiveSpec, recipes.getPolicy('secureSSL'))
+        ret = SimpleHttpArchive(archiveSpec, recipes.getPolicy('secureSSL'))
     elif archiveBackend == "shell":
-        return CustomArchive(archiveSpec, recipes.envWhiteList())
+        ret = CustomArchive(archiveSpec, recipes.envWhiteList())
     elif archiveBackend == "azure":
-        return AzureArchive(archiveSpec)
+        ret = AzureArchive(archiveSpec)
     elif archiveBackend == "none":
         return DummyArchive()
     else:
         raise BuildError("Invalid archive backend: "+archiveBackend)
+    ret.setHashAlgorithm(recipes.getHashAlgorithm())
+    return ret
 
 def getArchiver(recipes):
     archiveSpec = recipes.archiveSpec()
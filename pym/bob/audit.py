@@ -17,6 +17,7 @@ import os
 import pickle
 import schema
 import struct
+import tempfile
 
 def digestMap(m, h):
     h.update(struct.pack("<BI", 1, len(m)))
@@ -211,11 +212,18 @@ class Artifact:
         self.__defines[name] = value
         self.__id = None
 
-    def addScm(self, name, workspace, dir):
+    @staticmethod
+    def scanScm(name, workspace, dir):
         scm = Artifact.SCMS.get(name)
         if scm is None:
             raise BuildError("Cannot handle SCM: " + name)
-        self.__scms.append(scm.fromDir(workspace, dir))
+        return scm.fromDir(workspace, dir)
+
+    def addScm(self, name, workspace, dir):
+        self.addScmAudit(Artifact.scanScm(name, workspace, dir))
+
+    def addScmAudit(self, scm):
+        self.__scms.append(scm)
         self.__id = None
 
     def addTool(self, name, tool):
@@ -259,15 +267,131 @@ class Artifact:
     def getFingerprint(self):
         return self.__fingerprint
 
+class AuditStore:
+    """Content addressed store of audit records.
+
+    Every artifact is stored exactly once, keyed by its artifact-id. Artifacts
+    are only added after all artifacts that they reference. Hence, if an
+    artifact is in the store, its whole audit trail is too.
+    """
+
+    def __init__(self, path):
+        self.__path = os.path.abspath(path)
+        self.__cache = {}
+
+    def getPath(self):
+        return self.__path
+
+    def __entry(self, aid):
+        aid = asHexStr(aid)
+        return os.path.join(self.__path, aid[0:2], aid[2:] + ".json.gz")
+
+    def __contains__(self, aid):
+        return aid in self.__cache or os.path.exists(self.__entry(aid))
+
+    def get(self, aid):
+        """Load artifact 'aid' from the store. Returns None if unknown."""
+        ret = self.__cache.get(aid)
+        if ret is not None: return ret
+
+        name = self.__entry(aid)
+        try:
+            with gzip.open(name, 'rb') as gzf:
+                tree = json.load(io.TextIOWrapper(gzf, encoding='utf8'))
+            ret = Artifact.fromData(Artifact.SCHEMA.validate(tree))
+        except FileNotFoundError:
+            return None
+        except OSError as e:
+            raise ParseError(name + ": Cannot read audit record: " + str(e))
+        except schema.SchemaError as e:
+            raise ParseError(name + ": Invalid audit record: " + str(e))
+        except ValueError as e:
+            raise ParseError(name + ": Invalid json: " + str(e))
+        if ret.getId() != aid:
+            raise ParseError(name + ": Corrupt audit record!")
+
+        self.__cache[aid] = ret
+        return ret
+
+    def put(self, artifact):
+        aid = artifact.getId()
+        if aid in self: return
+
+        name = self.__entry(aid)
+        os.makedirs(os.path.dirname(name), exist_ok=True)
+        (fd, tmpName) = tempfile.mkstemp(".tmp", dir=os.path.dirname(name))
+        try:
+            with os.fdopen(fd, "wb") as f:
+                with gzip.GzipFile(fileobj=f, mode='wb', compresslevel=6) as gzf:
+                    gzf.write(json.dumps(artifact.dump()).encode('utf8'))
+            os.replace(tmpName, name)
+        except:
+            os.unlink(tmpName)
+            raise
+        self.__cache[aid] = artifact
+
+    def collectGarbage(self, roots, dryRun=False):
+        """Remove all records that are not reachable from 'roots'.
+
+        Takes an iterable of artifact-ids that are referenced from outside of
+        the store. Returns the file names of the removed records. Nothing is
+        removed if 'dryRun' is True.
+        """
+        reachable = set()
+        todo = list(roots)
+        while todo:
+            aid = todo.pop()
+            if aid in reachable: continue
+            reachable.add(aid)
+            artifact = self.get(aid)
+            if artifact is not None: todo.extend(artifact.getReferences())
+
+        ret = []
+        try:
+            prefixes = sorted(os.listdir(self.__path))
+        except FileNotFoundError:
+            return ret
+        for prefix in prefixes:
+            d = os.path.join(self.__path, prefix)
+            if not os.path.isdir(d): continue
+            for f in sorted(os.listdir(d)):
+                if not f.endswith(".json.gz"): continue
+                try:
+                    aid = bytes.fromhex(prefix + f[:-len(".json.gz")])
+                except ValueError:
+                    continue
+                if aid in reachable: continue
+                name = os.path.join(d, f)
+                if not dryRun:
+                    os.unlink(name)
+                    self.__cache.pop(aid, None)
+                ret.append(name)
+        return ret
+
 class Audit:
+    """Audit trail of an artifact.
+
+    An audit trail can be saved in two formats. The self-contained format
+    holds all transitively referenced artifacts in the 'references' list. If
+    an AuditStore is set, the referenced artifacts are put into the store and
+    the saved audit just points to it. References are then resolved lazily.
+    """
+
     SCHEMA = schema.Schema({
         'artifact' : Artifact.SCHEMA,
         'references' : [ Artifact.SCHEMA ]
     })
 
+    LINKED_SCHEMA = schema.Schema({
+        'artifact' : Artifact.SCHEMA,
+        'store' : str
+    })
+
     def __init__(self):
         self.__artifact = Artifact()
         self.__references = {}
+        self.__stores = []
+        self.__store = None
 
     @classmethod
     def fromFile(cls, file):
@@ -285,9 +409,10 @@ class Audit:
         try:
             with gzip.open(file, 'rb') as gzf:
                 audit.load(gzf, file)
-            with open(cacheName, "wb") as f:
-                f.write(cacheKey)
-                pickle.dump(audit, f, -1)
+            if audit.__store is None:
+                with open(cacheName, "wb") as f:
+                    f.write(cacheKey)
+                    pickle.dump(audit, f, -1)
         except OSError as e:
             log("Error loading audit: " + str(e), WARNING)
         return audit
@@ -299,55 +424,111 @@ class Audit:
         return audit
 
     @classmethod
-    def create(cls, variantId, buildId, resultHash, fingerprint):
+    def create(cls, variantId, buildId, resultHash, fingerprint, store=None):
         audit = cls()
         audit.reset(variantId, buildId, resultHash, fingerprint)
+        audit.setStore(store)
         return audit
 
     def __merge(self, other):
         self.__references.update(other.__references)
         self.__references[other.getId()] = other.__artifact
+        for store in other.__stores:
+            if all(store.getPath() != i.getPath() for i in self.__stores):
+                self.__stores.append(store)
+
+    def __lookup(self, aid):
+        ret = self.__references.get(aid)
+        if ret is None:
+            for store in self.__stores:
+                ret = store.get(aid)
+                if ret is not None: break
+            else:
+                raise ParseError("Incomplete audit: missing " + asHexStr(aid))
+        return ret
 
-    def __validate(self):
-        done = set()
+    def __closure(self):
+        ret = {}
         refs = self.__artifact.getReferences()
         while refs:
             curId = refs.pop()
-            cur = self.__references.get(curId)
-            if cur is None:
-                raise ParseError("Incomplete audit: missing " + asHexStr(curId))
+            cur = self.__lookup(curId)
             for dep in cur.getReferences():
-                if dep not in done: refs.add(dep)
-            done.add(curId)
+                if dep not in ret: refs.add(dep)
+            ret[curId] = cur
+        return ret
+
+    def __export(self, store):
+        # Put referenced artifacts into the store. Dependencies are stored
+        # before the artifacts that reference them. Existing entries are
+        # already complete and are not descended into.
+        todo = [ (aid, False) for aid in self.__artifact.getReferences() ]
+        while todo:
+            (curId, expanded) = todo.pop()
+            if curId in store: continue
+            cur = self.__lookup(curId)
+            if expanded:
+                store.put(cur)
+            else:
+                todo.append((curId, True))
+                todo.extend((dep, False) for dep in cur.getReferences())
 
     def load(self, file, name):
         try:
             tree = json.load(io.TextIOWrapper(file, encoding='utf8'))
+            if isinstance(tree, dict) and "store" in tree:
+                tree = Audit.LINKED_SCHEMA.validate(tree)
+                self.__artifact = Artifact.fromData(tree["artifact"])
+                self.__references = {}
+                self.__stores = []
+                self.setStore(AuditStore(os.path.join(os.path.dirname(name),
+                                                      tree["store"])))
+                return
             tree = Audit.SCHEMA.validate(tree)
             self.__artifact = Artifact.fromData(tree["artifact"])
             self.__references = {
                 r["artifact-id"] : Artifact.fromData(r) for r in tree["references"]
             }
+            self.__stores = []
+            self.__store = None
         except schema.SchemaError as e:
             raise ParseError(name + ": Invalid audit record: " + str(e))
         except ValueError as e:
             raise ParseError(name + ": Invalid json: " + str(e))
-        self.__validate()
+        self.__closure()
 
     def save(self, file):
-        tree = {
-            "artifact" : self.__artifact.dump(),
-            "references" : [ a.dump() for a in self.__references.values() ]
-        }
+        """Save audit trail to 'file' (a file name or a binary stream).
+
+        If a store is set, the referenced artifacts are put into the store.
+        Otherwise all references are included in the saved audit trail.
+        """
+        tree = { "artifact" : self.__artifact.dump() }
+        isName = isinstance(file, str)
         try:
-            with gzip.open(file, 'wb', 6) as gzf:
-                json.dump(tree, io.TextIOWrapper(gzf, encoding='utf8'))
+            if self.__store is not None:
+                self.__export(self.__store)
+                store = self.__store.getPath()
+                if isName:
+                    store = os.path.relpath(store, os.path.dirname(os.path.abspath(file)))
+                tree["store"] = store
+            else:
+                self.__references = self.__closure()
+                self.__stores = []
+                tree["references"] = [ a.dump() for a in self.__references.values() ]
 
-            cacheName = file + ".pickle"
-            cacheKey = binStat(file) + BOB_INPUT_HASH
-            with open(cacheName, "wb") as f:
-                f.write(cacheKey)
-                pickle.dump(self, f, -1)
+            with gzip.open(file, 'wb', 6) as gzf:
+                gzf.write(json.dumps(tree).encode('utf8'))
+
+            # Linked audits are small and need no cache. Remove a stale one.
+            if isName and self.__store is not None:
+                if os.path.exists(file + ".pickle"): os.unlink(file + ".pickle")
+            elif isName:
+                cacheName = file + ".pickle"
+                cacheKey = binStat(file) + BOB_INPUT_HASH
+                with open(cacheName, "wb") as f:
+                    f.write(cacheKey)
+                    pickle.dump(self, f, -1)
 
         except OSError as e:
             raise BuildError("Cannot write audit: " + str(e))
@@ -355,13 +536,26 @@ class Audit:
     def reset(self, variantId, buildId, resultHash, fingerprint):
         self.__artifact.reset(variantId, buildId, resultHash, fingerprint)
         self.__references = {}
+        self.__stores = [ self.__store ] if self.__store is not None else []
+
+    def setStore(self, store):
+        """Set the AuditStore that is used to save the references.
+
+        A store of None saves the audit trail in the self-contained format.
+        """
+        self.__store = store
+        if store is not None and all(store.getPath() != i.getPath() for i in self.__stores):
+            self.__stores.append(store)
+
+    def isLinked(self):
+        return self.__store is not None
 
     def getId(self):
         return self.__artifact.getId()
 
     def getArtifact(self, aid=None):
         if aid:
-            return self.__references[aid]
+            return self.__lookup(aid)
         else:
             return self.__artifact
 
@@ -369,7 +563,7 @@ class Audit:
         ret = set()
         refs = self.__artifact.getReferences()
         while refs:
-            artifact = self.__references[refs.pop()]
+            artifact = self.__lookup(refs.pop())
             if artifact.getMetaData()["step"] == "dist":
                 ret.add(artifact.getBuildId())
             else:
@@ -391,6 +585,19 @@ class Audit:
     def addScm(self, name, workspace, dir):
         self.__artifact.addScm(name, workspace, dir)
 
+    def addScmAudit(self, scm):
+        """Add SCM audit record that was created by Audit.scanScm()."""
+        self.__artifact.addScmAudit(scm)
+
+    @staticmethod
+    def scanScm(name, workspace, dir):
+        """Scan SCM 'name' in 'dir' of 'workspace'.
+
+        This is independent of any audit and can be run concurrently. The
+        result is added to an audit by addScmAudit().
+        """
+        return Artifact.scanScm(name, workspace, dir)
+
     def addTool(self, name, tool):
         audit = Audit.fromFile(tool)
         self.__merge(audit)
@@ -409,3 +616,23 @@ class Audit:
         self.__merge(audit)
         self.__artifact.addArg(audit.getId())
 
+
+def exportAudit(file):
+    """Return the self-contained audit trail of 'file' as gzip'ed json.
+
+    Returns None if the audit trail is not in the linked format. Such files
+    are passed on unchanged.
+    """
+    try:
+        with gzip.open(file, 'rb') as gzf:
+            tree = json.load(io.TextIOWrapper(gzf, encoding='utf8'))
+    except (EOFError, OSError, ValueError):
+        return None
+    if not isinstance(tree, dict) or "store" not in tree: return None
+
+    with gzip.open(file, 'rb') as gzf:
+        audit = Audit.fromByteStream(gzf, file)
+    audit.setStore(None)
+    ret = io.BytesIO()
+    audit.save(ret)
+    return ret.getvalue()
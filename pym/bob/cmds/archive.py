@@ -3,11 +3,16 @@
 #
 # SPDX-License-Identifier: GPL-3.0-or-later
 
-from ..audit import Audit
-from ..errors import BobError
-from ..utils import binStat, asHexStr, infixBinaryOp
+from ..archive import ArtifactReader, ARCHIVE_GENERATION, COMPRESSION_FORMATS, \
+    SUPPORTED_ARCHIVE_VERSIONS
+from ..audit import Audit, AuditStore
+from ..errors import BobError, BuildError
+from ..utils import binStat, asHexStr, infixBinaryOp, HASH_ALGORITHMS
 import argparse
+import collections
+import concurrent.futures
 import gzip
+import itertools
 import json
 import os, os.path
 import pickle
@@ -16,15 +21,79 @@ import re
 import sqlite3
 import tarfile
 
+# Archive generations of all supported compressions and hash algorithms
+GENERATIONS = sorted(set(c[1] + i[2] for c in COMPRESSION_FORMATS.values()
+                                   for i in HASH_ALGORITHMS.values()))
+
 # need to enable this for nested expression parsing performance
 pyparsing.ParserElement.enablePackrat()
 
+# Sections of the audit trail that are accessible in retention expressions
+VAR_SECTIONS = ('meta', 'build', 'metaEnv')
+
+def artifactPath(bid, taint, gen):
+    name = asHexStr(bid)
+    return os.path.join(name[0:2], name[2:4],
+        name[4:] + gen + ("-"+asHexStr(taint) if taint else "") + ".tgz")
+
+def flattenVars(vrs):
+    return [ (section, name, value) for section in VAR_SECTIONS
+             for (name, value) in sorted(vrs.get(section, {}).items()) ]
+
+def readArtifact(fileName):
+    """Read the audit trail of an artifact.
+
+    Runs in a worker process of the scanner. Returns a tuple of the audit
+    variables as (section, name, value) tuples, the referenced build-ids and
+    an error message. The variables are None if the file is not a Bob
+    artifact. Errors are passed as
+    message because exceptions cannot be sent reliably to the main process.
+    """
+    try:
+        with ArtifactReader(fileName, None) as tar:
+            # validate
+            if tar.pax_headers.get('bob-archive-vsn') not in SUPPORTED_ARCHIVE_VERSIONS:
+                return (None, None, None)
+
+            # Find audit trail. Bob puts it in front of the content so that
+            # nothing else needs to be decompressed.
+            f = tar.next()
+            while f:
+                if f.name == "meta/audit.json.gz": break
+                f = tar.next()
+            else:
+                return (None, None, "{}: Missing audit trail!".format(fileName))
+
+            # read audit trail
+            auditJsonGz = tar.extractfile(f)
+            auditJson = gzip.GzipFile(fileobj=auditJsonGz)
+            audit = Audit.fromByteStream(auditJson, fileName)
+
+        artifact = audit.getArtifact()
+        vrs = flattenVars({
+            'meta' : artifact.getMetaData(),
+            'build' : artifact.getBuildInfo(),
+            'metaEnv' : artifact.getMetaEnv(),
+        })
+        return (vrs, audit.getReferencedBuildIds(), None)
+    except tarfile.TarError as e:
+        return (None, None, "Cannot read {}: {}".format(fileName, str(e)))
+    except BobError as e:
+        return (None, None, e.slogan)
+    except OSError as e:
+        return (None, None, str(e))
+
 class ArchiveScanner:
-    CUR_VERSION = 1
+    CUR_VERSION = 3
+
+    # Number of artifacts that are committed together. Everything that was
+    # committed is not read again if an interrupted scan is restarted.
+    BATCH_SIZE = 256
 
     def __init__(self):
         self.__dirSchema = re.compile(r'[0-9a-zA-Z]{2}')
-        self.__archiveSchema = re.compile(r'[0-9a-zA-Z]{36}-1(-[0-9a-zA-Z]{40})?.tgz')
+        self.__archiveSchema = re.compile(r'[0-9a-zA-Z]{36}(' +
+            "|".join(GENERATIONS) + r')(-[0-9a-zA-Z]{40})?.tgz')
         self.__db = None
         self.__cleanup = False
 
@@ -40,27 +109,84 @@ class ArchiveScanner:
             self.__db.execute("SELECT value FROM meta WHERE key='vsn'")
             vsn = self.__db.fetchone()
             if vsn is None:
-                self.__db.executescript("""
-                    CREATE TABLE files(
-                        bid BLOB NOT NULL,
-                        taint BLOB NOT NULL,
-                        stat BLOB,
-                        vars BLOB,
-                        PRIMARY KEY(bid, taint)
-                    );
+                self.__db.execute("""\
                     CREATE TABLE refs(
                         bid BLOB NOT NULL,
                         ref BLOB NOT NULL,
                         PRIMARY KEY (bid, ref)
-                    );
-                    """)
+                    )""")
+                self.__createFiles()
                 self.__db.execute("INSERT INTO meta VALUES ('vsn', ?)", (self.CUR_VERSION,))
             elif vsn[0] > self.CUR_VERSION:
                 raise BobError("Archive database was created by a newer version of Bob!")
+            elif vsn[0] < self.CUR_VERSION:
+                self.__migrate(vsn[0])
         except sqlite3.Error as e:
             raise BobError("Cannot open cache: " + str(e))
         return self
 
+    def __createFiles(self):
+        # The same build-id may be stored in different archive generations
+        # (compression and hash algorithm). Each of them is a distinct file.
+        # Old databases stored the audit variables as pickled dict in the
+        # 'vars' column of the 'files' table. Version 1 did not have a
+        # generation.
+        self.__db.execute("""\
+            CREATE TABLE files(
+                bid BLOB NOT NULL,
+                taint BLOB NOT NULL,
+                gen TEXT NOT NULL,
+                stat BLOB,
+                PRIMARY KEY(bid, taint, gen)
+            )""")
+        self.__db.execute("""\
+            CREATE TABLE vars(
+                bid BLOB NOT NULL,
+                taint BLOB NOT NULL,
+                gen TEXT NOT NULL,
+                section TEXT NOT NULL,
+                name TEXT NOT NULL,
+                value TEXT,
+                PRIMARY KEY (bid, taint, gen, section, name)
+            )""")
+        self.__db.execute("CREATE INDEX vars_name ON vars(section, name, value)")
+
+    @staticmethod
+    def __findGeneration(bid, taint, st):
+        """Guess the generation of an artifact of an old database.
+
+        Prefer the file that is unchanged since the last scan. Otherwise the
+        entry will be refreshed by the next scan anyway.
+        """
+        existing = []
+        for gen in GENERATIONS:
+            try:
+                if binStat(artifactPath(bid, taint, gen)) == st: return gen
+                existing.append(gen)
+            except OSError:
+                pass
+        return existing[0] if existing else ARCHIVE_GENERATION
+
+    def __migrate(self, vsn):
+        self.__db.execute("BEGIN")
+        try:
+            self.__db.execute("ALTER TABLE files RENAME TO old_files")
+            self.__createFiles()
+            self.__db.execute("SELECT bid, taint, {}, stat, vars FROM old_files"
+                .format("gen" if vsn >= 2 else "NULL"))
+            for (bid, taint, gen, st, vrs) in self.__db.fetchall():
+                if gen is None: gen = self.__findGeneration(bid, taint, st)
+                self.__db.execute("INSERT INTO files VALUES (?, ?, ?, ?)",
+                    (bid, taint, gen, st))
+                self.__db.executemany("INSERT INTO vars VALUES (?, ?, ?, ?, ?, ?)",
+                    [ (bid, taint, gen) + v for v in flattenVars(pickle.loads(vrs)) ])
+            self.__db.execute("DROP TABLE old_files")
+            self.__db.execute("UPDATE meta SET value=? WHERE key='vsn'", (self.CUR_VERSION,))
+        except:
+            self.__db.execute("ROLLBACK")
+            raise
+        self.__db.execute("COMMIT")
+
     def __exit__(self, *exc):
         try:
             if self.__cleanup:
@@ -76,9 +202,17 @@ class ArchiveScanner:
         self.__db = None
         return False
 
-    def scan(self, verbose):
+    def scan(self, verbose, jobs=1):
+        """Scan the archive for new or changed artifacts.
+
+        The audit trails are read by 'jobs' worker processes. The results are
+        committed in batches. If the scan is interrupted, the next scan will
+        continue with the artifacts that were not committed yet.
+        """
         try:
-            self.__db.execute("BEGIN")
+            self.__db.execute("SELECT bid, taint, gen, stat FROM files")
+            cached = { (bid, taint, gen) : st for (bid, taint, gen, st) in self.__db.fetchall() }
+            todo = []
             for l1 in os.listdir("."):
                 if not self.__dirSchema.fullmatch(l1): continue
                 for l2 in os.listdir(l1):
@@ -87,73 +221,94 @@ class ArchiveScanner:
                     for l3 in os.listdir(l2):
                         m = self.__archiveSchema.fullmatch(l3)
                         if not m: continue
-                        taint = m.group(1) and m.group(1)[1:]
-                        self.__scan(os.path.join(l2, l3), taint, verbose)
+                        fileName = os.path.join(l2, l3)
+                        bid = bytes.fromhex(fileName[0:2] + fileName[3:5] + fileName[6:42])
+                        gen = m.group(1)
+                        taint = bytes.fromhex(m.group(2)[1:]) if m.group(2) else b''
+                        st = binStat(fileName)
+                        if cached.get((bid, taint, gen)) != st:
+                            todo.append((fileName, bid, taint, gen, st))
         except OSError as e:
             raise BobError("Error scanning archive: " + str(e))
-        finally:
-            self.__db.execute("END")
 
-    def __scan(self, fileName, taint, verbose):
+        batch = []
+        results = self.__read(todo, jobs)
         try:
-            st = binStat(fileName)
-            bid = bytes.fromhex(fileName[0:2] + fileName[3:5] + fileName[6:42])
-            taint = bytes.fromhex(taint) if taint else b''
-
-            # Validate entry in caching db. Delete entry if stat has changed.
-            # The database will clean the 'refs' table automatically.
-            self.__db.execute("SELECT stat FROM files WHERE bid=? AND taint=?",
-                                (bid, taint))
-            cachedStat = self.__db.fetchone()
-            if cachedStat is not None:
-                if cachedStat[0] == st: return
-                self.__db.execute("DELETE FROM files WHERE bid=? AND taint=?",
-                    (bid, taint))
-
-            # read audit trail
-            if verbose: print("scan", fileName)
-            with tarfile.open(fileName, errorlevel=1) as tar:
-                # validate
-                if tar.pax_headers.get('bob-archive-vsn') != "1":
+            for ((fileName, bid, taint, gen, st), (vrs, refs, error)) in results:
+                if verbose: print("scan", fileName)
+                if error is not None: raise BobError(error)
+                if vrs is None:
                     print("Not a Bob archive:", fileName, "Ignored!")
-                    return
+                batch.append((bid, taint, gen, st, vrs, refs))
+                if len(batch) >= self.BATCH_SIZE:
+                    self.__commit(batch)
+                    batch = []
+        finally:
+            results.close()
+            self.__commit(batch)
+
+    def __read(self, todo, jobs):
+        if jobs <= 1 or len(todo) <= 1:
+            for t in todo: yield (t, readArtifact(t[0]))
+            return
+
+        # Keep the number of outstanding jobs bounded so that an interruption
+        # does not have to wait for the whole archive.
+        pending = collections.deque()
+        todo = iter(todo)
+        with concurrent.futures.ProcessPoolExecutor(jobs) as executor:
+            try:
+                while True:
+                    while len(pending) < jobs * 4:
+                        t = next(todo, None)
+                        if t is None: break
+                        pending.append((t, executor.submit(readArtifact, t[0])))
+                    if not pending: break
+                    (t, f) = pending.popleft()
+                    yield (t, f.result())
+            finally:
+                for (t, f) in pending: f.cancel()
+
+    def __commit(self, batch):
+        """Store the scanned artifacts of a batch in one transaction.
+
+        Outdated entries of changed artifacts are replaced.
+        """
+        if not batch: return
+        self.__db.execute("BEGIN")
+        try:
+            for (bid, taint, gen, st, vrs, refs) in batch:
+                self.__db.execute("DELETE FROM files WHERE bid=? AND taint=? AND gen=?",
+                    (bid, taint, gen))
+                self.__db.execute("DELETE FROM vars WHERE bid=? AND taint=? AND gen=?",
+                    (bid, taint, gen))
+                if vrs is None: continue
+                self.__db.execute("INSERT INTO files VALUES (?, ?, ?, ?)",
+                    (bid, taint, gen, st))
+                self.__db.executemany("INSERT INTO vars VALUES (?, ?, ?, ?, ?, ?)",
+                    [ (bid, taint, gen) + v for v in vrs ])
+                self.__db.executemany("INSERT OR IGNORE INTO refs VALUES (?, ?)",
+                    [ (bid, r) for r in refs ])
+        finally:
+            self.__db.execute("END")
 
-                # find audit trail
-                f = tar.next()
-                while f:
-                    if f.name == "meta/audit.json.gz": break
-                    f = tar.next()
-                else:
-                    raise Error("Missing audit trail!")
-
-                # read audit trail
-                auditJsonGz = tar.extractfile(f)
-                auditJson = gzip.GzipFile(fileobj=auditJsonGz)
-                audit = Audit.fromByteStream(auditJson, fileName)
-
-            # import data
-            artifact = audit.getArtifact()
-            vrs = pickle.dumps({
-                'meta' : artifact.getMetaData(),
-                'build' : artifact.getBuildInfo(),
-                'metaEnv' : artifact.getMetaEnv(),
-            })
-            self.__db.execute("INSERT INTO files VALUES (?, ?, ?, ?)",
-                (bid, taint, st, vrs))
-            self.__db.executemany("INSERT OR IGNORE INTO refs VALUES (?, ?)",
-                [ (bid, r) for r in audit.getReferencedBuildIds() ])
-        except tarfile.TarError as e:
-            raise BobError("Cannot read {}: {}".format(fileName, str(e)))
-        except OSError as e:
-            raise BobError(str(e))
+    def remove(self, artifacts):
+        """Remove all (bid, taint) tuples of 'artifacts' from the cache.
 
-    def remove(self, bid, taint):
+        All generations of the artifacts are removed.
+        """
         self.__cleanup = True
-        self.__db.execute("DELETE FROM files WHERE bid=? AND taint=?",
-            (bid, taint))
+        self.__db.execute("BEGIN")
+        try:
+            self.__db.executemany("DELETE FROM files WHERE bid=? AND taint=?",
+                artifacts)
+            self.__db.executemany("DELETE FROM vars WHERE bid=? AND taint=?",
+                artifacts)
+        finally:
+            self.__db.execute("END")
 
     def getBuildIds(self):
-        self.__db.execute("SELECT bid,taint FROM files")
+        self.__db.execute("SELECT DISTINCT bid, taint FROM files")
         return self.__db.fetchall()
 
     def getReferencedBuildIds(self, bid):
@@ -162,13 +317,30 @@ class ArchiveScanner:
         return [ r[0] for r in self.__db.fetchall() ]
 
     def getVars(self, bid, taint):
-        self.__db.execute("SELECT vars FROM files WHERE bid=? AND taint=?",
+        self.__db.execute("SELECT section, name, value FROM vars WHERE bid=? AND taint=?",
             (bid, taint))
-        v = self.__db.fetchone()
-        if v:
-            return pickle.loads(v[0])
-        else:
-            return {}
+        ret = {}
+        for (section, name, value) in self.__db.fetchall():
+            ret.setdefault(section, {})[name] = value
+        return ret
+
+    def getUnretained(self, retainExpr):
+        """Get all artifacts that are not retained by 'retainExpr'.
+
+        An artifact is retained if it is matched by the expression or if it
+        is referenced by a retained artifact. The expression is evaluated by
+        the database. The references are followed by a recursive query.
+        """
+        (where, params) = retainExpr.sqlBool()
+        self.__db.execute("""            WITH RECURSIVE retained(bid) AS (
+                SELECT bid FROM files WHERE {}
+                UNION
+                SELECT refs.ref FROM refs JOIN retained ON refs.bid = retained.bid
+            )
+            SELECT DISTINCT bid, taint FROM files WHERE bid NOT IN (
+                SELECT bid FROM retained
+            )""".format(where), params)
+        return self.__db.fetchall()
 
 
 class Base:
@@ -195,6 +367,13 @@ class NotPredicate(Base):
     def evalString(self, data):
         self.barf("operator in string context")
 
+    def sqlBool(self):
+        (arg, params) = self.arg.sqlBool()
+        return ("NOT ({})".format(arg), params)
+
+    def sqlString(self):
+        self.barf("operator in string context")
+
 class AndPredicate(Base):
     def __init__(self, s, loc, toks):
         super().__init__(s, loc)
@@ -210,6 +389,14 @@ class AndPredicate(Base):
     def evalString(self, data):
         self.barf("operator in string context")
 
+    def sqlBool(self):
+        (left, leftParams) = self.left.sqlBool()
+        (right, rightParams) = self.right.sqlBool()
+        return ("({}) AND ({})".format(left, right), leftParams + rightParams)
+
+    def sqlString(self):
+        self.barf("operator in string context")
+
 class OrPredicate(Base):
     def __init__(self, s, loc, toks):
         super().__init__(s, loc)
@@ -225,12 +412,26 @@ class OrPredicate(Base):
     def evalString(self, data):
         self.barf("operator in string context")
 
+    def sqlBool(self):
+        (left, leftParams) = self.left.sqlBool()
+        (right, rightParams) = self.right.sqlBool()
+        return ("({}) OR ({})".format(left, right), leftParams + rightParams)
+
+    def sqlString(self):
+        self.barf("operator in string context")
+
 class ComparePredicate(Base):
     def __init__(self, s, loc, toks):
         super().__init__(s, loc)
         self.left = toks[0]
         self.right = toks[2]
         op = toks[1]
+        # Missing fields are NULL. Like in Python they are equal to each
+        # other and unequal to everything else. Ordering them is false.
+        self.sqlOp = {
+            '==' : "({}) IS ({})",
+            '!=' : "({}) IS NOT ({})",
+        }.get(op, "COALESCE(({}) " + op + " ({}), 0)")
         if op == '<':
             self.op = lambda l, r: l < r
         elif op == '>':
@@ -255,6 +456,14 @@ class ComparePredicate(Base):
     def evalString(self, data):
         self.barf("operator in string context")
 
+    def sqlBool(self):
+        (left, leftParams) = self.left.sqlString()
+        (right, rightParams) = self.right.sqlString()
+        return (self.sqlOp.format(left, right), leftParams + rightParams)
+
+    def sqlString(self):
+        self.barf("operator in string context")
+
 class StringLiteral(Base):
     def __init__(self, s, loc, toks):
         super().__init__(s, loc)
@@ -266,6 +475,12 @@ class StringLiteral(Base):
     def evalString(self, data):
         return self.literal
 
+    def sqlBool(self):
+        self.barf("string in boolean context")
+
+    def sqlString(self):
+        return ("?", [self.literal])
+
 class VarReference(Base):
     def __init__(self, s, loc, toks):
         super().__init__(s, loc)
@@ -284,18 +499,60 @@ class VarReference(Base):
             self.barf("invalid field reference")
         return data
 
+    def sqlBool(self):
+        self.barf("field reference in boolean context")
+
+    def sqlString(self):
+        if len(self.path) == 2:
+            return ("""(SELECT value FROM vars WHERE vars.bid=files.bid AND
+                        vars.taint=files.taint AND vars.gen=files.gen AND
+                        section=? AND name=?)""",
+                    self.path[:])
+        elif len(self.path) == 1 and self.path[0] in VAR_SECTIONS:
+            self.barf("invalid field reference")
+        else:
+            return ("NULL", [])
+
+
+def addJobsArgument(parser):
+    parser.add_argument('-j', '--jobs', default=None, type=int, nargs='?', const=...,
+        help="Number of parallel jobs (default: number of processors)")
+
+def getJobs(parser, args):
+    if args.jobs is None or args.jobs is ...:
+        return os.cpu_count() or 1
+    elif args.jobs <= 0:
+        parser.error("--jobs argument must be greater than zero!")
+    return args.jobs
 
 def doArchiveScan(argv):
     parser = argparse.ArgumentParser(prog="bob archive scan")
+    addJobsArgument(parser)
     parser.add_argument("-v", "--verbose", action='store_true',
         help="Verbose operation")
     args = parser.parse_args(argv)
+    jobs = getJobs(parser, args)
 
     scanner = ArchiveScanner()
     with scanner:
-        scanner.scan(args.verbose)
+        scanner.scan(args.verbose, jobs)
 
 
+def findArtifacts(bid, taint):
+    """Find the files of all generations of an artifact."""
+    candidates = [ artifactPath(bid, taint, gen) for gen in GENERATIONS ]
+    return [ c for c in candidates if os.path.exists(c) ]
+
+def removeArtifacts(paths):
+    for path in paths:
+        try:
+            os.unlink(path)
+        except FileNotFoundError:
+            pass
+        except OSError as e:
+            return "Cannot remove {}: {}".format(path, str(e))
+    return None
+
 # meta.package == "root" && build.date > "2017-06-19"
 def doArchiveClean(argv):
     varReference = pyparsing.Word(pyparsing.alphanums+'.')
@@ -324,9 +581,11 @@ def doArchiveClean(argv):
         help="Don't delete, just print what would be deleted")
     parser.add_argument('-n', dest='noscan', action='store_true',
         help="Skip scanning for new artifacts")
+    addJobsArgument(parser)
     parser.add_argument("-v", "--verbose", action='store_true',
         help="Verbose operation")
     args = parser.parse_args(argv)
+    jobs = getJobs(parser, args)
 
     try:
         retainExpr = expr.parseString(args.expression, True)[0]
@@ -334,40 +593,53 @@ def doArchiveClean(argv):
         raise BobError("Invalid retention expression: " + str(e))
 
     scanner = ArchiveScanner()
-    retained = set()
     with scanner:
         if not args.noscan:
-            scanner.scan(args.verbose)
-        for bid,taint in scanner.getBuildIds():
-            if bid in retained: continue
-            if retainExpr.evalBool(scanner.getVars(bid, taint)):
-                retained.add(bid)
-                todo = set(scanner.getReferencedBuildIds(bid))
-                while todo:
-                    n = todo.pop()
-                    if n in retained: continue
-                    retained.add(n)
-                    todo.update(scanner.getReferencedBuildIds(n))
-
-        for bid,taint in scanner.getBuildIds():
-            if bid in retained: continue
-            victim = asHexStr(bid)
-            victim = os.path.join(victim[0:2], victim[2:4],
-                victim[4:] + "-1" + ("-"+asHexStr(taint) if taint else "") + ".tgz")
+            scanner.scan(args.verbose, jobs)
+        victims = scanner.getUnretained(retainExpr)
+
+        # Removing files is dominated by the file system latency. Do it in
+        # parallel, especially for archives on network drives.
+        with concurrent.futures.ThreadPoolExecutor(max_workers=jobs) as executor:
+            paths = list(executor.map(lambda v: findArtifacts(*v), victims))
             if args.dry_run:
-                print(victim)
-            else:
-                try:
-                    if args.verbose:
-                        print("rm", victim)
-                    os.unlink(victim)
-                except FileNotFoundError:
-                    pass
-                except OSError as e:
-                    raise BobError("Cannot remove {}: {}".format(victim, str(e)))
-                scanner.remove(bid, taint)
+                for path in itertools.chain.from_iterable(paths): print(path)
+                return
+
+            removed = []
+            errors = []
+            for (victim, files, error) in zip(victims, paths,
+                                              executor.map(removeArtifacts, paths)):
+                if args.verbose:
+                    for path in files: print("rm", path)
+                if error is None:
+                    removed.append(victim)
+                else:
+                    errors.append(error)
+        scanner.remove(removed)
+
+    if errors:
+        raise BobError(errors[0])
+
+def doArchiveAudit(argv):
+    parser = argparse.ArgumentParser(prog="bob archive audit",
+        description="Convert audit trail between self-contained and linked format.")
+    parser.add_argument('-s', '--store', metavar="STORE",
+        help="Put references into audit store (default: self-contained output)")
+    parser.add_argument('input', help="Audit trail to convert")
+    parser.add_argument('output', help="Converted audit trail")
+    args = parser.parse_args(argv)
+
+    try:
+        with gzip.open(args.input, 'rb') as f:
+            audit = Audit.fromByteStream(f, args.input)
+    except OSError as e:
+        raise BuildError("Cannot read audit: " + str(e))
+    audit.setStore(AuditStore(args.store) if args.store else None)
+    audit.save(args.output)
 
 availableArchiveCmds = {
+    "audit" : (doArchiveAudit, "Convert audit trail format"),
     "scan" : (doArchiveScan, "Scan archive for new artifacts"),
     "clean" : (doArchiveClean, "Clean archive from unneeded artifacts"),
 }
@@ -44,6 +44,8 @@ def commonBuildDevelop(parser, argv, bobRoot, develop):
         help="Destination of build result (will be overwritten!)")
     parser.add_argument('-j', '--jobs', default=None, type=int, nargs='?', const=...,
         help="Specifies  the  number of jobs to run simultaneously.")
+    parser.add_argument('--hash-jobs', default=None, type=int, nargs='?', const=...,
+        metavar='JOBS', help="Number of workspaces that are hashed simultaneously.")
     parser.add_argument('-k', '--keep-going', default=None, action='store_true',
         help="Continue  as much as possible after an error.")
     parser.add_argument('-f', '--force', default=None, action='store_true',
@@ -103,6 +105,20 @@ def commonBuildDevelop(parser, argv, bobRoot, develop):
         help="Disable sandboxing")
     parser.add_argument('--clean-checkout', action='store_true', default=None, dest='clean_checkout',
         help="Do a clean checkout if SCM state is dirty.")
+    parser.add_argument('--refresh-fingerprints', action='store_true', default=False,
+        help="Re-run fingerprint scripts instead of using cached results")
+    parser.add_argument('--prefetch-jobs', metavar="JOBS", default=None, type=int,
+        help="Number of artifacts that are downloaded ahead of the build (0 = disable)")
+    parser.add_argument('--prefetch-rate', metavar="KIB", default=None, type=int,
+        help="Limit prefetch bandwidth to KIB kilobytes per second (0 = unlimited)")
+    parser.add_argument('--archive-cache', metavar="DIR", default=None,
+        help="Cache downloaded artifacts in DIR")
+    parser.add_argument('--archive-cache-size', metavar="MIB", default=None, type=int,
+        help="Maximum size of the artifact cache in MiB")
+    parser.add_argument('--upload-jobs', metavar="JOBS", default=None, type=int,
+        help="Number of artifacts that are uploaded in parallel in the background")
+    parser.add_argument('--no-wait-upload', default=None, action='store_true',
+        help="Do not wait for pending uploads at the end of the build")
     args = parser.parse_args(argv)
 
     defines = processDefines(args.defines)
@@ -163,6 +179,12 @@ def commonBuildDevelop(parser, argv, bobRoot, develop):
                 'link_deps' : True,
                 'jobs' : 1,
                 'keep_going' : False,
+                'prefetch_jobs' : 4,
+                'prefetch_rate' : 0,
+                'archive_cache' : None,
+                'archive_cache_size' : 10240,
+                'upload_jobs' : 2,
+                'no_wait_upload' : False,
             }
 
         for a in vars(args):
@@ -173,6 +195,20 @@ def commonBuildDevelop(parser, argv, bobRoot, develop):
             args.jobs = os.cpu_count()
         elif args.jobs <= 0:
             parser.error("--jobs argument must be greater than zero!")
+        if args.hash_jobs is None:
+            args.hash_jobs = args.jobs
+        elif args.hash_jobs is ...:
+            args.hash_jobs = os.cpu_count()
+        elif args.hash_jobs <= 0:
+            parser.error("--hash-jobs argument must be greater than zero!")
+        if args.prefetch_jobs < 0:
+            parser.error("--prefetch-jobs argument must not be negative!")
+        if args.prefetch_rate < 0:
+            parser.error("--prefetch-rate argument must not be negative!")
+        if args.archive_cache_size <= 0:
+            parser.error("--archive-cache-size argument must be greater than zero!")
+        if args.upload_jobs <= 0:
+            parser.error("--upload-jobs argument must be greater than zero!")
 
         envWhiteList = recipes.envWhiteList()
         envWhiteList |= set(args.white_list)
@@ -196,13 +232,19 @@ def commonBuildDevelop(parser, argv, bobRoot, develop):
                                args.no_logfiles)
 
         builder.setArchiveHandler(getArchiver(recipes))
+        if args.archive_cache:
+            builder.setArchiveCache(args.archive_cache, args.archive_cache_size * 1024 * 1024)
         builder.setUploadMode(args.upload)
+        builder.setUpload(args.upload_jobs, not args.no_wait_upload)
         builder.setDownloadMode(args.download)
         builder.setCleanCheckout(args.clean_checkout)
         builder.setAlwaysCheckout(args.always_checkout + cfg.get('always_checkout', []))
         builder.setLinkDependencies(args.link_deps)
         builder.setJobs(args.jobs)
+        builder.setHashJobs(args.hash_jobs)
         builder.setKeepGoing(args.keep_going)
+        builder.setRefreshFingerprints(args.refresh_fingerprints)
+        builder.setPrefetch(args.prefetch_jobs, args.prefetch_rate * 1024)
         if args.resume: builder.loadBuildState()
 
         backlog = []
@@ -262,7 +304,27 @@ def commonBuildDevelop(parser, argv, bobRoot, develop):
                     + " (" + str(activeOverrides) + (" overrides" if (activeOverrides != 1) else " override") + " active), "
                 + str(stats.packagesBuilt)
                     + " package" + ("s" if (stats.packagesBuilt != 1) else "") + " built, "
-                + str(stats.packagesDownloaded) + " downloaded.")
+                + str(stats.packagesDownloaded) + " downloaded"
+                    + ((" (" + str(stats.artifactCacheHits) + " cache hits, "
+                             + str(stats.artifactCacheMisses) + " misses), ")
+                       if (stats.artifactCacheHits + stats.artifactCacheMisses) else ", ")
+                + str(datetime.timedelta(seconds=round(stats.getHashTime(), 3)))
+                    + " spent hashing, "
+                + str(datetime.timedelta(seconds=round(stats.getAuditTime(), 3)))
+                    + " generating audit trails.")
+        uploads = (stats.artifactsUploaded + stats.artifactsUploadSkipped +
+                   stats.artifactsUploadFailed + stats.artifactsUploadDropped)
+        if uploads:
+            print("Uploads: " + str(stats.artifactsUploaded) + " uploaded, "
+                    + str(stats.artifactsUploadSkipped) + " skipped, "
+                    + str(stats.artifactsUploadFailed) + " failed"
+                    + ((", " + str(stats.artifactsUploadDropped) + " dropped")
+                       if stats.artifactsUploadDropped else "")
+                    + ".")
+        if verbosity >= 2:
+            for path, duration in sorted(stats.getHashTimes().items(),
+                                         key=lambda i: i[1], reverse=True):
+                print("   {:>10.3f}s  {}".format(duration, path))
 
         # copy build result if requested
         ok = True
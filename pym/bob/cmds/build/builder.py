@@ -4,8 +4,8 @@
 # SPDX-License-Identifier: GPL-3.0-or-later
 
 from ... import BOB_VERSION
-from ...archive import DummyArchive
-from ...audit import Audit
+from ...archive import ArtifactCache, ArtifactPrefetcher, DummyArchive, UploadQueue
+from ...audit import Audit, AuditStore
 from ...errors import BobError, BuildError, MultiBobError
 from ...input import RecipeSet
 from ...state import BobState
@@ -13,7 +13,7 @@ from ...tty import log, stepMessage, stepAction, stepExec, \
     SKIPPED, EXECUTED, INFO, WARNING, DEFAULT, \
     ALWAYS, IMPORTANT, NORMAL, INFO, DEBUG, TRACE
 from ...utils import asHexStr, hashDirectory, removePath, emptyDirectory, \
-    isWindows
+    isWindows, getHashAlgorithm, HASH_ALGORITHMS
 from pipes import quote
 from textwrap import dedent
 import argparse
@@ -22,13 +22,17 @@ import concurrent.futures
 import datetime
 import hashlib
 import io
+import json
 import locale
 import os
+import platform
 import re
+import shutil
 import signal
 import stat
 import subprocess
 import tempfile
+import time
 
 # Output verbosity:
 #    <= -2: package name
@@ -44,9 +48,54 @@ async def gatherTasks(tasks):
     await asyncio.wait(tasks)
     return [ t.result() for t in tasks ]
 
-def hashWorkspace(step):
-    return hashDirectory(step.getWorkspacePath(),
-        os.path.join(step.getWorkspacePath(), "..", "cache.bin"))
+def workspaceHashIndex(step):
+    return os.path.join(step.getWorkspacePath(), "..", "cache.bin")
+
+def hashWorkspace(step, algorithm='sha1'):
+    return hashDirectory(step.getWorkspacePath(), workspaceHashIndex(step),
+        algorithm=algorithm)
+
+# Maximum age of cached fingerprint script results (seconds)
+FINGERPRINT_CACHE_TTL = 7 * 24 * 60 * 60
+
+# Maximum age of remembered missing artifacts (seconds)
+ARTIFACT_MISS_TTL = 30 * 60
+
+def fingerprintHostId(script, env):
+    """Calculate the identity of the host environment of a fingerprint script.
+
+    Covers the used environment variables, all programs that are possibly
+    called by the script and the system libraries. A program is anything in
+    the script that resolves to an executable via PATH. It is identified by
+    the stat data of its real path. The dynamic linker cache is included to
+    catch library updates.
+    """
+    path = env.get("PATH", os.defpath)
+    h = hashlib.sha1()
+    h.update(repr(tuple(platform.uname())).encode('utf8'))
+    h.update(path.encode('utf8', 'replace'))
+
+    names = set(re.findall(r'\$\{?([A-Za-z_][A-Za-z0-9_]*)', script))
+    words = script
+    for name in sorted(names):
+        val = env.get(name)
+        if val is None: continue
+        h.update("{}={}\0".format(name, val).encode('utf8', 'replace'))
+        words += " " + val
+
+    files = [ "/etc/ld.so.cache" ]
+    for word in sorted(set(re.findall(r'[A-Za-z0-9_.+/-]+', words))):
+        if "/" in word and not word.startswith("/"): continue
+        prog = shutil.which(word, path=path)
+        if prog is not None: files.append(os.path.realpath(prog))
+    for f in files:
+        try:
+            st = os.stat(f)
+            h.update("{}\0{}\0{}\0{}\0{}\0".format(f, st.st_dev, st.st_ino,
+                st.st_size, st.st_mtime_ns).encode('utf8', 'replace'))
+        except OSError:
+            h.update("{}\0\0".format(f).encode('utf8', 'replace'))
+    return h.digest()
 
 def compareDirectoryState(left, right):
     """Compare two directory states while ignoring the SCM specs.
@@ -117,9 +166,17 @@ class CancelBuildException(Exception):
 class LocalBuilderStatistic:
     def __init__(self):
         self.__activeOverrides = set()
+        self.__hashTimes = {}
+        self.__auditTime = 0.0
         self.checkouts = 0
         self.packagesBuilt = 0
         self.packagesDownloaded = 0
+        self.artifactCacheHits = 0
+        self.artifactCacheMisses = 0
+        self.artifactsUploaded = 0
+        self.artifactsUploadSkipped = 0
+        self.artifactsUploadFailed = 0
+        self.artifactsUploadDropped = 0
 
     def addOverrides(self, overrides):
         self.__activeOverrides.update(overrides)
@@ -127,6 +184,23 @@ class LocalBuilderStatistic:
     def getActiveOverrides(self):
         return self.__activeOverrides
 
+    def addHashTime(self, path, duration):
+        self.__hashTimes[path] = self.__hashTimes.get(path, 0.0) + duration
+
+    def getHashTimes(self):
+        """Return dict of workspace path to seconds spent hashing it."""
+        return self.__hashTimes
+
+    def getHashTime(self):
+        return sum(self.__hashTimes.values())
+
+    def addAuditTime(self, duration):
+        self.__auditTime += duration
+
+    def getAuditTime(self):
+        """Return seconds spent generating audit trails."""
+        return self.__auditTime
+
 class LocalBuilder:
 
     RUN_TEMPLATE = """#!/bin/bash
@@ -341,13 +415,32 @@ esac
         self.__linkDeps = True
         self.__buildIdLocks = {}
         self.__jobs = 1
+        self.__hashJobs = 1
         self.__bufferedStdIO = False
         self.__keepGoing = False
         self.__fingerprints = { None : b'', "" : b'' }
+        self.__refreshFingerprints = False
+        self.__prefetchJobs = 0
+        self.__prefetchRate = 0
+        self.__prefetcher = None
+        self.__archiveId = None
+        self.__uploadJobs = 2
+        self.__uploadWait = True
+        self.__uploads = None
+        self.__auditStore = AuditStore(".bob-audit")
 
     def setArchiveHandler(self, archive):
         self.__archive = archive
 
+    def setArchiveCache(self, path, maxSize):
+        """Put a node-wide artifact cache in front of the archive.
+
+        Must be called after setArchiveHandler(). The cache in 'path' is
+        limited to 'maxSize' bytes.
+        """
+        self.__archive = ArtifactCache(self.__archive, path, maxSize,
+            self.__recipes.getHashAlgorithm(), self.__statistic)
+
     def setDownloadMode(self, mode):
         self.__downloadDepth = 0xffff
         if mode in ('yes', 'forced'):
@@ -387,12 +480,39 @@ esac
     def setJobs(self, jobs):
         self.__jobs = max(jobs, 1)
 
+    def setHashJobs(self, jobs):
+        self.__hashJobs = max(jobs, 1)
+
     def enableBufferedIO(self):
         self.__bufferedStdIO = True
 
+    def setRefreshFingerprints(self, refresh):
+        self.__refreshFingerprints = refresh
+
     def setKeepGoing(self, keepGoing):
         self.__keepGoing = keepGoing
 
+    def setPrefetch(self, jobs, rateLimit=0):
+        """Configure artifact prefetching.
+
+        Up to 'jobs' artifacts are downloaded in parallel ahead of the build.
+        The overall bandwidth is limited to 'rateLimit' bytes/s unless it is
+        zero. Prefetching is disabled if 'jobs' is zero.
+        """
+        self.__prefetchJobs = max(jobs, 0)
+        self.__prefetchRate = max(rateLimit, 0)
+
+    def setUpload(self, jobs, wait=True):
+        """Configure the background upload of artifacts.
+
+        Up to 'jobs' artifacts are uploaded in parallel while the build goes
+        on. The build waits for all queued uploads at the end unless 'wait'
+        is False. In this case uploads that have not finished yet are
+        dropped.
+        """
+        self.__uploadJobs = max(jobs, 1)
+        self.__uploadWait = wait
+
     def saveBuildState(self):
         state = {}
         # Save 'wasRun' as plain dict. Skipped steps are dropped because they
@@ -450,12 +570,22 @@ esac
         return (workDir, created)
 
     async def _generateAudit(self, step, depth, resultHash, executed=True):
+        """Generate the audit trail of a step without blocking the event loop.
+
+        The SCMs of a checkout step are scanned concurrently. Loading the
+        audit trails of the dependencies and saving the result is done in
+        the audit executor too.
+        """
         if step.isCheckoutStep():
             buildId = resultHash
         else:
             buildId = await self._getBuildId(step, depth)
         fingerprint = await self._getFingerprint(step.getPackage())
-        audit = Audit.create(step.getVariantId(), buildId, resultHash, fingerprint)
+
+        loop = asyncio.get_event_loop()
+        start = time.monotonic()
+        audit = Audit.create(step.getVariantId(), buildId, resultHash, fingerprint,
+                             self.__auditStore)
         audit.addDefine("bob", BOB_VERSION)
         audit.addDefine("recipe", step.getPackage().getRecipe().getName())
         audit.addDefine("package", "/".join(step.getPackage().getStack()))
@@ -464,37 +594,57 @@ esac
             audit.addMetaEnv(var, val)
         audit.setRecipesAudit(step.getPackage().getRecipe().getRecipeSet().getScmAudit())
 
+        # Always check for SCMs but don't fail if we did not execute the step
+        if step.isCheckoutStep():
+            auditSpecs = [ scm.getAuditSpec() for scm in step.getScmList() ]
+            auditSpecs = [ spec for spec in auditSpecs if spec is not None ]
+            scms = await asyncio.gather(*(
+                    loop.run_in_executor(self.__auditExecutor, Audit.scanScm,
+                                         typ, step.getWorkspacePath(), dir)
+                    for (typ, dir) in auditSpecs),
+                return_exceptions=True)
+            for ((typ, dir), scm) in zip(auditSpecs, scms):
+                if isinstance(scm, BobError):
+                    if executed: raise scm
+                    stepMessage(step, "AUDIT", "WARNING: cannot audit SCM: {} ({})"
+                                        .format(scm.slogan, dir),
+                                   WARNING)
+                elif isinstance(scm, BaseException):
+                    raise scm
+                else:
+                    audit.addScmAudit(scm)
+
         # The following things make only sense if we just executed the step
+        deps = None
         if executed:
-            audit.setEnv(os.path.join(step.getWorkspacePath(), "..", "env"))
-            for (name, tool) in sorted(step.getTools().items()):
-                audit.addTool(name,
-                    os.path.join(tool.getStep().getWorkspacePath(), "..", "audit.json.gz"))
             sandbox = step.getSandbox()
             if sandbox is not None:
-                audit.setSandbox(os.path.join(sandbox.getStep().getWorkspacePath(), "..", "audit.json.gz"))
-            for dep in step.getArguments():
-                if dep.isValid():
-                    audit.addArg(os.path.join(dep.getWorkspacePath(), "..", "audit.json.gz"))
-
-        # Always check for SCMs but don't fail if we did not execute the step
-        if step.isCheckoutStep():
-            for scm in step.getScmList():
-                auditSpec = scm.getAuditSpec()
-                if auditSpec is not None:
-                    (typ, dir) = auditSpec
-                    try:
-                        audit.addScm(typ, step.getWorkspacePath(), dir)
-                    except BobError as e:
-                        if executed: raise
-                        stepMessage(step, "AUDIT", "WARNING: cannot audit SCM: {} ({})"
-                                            .format(e.slogan, dir),
-                                       WARNING)
+                sandbox = os.path.join(sandbox.getStep().getWorkspacePath(), "..", "audit.json.gz")
+            deps = (
+                os.path.join(step.getWorkspacePath(), "..", "env"),
+                [ (name, os.path.join(tool.getStep().getWorkspacePath(), "..", "audit.json.gz"))
+                  for (name, tool) in sorted(step.getTools().items()) ],
+                sandbox,
+                [ os.path.join(dep.getWorkspacePath(), "..", "audit.json.gz")
+                  for dep in step.getArguments() if dep.isValid() ]
+            )
 
         auditPath = os.path.join(step.getWorkspacePath(), "..", "audit.json.gz")
-        audit.save(auditPath)
+        await loop.run_in_executor(self.__auditExecutor, LocalBuilder._saveAudit,
+                                   audit, deps, auditPath)
+        self.__statistic.addAuditTime(time.monotonic() - start)
         return auditPath
 
+    @staticmethod
+    def _saveAudit(audit, deps, auditPath):
+        if deps is not None:
+            (env, tools, sandbox, args) = deps
+            audit.setEnv(env)
+            for (name, tool) in tools: audit.addTool(name, tool)
+            if sandbox is not None: audit.setSandbox(sandbox)
+            for arg in args: audit.addArg(arg)
+        audit.save(auditPath)
+
     def __linkDependencies(self, step):
         """Create symlinks to the dependency workspaces"""
 
@@ -541,6 +691,10 @@ esac
                 i += 1
 
     async def _runShell(self, step, scriptName, cleanWorkspace, logger):
+        # The workspace is about to change. Make sure the invalidated state is
+        # on disk before.
+        BobState().sync()
+
         workspacePath = step.getWorkspacePath()
         if cleanWorkspace: emptyDirectory(workspacePath)
         if not os.path.isdir(workspacePath): os.makedirs(workspacePath)
@@ -796,6 +950,7 @@ esac
                 log("Cancel all running jobs...", WARNING)
             self.__running = False
             self.__restart = False
+            if self.__uploads is not None: self.__uploads.cancel()
             for i in asyncio.Task.all_tasks(): i.cancel()
 
         async def dispatcher():
@@ -808,7 +963,23 @@ esac
                 for step in steps:
                     await self._cookTask(step, checkoutOnly, depth)
 
+        def syncState():
+            BobState().sync()
+            nonlocal syncTimer
+            syncTimer = loop.call_later(BobState().COMMIT_INTERVAL, syncState)
+
         loop = asyncio.get_event_loop()
+        # State changes are group-committed while building. They are synced
+        # periodically, before steps are executed and at the end.
+        BobState().setAsynchronous()
+        syncTimer = loop.call_later(BobState().COMMIT_INTERVAL, syncState)
+        try:
+            self.__cookRounds(loop, dispatcher, cancelJobs, checkoutOnly)
+        finally:
+            syncTimer.cancel()
+            BobState().setSynchronous()
+
+    def __cookRounds(self, loop, dispatcher, cancelJobs, checkoutOnly):
         self.__restart = True
         while self.__restart:
             self.__running = True
@@ -818,6 +989,17 @@ esac
             self.__allTasks = set()
             self.__buildErrors = []
             self.__runners = asyncio.BoundedSemaphore(self.__jobs)
+            self.__hashExecutor = concurrent.futures.ThreadPoolExecutor(
+                max_workers=self.__hashJobs)
+            self.__auditExecutor = concurrent.futures.ThreadPoolExecutor()
+            if self.__prefetchJobs and not checkoutOnly and \
+               self.__archive.canDownloadLocal():
+                self.__prefetcher = ArtifactPrefetcher(self.__archive,
+                    self.__prefetchJobs, self.__prefetchRate,
+                    self.__recipes.getHashAlgorithm())
+                self.__prefetcher.start()
+            self.__uploads = UploadQueue(self.__archive, self.__uploadJobs,
+                statistic=self.__statistic)
 
             j = self.__createTask(dispatcher)
             try:
@@ -825,12 +1007,24 @@ esac
             except NotImplementedError:
                 pass # not implemented on windows
             try:
-                loop.run_until_complete(j)
-            except CancelBuildException:
-                pass
-            except concurrent.futures.CancelledError:
-                pass
+                try:
+                    loop.run_until_complete(j)
+                except CancelBuildException:
+                    pass
+                except concurrent.futures.CancelledError:
+                    pass
+                # Finish the uploads of all artifacts that were built in this
+                # round. A cancellation by the user cancels them too.
+                if not self.__uploadWait:
+                    self.__statistic.artifactsUploadDropped += self.__uploads.cancel()
+                try:
+                    self.__buildErrors.extend(
+                        loop.run_until_complete(self.__uploads.drain()))
+                except concurrent.futures.CancelledError:
+                    # Interrupted by the user. Reap the cancelled uploads.
+                    loop.run_until_complete(self.__uploads.drain())
             finally:
+                self.__uploads = None
                 try:
                     loop.remove_signal_handler(signal.SIGINT)
                 except NotImplementedError:
@@ -844,6 +1038,11 @@ esac
                 loop.run_until_complete(asyncio.gather(*self.__allTasks,
                                                        return_exceptions=True))
             self.__allTasks.clear()
+            self.__hashExecutor.shutdown()
+            self.__auditExecutor.shutdown()
+            if self.__prefetcher is not None:
+                loop.run_until_complete(self.__prefetcher.stop())
+                self.__prefetcher = None
 
             if len(self.__buildErrors) > 1:
                 raise MultiBobError(self.__buildErrors)
@@ -854,6 +1053,22 @@ esac
             raise BuildError("Canceled by user!",
                              help = "Run again with '--resume' to skip already built packages.")
 
+    async def _hashWorkspace(self, step):
+        """Hash the workspace of a step without blocking the event loop.
+
+        The hashing is done in a dedicated thread pool whose size is
+        independent of the number of jobs. Reading and hashing the files
+        releases the GIL so that multiple workspaces can be hashed in
+        parallel.
+        """
+        path = step.getWorkspacePath()
+        loop = asyncio.get_event_loop()
+        start = time.monotonic()
+        ret = await loop.run_in_executor(self.__hashExecutor, hashWorkspace,
+            step, self.__recipes.getHashAlgorithm())
+        self.__statistic.addHashTime(path, time.monotonic() - start)
+        return ret
+
     async def _cookTask(self, step, checkoutOnly, depth):
         async with self.__runners:
             if not self.__running: raise CancelBuildException
@@ -1019,7 +1234,7 @@ esac
         # We always have to rehash the directory as the user might have
         # changed the source code manually.
         oldCheckoutHash = BobState().getResultHash(prettySrcPath)
-        checkoutHash = hashWorkspace(checkoutStep)
+        checkoutHash = await self._hashWorkspace(checkoutStep)
         BobState().setResultHash(prettySrcPath, checkoutHash)
 
         # Generate audit trail. Has to be done _after_ setResultHash()
@@ -1088,7 +1303,7 @@ esac
             # We always rehash the directory in development mode as the
             # user might have compiled the package manually.
             if not self.__cleanBuild:
-                BobState().setResultHash(prettyBuildPath, hashWorkspace(buildStep))
+                BobState().setResultHash(prettyBuildPath, await self._hashWorkspace(buildStep))
         else:
             with stepExec(buildStep, "BUILD", prettyBuildPath) as a:
                 # Squash state because running the step will change the
@@ -1098,7 +1313,7 @@ esac
                 BobState().setResultHash(prettyBuildPath, datetime.datetime.utcnow())
                 # build it
                 await self._runShell(buildStep, "build", self.__cleanBuild, a)
-                buildHash = hashWorkspace(buildStep)
+                buildHash = await self._hashWorkspace(buildStep)
             await self._generateAudit(buildStep, depth, buildHash)
             BobState().setResultHash(prettyBuildPath, buildHash)
             BobState().setVariantId(prettyBuildPath, buildDigest[0])
@@ -1121,8 +1336,7 @@ esac
         # Calculate build-id and fingerprint of expected artifact. Prohibit
         # up-/download if we are on the old allRelocatable policy and the
         # package is not explicitly relocatable and built outside the sandbox.
-        mayUpOrDownload = self.__recipes.getPolicy('allRelocatable') or \
-            packageStep.isRelocatable() or (packageStep.getSandbox() is not None)
+        mayUpOrDownload = self.__mayUpOrDownload(packageStep)
         packageBuildId = await self._getBuildId(packageStep, depth)
         packageFingerprint = await self._getFingerprint(packageStep.getPackage())
 
@@ -1171,13 +1385,30 @@ esac
             # we're done.
             if BobState().getResultHash(prettyPackagePath) is None:
                 audit = os.path.join(prettyPackagePath, "..", "audit.json.gz")
-                wasDownloaded = await self.__archive.downloadPackage(packageStep,
-                    packageBuildId, packageFingerprint, audit, prettyPackagePath)
+                prefetched = None
+                if self.__prefetcher is not None:
+                    prefetched = await self.__prefetcher.take(packageBuildId,
+                                                              packageFingerprint)
+                # The content is hashed while unpacking. Hashing the workspace
+                # afterwards will just take the digests from the index.
+                hashIndex = workspaceHashIndex(packageStep)
+                if prefetched is None and depth < self.__downloadDepthForce and \
+                   self.__isKnownMissing(packageBuildId, packageFingerprint):
+                    with stepAction(packageStep, "DOWNLOAD", prettyPackagePath,
+                                    details="(cached)") as a:
+                        a.fail("not found", WARNING)
+                elif prefetched is None:
+                    wasDownloaded = await self.__archive.downloadPackage(packageStep,
+                        packageBuildId, packageFingerprint, audit, prettyPackagePath,
+                        hashIndex)
+                else:
+                    wasDownloaded = await self.__prefetcher.unpack(packageStep,
+                        prefetched, audit, prettyPackagePath, hashIndex)
                 if wasDownloaded:
                     self.__statistic.packagesDownloaded += 1
                     BobState().setInputHashes(prettyPackagePath,
                         packageInputDownloaded(packageBuildId, packageFingerprint))
-                    packageHash = hashWorkspace(packageStep)
+                    packageHash = await self._hashWorkspace(packageStep)
                     workspaceChanged = True
                     wasDownloaded = True
                 elif depth >= self.__downloadDepthForce:
@@ -1192,6 +1423,11 @@ esac
         # previously downloaded the oldInputHashes will be None to trigger
         # an actual build.
         if not wasDownloaded:
+            # Fetch the artifacts of our dependencies in the background while
+            # we descend into them.
+            if self.__prefetcher is not None:
+                await self.__prefetchDependencies(packageStep, depth)
+
             # depth first
             await self._cook(packageStep.getAllDepSteps(), packageStep.getPackage(),
                        checkoutOnly, depth+1)
@@ -1215,14 +1451,16 @@ esac
                     BobState().delInputHashes(prettyPackagePath)
                     BobState().setResultHash(prettyPackagePath, datetime.datetime.utcnow())
                     await self._runShell(packageStep, "package", True, a)
-                    packageHash = hashWorkspace(packageStep)
+                    packageHash = await self._hashWorkspace(packageStep)
                     packageDigest = self.__getIncrementalVariantId(packageStep)
                     workspaceChanged = True
                     self.__statistic.packagesBuilt += 1
                 audit = await self._generateAudit(packageStep, depth, packageHash)
                 if mayUpOrDownload and self.__archive.canUploadLocal():
-                    await self.__archive.uploadPackage(packageStep, packageBuildId,
+                    # Dependent steps do not need to wait for the upload
+                    self.__uploads.put(packageStep, packageBuildId,
                         packageFingerprint, audit, prettyPackagePath)
+                    BobState().delArtifactMissing(packageBuildId + packageFingerprint)
 
         # Rehash directory if content was changed
         if workspaceChanged:
@@ -1235,6 +1473,107 @@ esac
                 BobState().setInputHashes(prettyPackagePath,
                     packageInputBuilt(packageBuildId, packageFingerprint, packageInputHashes))
 
+    def __getArchiveId(self):
+        if self.__archiveId is None:
+            self.__archiveId = hashlib.sha1(json.dumps(self.__recipes.archiveSpec(),
+                sort_keys=True, default=str).encode("utf8")).digest()
+        return self.__archiveId
+
+    def __isKnownMissing(self, buildId, fingerprint):
+        """Check if the artifact was recently found to be missing.
+
+        Misses are remembered across runs so that a restarted build does not
+        have to ask the archive again for every artifact.
+        """
+        return BobState().isArtifactMissing(buildId + fingerprint,
+            self.__getArchiveId(), ARTIFACT_MISS_TTL)
+
+    def __setKnownMissing(self, buildId, fingerprint):
+        BobState().setArtifactMissing(buildId + fingerprint, self.__getArchiveId())
+
+    def __mayUpOrDownload(self, packageStep):
+        return self.__recipes.getPolicy('allRelocatable') or \
+            packageStep.isRelocatable() or (packageStep.getSandbox() is not None)
+
+    def __needsDownload(self, packageStep, buildId, fingerprint):
+        """Check if _cookPackageStep() will try to download the package."""
+        path = packageStep.getWorkspacePath()
+        if BobState().getDirectoryState(path, False) != packageStep.getVariantId():
+            return True
+        if BobState().getResultHash(path) is None:
+            return True
+        _, _, oldInputBuildId, oldInputFingerprint = \
+            dissectPackageInputState(BobState().getInputHashes(path))
+        return self.__force or (oldInputFingerprint != fingerprint) or \
+            ((oldInputBuildId is not None) and (oldInputBuildId != buildId))
+
+    def __prefetchCandidates(self, step, depth, seen):
+        """Yield all package steps that are cooked on behalf of a step."""
+        for dep in step.getAllDepSteps():
+            path = dep.getWorkspacePath()
+            if not dep.isValid() or path in seen: continue
+            seen.add(path)
+            if dep.isPackageStep():
+                yield (dep, depth+1)
+            elif dep.isBuildStep():
+                yield from self.__prefetchCandidates(dep, depth+1, seen)
+
+    async def __prefetchDependencies(self, packageStep, depth):
+        self.__prefetcher.spawn(self.__prefetchPackages(
+            list(self.__prefetchCandidates(packageStep, depth, set()))))
+        # Let the prefetches start before the dependencies are cooked
+        await asyncio.sleep(0)
+
+    async def __prefetchArtifact(self, packageStep, depth):
+        """Get the artifact that _cookPackageStep() will try to download.
+
+        Returns a (buildId, fingerprint) tuple. Returns None if the package
+        cannot be downloaded and False if nothing needs to be done for it.
+        The build-ids were already calculated when the build-id of the parent
+        package was computed.
+        """
+        if self._wasAlreadyRun(packageStep, False): return False
+        if depth < self.__downloadDepth or not self.__mayUpOrDownload(packageStep):
+            return None
+        buildId = self.__buildDistBuildIds.get(packageStep.getWorkspacePath())
+        if buildId is None: return False
+        try:
+            fingerprint = await self._getFingerprint(packageStep.getPackage())
+        except BuildError:
+            return False
+        if not self.__needsDownload(packageStep, buildId, fingerprint):
+            return False
+        return (buildId, fingerprint)
+
+    async def __prefetchPackages(self, candidates):
+        """Prefetch the artifacts of a list of package steps.
+
+        The archive is asked in one go which of the artifacts exist. Missing
+        artifacts are remembered. If an artifact is not available the package
+        will be built and its dependencies are prefetched in turn. Any error
+        is ignored. The regular download will handle it later.
+        """
+        artifacts = [ await self.__prefetchArtifact(dep, depth)
+                      for (dep, depth) in candidates ]
+        unknown = [ a for a in artifacts if a and not self.__isKnownMissing(*a) ]
+        if len(unknown) > 1:
+            found = await self.__archive.probePackages(unknown)
+            for (artifact, exists) in zip(unknown, found):
+                if exists is False: self.__setKnownMissing(*artifact)
+
+        for ((dep, depth), artifact) in zip(candidates, artifacts):
+            if artifact is False: continue
+            if artifact is not None and not self.__isKnownMissing(*artifact):
+                self.__prefetcher.spawn(self.__prefetchPackage(dep, depth, *artifact))
+            else:
+                await self.__prefetchDependencies(dep, depth)
+
+    async def __prefetchPackage(self, packageStep, depth, buildId, fingerprint):
+        found = await self.__prefetcher.prefetch(packageStep, buildId, fingerprint)
+        if found is False:
+            self.__setKnownMissing(buildId, fingerprint)
+            await self.__prefetchDependencies(packageStep, depth)
+
     async def __queryLiveBuildId(self, step):
         """Predict live build-id of checkout step.
 
@@ -1269,6 +1608,10 @@ esac
         miss the archive is interrogated. A valid result is cached.
         """
         key = b'\x01' + liveBId
+        algorithm = self.__recipes.getHashAlgorithm()
+        if algorithm != "sha1":
+            # translations of other hash algorithms must not collide
+            key += HASH_ALGORITHMS[algorithm][1]
         bid = BobState().getBuildId(key)
         if bid is not None:
             return bid
@@ -1362,7 +1705,8 @@ esac
         else:
             ret = self.__buildDistBuildIds.get(path)
             if ret is None:
-                ret = await step.getDigestCoro(lambda x: self.__getBuildIdList(x, depth+1), True)
+                ret = await step.getDigestCoro(lambda x: self.__getBuildIdList(x, depth+1),
+                    True, getHashAlgorithm(self.__recipes.getHashAlgorithm()))
                 self.__buildDistBuildIds[path] = ret
 
         return ret
@@ -1457,11 +1801,21 @@ esac
         if sandbox is not None:
             return sandbox.getStep().getVariantId()
 
-        # Execute the fingerprint script (or use cached result)
+        # Execute the fingerprint script (or use cached result). Results are
+        # persisted across invocations as long as the host environment did
+        # not change.
         fingerprint = self.__fingerprints.get(script)
         if fingerprint is None:
-            with stepAction(packageStep, "FNGRPRNT", package.getName(), TRACE) as a:
-                fingerprint = await self.__runFingerprintScript(script, a)
+            runEnv = self.__getFingerprintEnv()
+            key = hashlib.sha1(script.encode('utf8')).digest()
+            host = fingerprintHostId(script, runEnv)
+            if not self.__refreshFingerprints:
+                fingerprint = BobState().getFingerprint(key, host,
+                    FINGERPRINT_CACHE_TTL)
+            if fingerprint is None:
+                with stepAction(packageStep, "FNGRPRNT", package.getName(), TRACE) as a:
+                    fingerprint = await self.__runFingerprintScript(script, runEnv, a)
+                BobState().setFingerprint(key, host, fingerprint)
             self.__fingerprints[script] = fingerprint
 
         # If the package is not relocatable the exec path is mixed into the
@@ -1472,14 +1826,15 @@ esac
 
         return hashlib.sha1(fingerprint).digest()
 
-    async def __runFingerprintScript(self, script, logger):
+    def __getFingerprintEnv(self):
         if self.__preserveEnv:
-            runEnv = os.environ.copy()
+            return os.environ.copy()
         else:
             whiteList = set(self.__envWhiteList)
             whiteList.add("PATH")
-            runEnv = { k:v for (k,v) in os.environ.items() if k in whiteList }
+            return { k:v for (k,v) in os.environ.items() if k in whiteList }
 
+    async def __runFingerprintScript(self, script, runEnv, logger):
         stdout = stderr = None
         with tempfile.TemporaryDirectory() as tmp:
             try:
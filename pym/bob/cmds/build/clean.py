@@ -3,12 +3,15 @@
 #
 # SPDX-License-Identifier: GPL-3.0-or-later
 
+from ...audit import Audit, AuditStore
+from ...errors import BuildError
 from ...input import RecipeSet
 from ...scm import getScm, ScmTaint, ScmStatus
 from ...state import BobState
 from ...tty import colorize, ERROR, WARNING, EXECUTED, DEFAULT
 from ...utils import removePath, processDefines
 import argparse
+import gzip
 import os
 
 from .builder import LocalBuilder
@@ -91,6 +94,25 @@ def checkAtticSource(workspace, verbose):
     return checkSCM(workspace, ".", scmSpec, verbose)
 
 
+def collectAuditRoots(ignore):
+    """Get the artifact-ids that are referenced by workspace audit trails.
+
+    The audit trails of the 'ignore' workspaces are skipped.
+    """
+    paths = set(BobState().getDirectories())
+    paths.update(os.path.join(d, "workspace")
+                 for (d, isSourceDir) in BobState().getAllNameDirectores())
+    roots = set()
+    for d in sorted(paths - set(ignore)):
+        audit = os.path.join(d, "..", "audit.json.gz")
+        if not os.path.exists(audit): continue
+        try:
+            with gzip.open(audit, 'rb') as f:
+                roots.update(Audit.fromByteStream(f, audit).getArtifact().getReferences())
+        except OSError as e:
+            raise BuildError("Cannot read audit: " + str(e))
+    return roots
+
 def doClean(argv, bobRoot):
     parser = argparse.ArgumentParser(prog="bob clean",
         formatter_class=argparse.RawDescriptionHelpFormatter,
@@ -220,3 +242,9 @@ would get removed without actually deleting that already.
                 if not os.path.exists(d): BobState().delAtticDirectoryState(d)
     finally:
         BobState().setSynchronous()
+
+    # Drop audit records that are not referenced by any workspace anymore
+    store = AuditStore(".bob-audit")
+    for name in store.collectGarbage(collectAuditRoots(delPaths), args.dry_run):
+        if args.verbose or args.dry_run:
+            print("rm", os.path.relpath(name))
@@ -15,17 +15,22 @@ from pipes import quote
 import argparse
 import ast
 import base64
+import concurrent.futures
+import contextlib
 import datetime
 import getpass
 import hashlib
 import http.client
 import json
 import os.path
+import queue
 import random
 import re
 import ssl
 import sys
 import textwrap
+import threading
+import time
 import urllib.parse
 import xml.etree.ElementTree
 
@@ -116,8 +121,8 @@ def wrapCommandArguments(cmd, arguments):
 class SpecHasher:
     """Track digest calculation and output as spec for bob-hash-engine"""
 
-    def __init__(self):
-        self.lines = ["{sha1"]
+    def __init__(self, algorithm="sha1"):
+        self.lines = ["{" + algorithm]
 
     def update(self, data):
         if isinstance(data, bytes):
@@ -134,7 +139,16 @@ def getBuildIdSpec(step):
     if step.isCheckoutStep():
         return "#" + step.getWorkspacePath()
     else:
-        return step.getDigest(lambda s: s, True, SpecHasher)
+        algorithm = step.getPackage().getRecipe().getRecipeSet().getHashAlgorithm()
+        return step.getDigest(lambda s: s, True, lambda: SpecHasher(algorithm))
+
+def getHashEngineCmd(step):
+    """Return bob-hash-engine invocation for the hash algorithm of the project"""
+    algorithm = step.getPackage().getRecipe().getRecipeSet().getHashAlgorithm()
+    ret = "bob-hash-engine --state .state"
+    if algorithm != "sha1":
+        ret += " --algorithm " + algorithm
+    return ret
 
 def genUuid():
     ret = "".join(random.sample("0123456789abcdef", 8))
@@ -388,7 +402,7 @@ class JenkinsJob:
         return "\n".join(cmds)
 
     def dumpStepBuildIdGen(self, step):
-        return [ "bob-hash-engine --state .state -o {} <<'EOF'".format(JenkinsJob._buildIdName(step)),
+        return [ "{} -o {} <<'EOF'".format(getHashEngineCmd(step), JenkinsJob._buildIdName(step)),
                  getBuildIdSpec(step),
                  "EOF" ]
 
@@ -427,8 +441,8 @@ class JenkinsJob:
         cmd.extend(["-o", JenkinsJob._auditName(step)])
         cmd.append(asHexStr(step.getVariantId()))
         cmd.append("$(hexdump -v -e '/1 \"%02x\"' " + JenkinsJob._buildIdName(step) + ")")
-        cmd.append("$(echo \"#{}\" | bob-hash-engine --state .state | hexdump -v -e '/1 \"%02x\"')"
-                    .format(step.getWorkspacePath()))
+        cmd.append("$(echo \"#{}\" | {} | hexdump -v -e '/1 \"%02x\"')"
+                    .format(step.getWorkspacePath(), getHashEngineCmd(step)))
         fingerprint = self._fingerprintName(step.getPackage())
         if isinstance(fingerprint, bytes):
             cmd.append(asHexStr(fingerprint))
@@ -1505,12 +1519,20 @@ def getUrl(config):
 class JenkinsConnection:
     """Connection to a Jenkins server abstracting the REST API"""
 
-    def __init__(self, config, sslVerify):
+    # Number of tries and initial delay between tries of a single request
+    RETRIES = 3
+    BACKOFF = 1.0
+
+    def __init__(self, config, sslVerify, headers=None):
         self.__config = config
         self.__sslVerify = sslVerify
-        self.__init()
+        self.__connect()
+        if headers is None:
+            self.__authenticate()
+        else:
+            self.__headers = headers
 
-    def __init(self):
+    def __connect(self):
         # create connection
         url = self.__config["url"]
         if url["scheme"] == 'http':
@@ -1528,8 +1550,11 @@ class JenkinsConnection:
             raise BuildError("Unsupported Jenkins URL scheme: '{}'".format(
                 url["scheme"]))
 
-        # remember basic settings
         self.__connection = connection
+
+    def __authenticate(self):
+        # remember basic settings
+        url = self.__config["url"]
         self.__headers = { "Content-Type": "application/xml" }
 
         # handle authorization
@@ -1542,9 +1567,9 @@ class JenkinsConnection:
                 userPass.encode("utf-8")).decode("ascii")
 
         # get CSRF token
-        connection.request("GET", url["path"] + "crumbIssuer/api/xml",
-                           headers=self.__headers)
-        response = connection.getresponse()
+        self.__connection.request("GET", url["path"] + "crumbIssuer/api/xml",
+                                  headers=self.__headers)
+        response = self.__connection.getresponse()
         if response.status == 200:
             resp = xml.etree.ElementTree.fromstring(response.read())
             crumb = resp.find("crumb").text
@@ -1554,32 +1579,52 @@ class JenkinsConnection:
             # dump response
             response.read()
 
+    def clone(self):
+        """Open another connection with the same credentials and CSRF crumb."""
+        return JenkinsConnection(self.__config, self.__sslVerify, self.__headers)
+
+    def close(self):
+        self.__connection.close()
+
     def __enter__(self):
         return self
 
     def __exit__(self, exc_type, exc_value, traceback):
-        self.__connection.close()
+        self.close()
         return False
 
     def _send(self, method, path, body=None, headers=None):
         if headers is None:
             headers = self.__headers
 
-        # Retry in case of BadStatusLine or OSError (broken pipe). This happens
-        # sometimes if the server is under load. Running Bob again essentially
-        # does that anyway...
-        retries = 3
+        # Retry in case of BadStatusLine or OSError (broken pipe) or if the
+        # server is temporarily unavailable. This happens sometimes if the
+        # server is under load. Running Bob again essentially does that
+        # anyway...
+        retries = self.RETRIES
+        delay = self.BACKOFF
         while True:
             try:
                 self.__connection.request(method, self.__config["url"]["path"] + path, body,
                                           headers)
-                return self.__connection.getresponse()
+                response = self.__connection.getresponse()
+                if response.status not in (502, 503, 504):
+                    return response
+                retries -= 1
+                if retries <= 0: return response
+                response.read()
+                print("Jenkins server unavailable ({} {}). Retrying...".format(
+                        response.status, response.reason),
+                      file=sys.stderr)
             except (http.client.BadStatusLine, OSError) as e:
                 retries -= 1
                 if retries <= 0: raise
                 print("Jenkins connection dropped ({}). Retrying...".format(str(e)),
                       file=sys.stderr)
-                self.__init()
+                self.__connection.close()
+                self.__connect()
+            time.sleep(delay)
+            delay *= 2
 
     def checkPlugins(self):
         response = self._send("GET", "pluginManager/api/python?depth=1")
@@ -1683,6 +1728,39 @@ class JenkinsConnection:
                 .format(name, response.status, response.reason))
         response.read()
 
+class JenkinsConnectionPool:
+    """Pool of connections that share the credentials of 'connection'.
+
+    Connections are opened on demand. Each thread must take a connection
+    with get() for its requests. Connections that are opened by the pool are
+    closed by close().
+    """
+
+    def __init__(self, connection):
+        self.__idle = queue.LifoQueue()
+        self.__idle.put(connection)
+        self.__connection = connection
+        self.__connections = []
+        self.__lock = threading.Lock()
+
+    @contextlib.contextmanager
+    def get(self):
+        try:
+            connection = self.__idle.get_nowait()
+        except queue.Empty:
+            connection = self.__connection.clone()
+            with self.__lock:
+                self.__connections.append(connection)
+        try:
+            yield connection
+        finally:
+            self.__idle.put(connection)
+
+    def close(self):
+        for connection in self.__connections:
+            connection.close()
+        self.__connections = []
+
 
 def doJenkinsPrune(recipes, argv):
     parser = argparse.ArgumentParser(prog="bob jenkins prune",
@@ -1794,6 +1872,8 @@ def doJenkinsPush(recipes, argv):
                         help="Overwrite existing jobs")
     parser.add_argument('--no-ssl-verify', dest='ssl_verify', default=True,
         action='store_false', help="Disable SSL certificate verification.")
+    parser.add_argument('-j', '--jobs', default=1, type=int,
+        help="Number of jobs that are pushed in parallel (default: 1)")
     parser.add_argument("--no-trigger", action="store_true", default=False,
                         help="Do not trigger build for updated jobs")
     parser.add_argument('-q', '--quiet', default=0, action='count',
@@ -1805,6 +1885,8 @@ def doJenkinsPush(recipes, argv):
     if args.name not in BobState().getAllJenkins():
         print("Jenkins '{}' not known.".format(args.name), file=sys.stderr)
         sys.exit(1)
+    if args.jobs <= 0:
+        parser.error("--jobs argument must be greater than zero!")
 
     config = BobState().getJenkinsConfig(args.name)
     existingJobs = BobState().getJenkinsAllJobs(args.name)
@@ -1838,104 +1920,89 @@ def doJenkinsPush(recipes, argv):
     def printInfo(job, *args): printLine(1, job, *args)
     def printDebug(job, *args): printLine(2, job, *args)
 
-    # connect to server
-    with JenkinsConnection(config, args.ssl_verify) as connection:
-        # verify plugin state
-        printDebug(None, "Check available plugins...")
-        connection.checkPlugins()
-
-        # push new jobs / reconfigure existing ones
-        for (name, job) in jobs.items():
-            info = {
-                'alias' : args.name,
-                'name' : name,
-                'url' : getUrl(config),
-                'prefix' : config.get('prefix'),
-                'nodes' : nodes,
-                'sandbox' : config['sandbox'],
-                'windows' : windows,
-                'checkoutSteps' : job.getCheckoutSteps(),
-                'buildSteps' : job.getBuildSteps(),
-                'packageSteps' : job.getPackageSteps(),
-                'authtoken': authtoken
-            }
+    def calculateJob(name, job, origXML):
+        info = {
+            'alias' : args.name,
+            'name' : name,
+            'url' : getUrl(config),
+            'prefix' : config.get('prefix'),
+            'nodes' : nodes,
+            'sandbox' : config['sandbox'],
+            'windows' : windows,
+            'checkoutSteps' : job.getCheckoutSteps(),
+            'buildSteps' : job.getBuildSteps(),
+            'packageSteps' : job.getPackageSteps(),
+            'authtoken': authtoken
+        }
 
-            # get original XML if it exists
-            if name in existingJobs:
-                printDebug(name, "Retrieve configuration...")
-                origXML = connection.fetchConfig(name)
-                if origXML is None:
-                    # Job was deleted
-                    printDebug(name, "Forget job. Has been deleted on the server!")
-                    existingJobs.remove(name)
-                    BobState().delJenkinsJob(args.name, name)
-                else:
-                    oldJobConfig = BobState().getJenkinsJobConfig(args.name, name)
+        # calculate new job configuration
+        try:
+            if origXML is not None:
+                jobXML = applyHooks(jenkinsJobPreUpdate, origXML, info, True)
             else:
-                origXML = None
+                jobXML = None
 
-            # calculate new job configuration
-            try:
-                if origXML is not None:
-                    jobXML = applyHooks(jenkinsJobPreUpdate, origXML, info, True)
-                else:
-                    jobXML = None
+            jobXML = job.dumpXML(jobXML, nodes, windows, credentials, clean, options, date, authtoken)
 
-                jobXML = job.dumpXML(jobXML, nodes, windows, credentials, clean, options, date, authtoken)
+            if origXML is not None:
+                jobXML = applyHooks(jenkinsJobPostUpdate, jobXML, info)
+                # job hash is based on unmerged config to detect just our changes
+                hashXML = applyHooks(jenkinsJobCreate,
+                    job.dumpXML(None, nodes, windows, credentials, clean, options, date, authtoken),
+                    info)
+            else:
+                jobXML = applyHooks(jenkinsJobCreate, jobXML, info)
+                hashXML = jobXML
+
+            # Remove description from job hash for comparisons. Additionally
+            # wipe comments and audit-engine calls for schedule decisions.
+            root = xml.etree.ElementTree.fromstring(hashXML)
+            description = root.find("description").text
+            newDescrHash = hashlib.sha1(description.encode('utf8')).digest()
+            root.find("description").text = ""
+            hashXML = xml.etree.ElementTree.tostring(root, encoding="UTF-8")
+            newJobHash = hashlib.sha1(hashXML).digest()
+            cleanJobConfig(root)
+            scheduleHashXML = xml.etree.ElementTree.tostring(root, encoding="UTF-8")
+            newScheduleHash = hashlib.sha1(scheduleHashXML).digest()
+            newJobConfig = {
+                'hash' : newJobHash,
+                'scheduledHash' : newScheduleHash,
+                'descrHash' : newDescrHash,
+                'enabled' : True,
+            }
+        except xml.etree.ElementTree.ParseError as e:
+            raise BuildError("Cannot parse XML of job '{}': {}".format(
+                name, str(e)))
 
-                if origXML is not None:
-                    jobXML = applyHooks(jenkinsJobPostUpdate, jobXML, info)
-                    # job hash is based on unmerged config to detect just our changes
-                    hashXML = applyHooks(jenkinsJobCreate,
-                        job.dumpXML(None, nodes, windows, credentials, clean, options, date, authtoken),
-                        info)
-                else:
-                    jobXML = applyHooks(jenkinsJobCreate, jobXML, info)
-                    hashXML = jobXML
-
-                # Remove description from job hash for comparisons. Additionally
-                # wipe comments and audit-engine calls for schedule decisions.
-                root = xml.etree.ElementTree.fromstring(hashXML)
-                description = root.find("description").text
-                newDescrHash = hashlib.sha1(description.encode('utf8')).digest()
-                root.find("description").text = ""
-                hashXML = xml.etree.ElementTree.tostring(root, encoding="UTF-8")
-                newJobHash = hashlib.sha1(hashXML).digest()
-                cleanJobConfig(root)
-                scheduleHashXML = xml.etree.ElementTree.tostring(root, encoding="UTF-8")
-                newScheduleHash = hashlib.sha1(scheduleHashXML).digest()
-                newJobConfig = {
-                    'hash' : newJobHash,
-                    'scheduledHash' : newScheduleHash,
-                    'descrHash' : newDescrHash,
-                    'enabled' : True,
-                }
-            except xml.etree.ElementTree.ParseError as e:
-                raise BuildError("Cannot parse XML of job '{}': {}".format(
-                    name, str(e)))
+        return (jobXML, description, newJobConfig)
 
-            # configure or create job
-            if name in existingJobs:
-                # skip job if completely unchanged
-                if oldJobConfig == newJobConfig:
-                    printInfo(name, "Unchanged. Skipping...")
-                    continue
+    # The REST calls to create or reconfigure the jobs are independent of
+    # each other and are done by a pool of workers. Everything else,
+    # especially touching BobState, stays in this thread.
 
+    def fetchJob(pool, name):
+        with pool.get() as connection:
+            printDebug(name, "Retrieve configuration...")
+            return connection.fetchConfig(name)
+
+    def updateJob(pool, name, jobXML, description, oldJobConfig, newJobConfig):
+        with pool.get() as connection:
+            if oldJobConfig is not None:
                 # updated config.xml?
                 if oldJobConfig.get('hash') != newJobConfig['hash']:
                     printNormal(name, "Set new configuration...")
                     connection.updateConfig(name, jobXML)
                     oldJobConfig['hash'] = newJobConfig['hash']
                     oldJobConfig['descrHash'] = newJobConfig['descrHash']
-                    BobState().setJenkinsJobConfig(args.name, name, oldJobConfig)
                 elif oldJobConfig.get('descrHash') != newJobConfig['descrHash']:
                     # just set description
                     printInfo(name, "Update description...")
                     connection.setDescription(name, description)
                     oldJobConfig['descrHash'] = newJobConfig['descrHash']
-                    BobState().setJenkinsJobConfig(args.name, name, oldJobConfig)
                 else:
                     printDebug(name, "Not reconfigured. Unchanged configuration.")
+                return (False, oldJobConfig)
             else:
                 printNormal(name, "Initial creation...")
                 oldJobConfig = {
@@ -1949,9 +2016,88 @@ def doJenkinsPush(recipes, argv):
                     else:
                         raise BuildError("Error creating '{}': already exists"
                             .format(name))
+                return (True, oldJobConfig)
+
+    # connect to server
+    with JenkinsConnection(config, args.ssl_verify) as connection:
+        # verify plugin state
+        printDebug(None, "Check available plugins...")
+        connection.checkPlugins()
+
+        # push new jobs / reconfigure existing ones
+        pool = JenkinsConnectionPool(connection)
+        executor = concurrent.futures.ThreadPoolExecutor(max_workers=args.jobs)
+        pending = {}
+        errors = []
+
+        def submit(handler, fn, *fnArgs):
+            # Do not start new requests after an error
+            if not errors:
+                pending[executor.submit(fn, pool, *fnArgs)] = handler
+
+        def startUpdate(name, job, oldJobConfig, origXML):
+            (jobXML, description, newJobConfig) = calculateJob(name, job, origXML)
+
+            # skip job if completely unchanged
+            if oldJobConfig == newJobConfig:
+                printInfo(name, "Unchanged. Skipping...")
+                return
+
+            submit(lambda result: updated(name, newJobConfig, *result),
+                   updateJob, name, jobXML, description, oldJobConfig, newJobConfig)
+
+        def fetched(name, job, origXML):
+            oldJobConfig = BobState().getJenkinsJobConfig(args.name, name)
+            if origXML is None:
+                # Job was deleted
+                printDebug(name, "Forget job. Has been deleted on the server!")
+                BobState().delJenkinsJob(args.name, name)
+                oldJobConfig = None
+            startUpdate(name, job, oldJobConfig, origXML)
+
+        def updated(name, newJobConfig, created, oldJobConfig):
+            if created:
                 BobState().addJenkinsJob(args.name, name, oldJobConfig)
+            else:
+                BobState().setJenkinsJobConfig(args.name, name, oldJobConfig)
             updatedJobs[name] = (oldJobConfig, newJobConfig)
 
+        def fail(e):
+            # let running requests finish but do not start new ones
+            errors.append(e)
+            for f in pending: f.cancel()
+
+        try:
+            for (name, job) in jobs.items():
+                try:
+                    if name in existingJobs:
+                        submit(lambda origXML, name=name, job=job: fetched(name, job, origXML),
+                               fetchJob, name)
+                    else:
+                        startUpdate(name, job, None, None)
+                except Exception as e:
+                    fail(e)
+                    break
+
+            while pending:
+                (done, notDone) = concurrent.futures.wait(pending,
+                    return_when=concurrent.futures.FIRST_COMPLETED)
+                for f in done:
+                    handler = pending.pop(f)
+                    if f.cancelled(): continue
+                    try:
+                        handler(f.result())
+                    except Exception as e:
+                        fail(e)
+        except:
+            for f in pending: f.cancel()
+            raise
+        finally:
+            executor.shutdown()
+            pool.close()
+        if errors:
+            raise errors[0]
+
         # process obsolete jobs
         for name in BobState().getJenkinsAllJobs(args.name) - set(jobs.keys()):
             if keep:
@@ -11,7 +11,8 @@ from .scm import CvsScm, GitScm, SvnScm, UrlScm, ScmOverride, auditFromDir, getS
 from .state import BobState
 from .stringparser import checkGlobList, Env, DEFAULT_STRING_FUNS
 from .tty import InfoOnce, Warn, WarnOnce, setColorMode
-from .utils import asHexStr, joinScripts, sliceString, compareVersion, binStat, updateDicRecursive, hashString
+from .utils import asHexStr, joinScripts, sliceString, compareVersion, binStat, updateDicRecursive, hashString, \
+    getHashAlgorithm
 from abc import ABCMeta, abstractmethod
 from base64 import b64encode
 from itertools import chain
@@ -1819,7 +1820,7 @@ class Recipe(object):
             n : p(n in recipe, recipe.get(n))
             for (n, p) in properties.items()
         }
-        self.__corePackagesByMatch = []
+        self.__corePackagesByMatch = PackageMatchIndex()
         self.__corePackagesById = {}
 
         sourceName = ("Recipe " if isRecipe else "Class  ") + packageName
@@ -2034,17 +2035,17 @@ class Recipe(object):
     def prepare(self, inputEnv, sandboxEnabled, inputStates, inputSandbox=None,
                 inputTools=Env(), stack=[]):
         # already calculated?
-        for m in self.__corePackagesByMatch:
-            if m.matches(inputEnv.detach(), inputTools.detach(), inputStates, inputSandbox):
-                if set(stack) & m.subTreePackages:
-                    raise ParseError("Recipes are cyclic")
-                m.touch(inputEnv, inputTools)
-                if DEBUG['pkgck']:
-                    reusedCorePackage = m.corePackage
-                    break
+        reusedCorePackage = None
+        m = self.__corePackagesByMatch.find(inputEnv.detach(), inputTools.detach(),
+                                            inputStates, inputSandbox)
+        if m is not None:
+            if set(stack) & m.subTreePackages:
+                raise ParseError("Recipes are cyclic")
+            m.touch(inputEnv, inputTools)
+            if DEBUG['pkgck']:
+                reusedCorePackage = m.corePackage
+            else:
                 return m.corePackage, m.subTreePackages
-        else:
-            reusedCorePackage = None
 
         # Track tool and sandbox changes
         diffSandbox = ...
@@ -2291,7 +2292,7 @@ class Recipe(object):
             reusableCorePackage = self.__corePackagesById.setdefault(pid, p)
             if reusableCorePackage is not p:
                 p = reusableCorePackage
-            self.__corePackagesByMatch.insert(0, PackageMatcher(
+            self.__corePackagesByMatch.add(PackageMatcher(
                 reusableCorePackage, inputEnv, inputTools, inputStates,
                 inputSandbox, subTreePackages))
         elif packageCoreStep.getResultId() != reusedCorePackage.getCorePackageStep().getResultId():
@@ -2401,24 +2402,69 @@ class PackageMatcher:
         self.sandbox = sandbox.coreStep.variantId if sandbox is not None else None
         self.subTreePackages = subTreePackages
 
-    def matches(self, inputEnv, inputTools, inputStates, inputSandbox):
-        for (name, env) in self.env.items():
-            if env != inputEnv.get(name): return False
-        for (name, tool) in self.tools.items():
-            match = inputTools.get(name)
-            match = match.coreStep.variantId if match is not None else None
-            if tool != match: return False
-        match = inputSandbox.coreStep.variantId \
-            if inputSandbox is not None else None
-        if self.sandbox != match: return False
-        if self.states != inputStates: return False
-        return True
+    def getKeys(self):
+        """Names of the environment variables and tools that were used."""
+        return (tuple(sorted(self.env.keys())), tuple(sorted(self.tools.keys())))
+
+    def getIndex(self, envKeys, toolKeys):
+        return (tuple(self.env[n] for n in envKeys),
+                tuple(self.tools[n] for n in toolKeys),
+                self.sandbox)
 
     def touch(self, inputEnv, inputTools):
         inputEnv.touch(self.env.keys())
         inputTools.touch(self.tools.keys())
 
 
+class PackageMatchIndex:
+    """Hash index of the PackageMatcher objects of a recipe.
+
+    Matchers are grouped by the names of the environment variables and tools
+    that were used by the package. Within a group the matchers are indexed by
+    the values of these variables, the variant-ids of the tools and the
+    sandbox. A lookup needs one hash probe per group instead of comparing the
+    input with every matcher. Plugin states only support comparison. They are
+    checked on the matchers of the found bucket.
+
+    If more than one matcher fits, the most recently added one is returned,
+    regardless of its group.
+    """
+
+    def __init__(self):
+        self.__groups = []
+        self.__groupsByKeys = {}
+        self.__serial = 0
+
+    def add(self, matcher):
+        keys = matcher.getKeys()
+        group = self.__groupsByKeys.get(keys)
+        if group is None:
+            group = self.__groupsByKeys[keys] = {}
+            self.__groups.append((keys[0], keys[1], group))
+        self.__serial += 1
+        group.setdefault(matcher.getIndex(*keys), []).insert(0, (self.__serial, matcher))
+
+    def find(self, inputEnv, inputTools, inputStates, inputSandbox):
+        sandbox = inputSandbox.coreStep.variantId \
+            if inputSandbox is not None else None
+        ret = None
+        retSerial = 0
+        for (envKeys, toolKeys, group) in self.__groups:
+            tools = ( inputTools.get(n) for n in toolKeys )
+            index = (tuple(inputEnv.get(n) for n in envKeys),
+                     tuple((t.coreStep.variantId if t is not None else None)
+                           for t in tools),
+                     sandbox)
+            # buckets are sorted from newest to oldest matcher
+            for (serial, m) in group.get(index, ()):
+                if serial < retSerial: break
+                if m.states == inputStates:
+                    ret = m
+                    retSerial = serial
+                    break
+        return ret
+
+
 class ArchiveValidator:
     def __init__(self):
         self.__validTypes = schema.Schema({'backend': schema.Or('none', 'file', 'http', 'shell', 'azure')},
@@ -2426,13 +2472,21 @@ class ArchiveValidator:
         baseArchive = {
             'backend' : str,
             schema.Optional('flags') : schema.Schema(["download", "upload",
-                "nofail", "nolocal", "nojenkins"])
+                "nofail", "nolocal", "nojenkins"]),
+            schema.Optional('compression') : schema.Or("gzip", "zstd"),
+            schema.Optional('compressionLevel') : int,
+            schema.Optional('compressionThreads') : schema.And(int, lambda n: n > 0),
         }
         fileArchive = baseArchive.copy()
         fileArchive["path"] = str
+        fileArchive[schema.Optional("unpackedPath")] = str
+        fileArchive[schema.Optional("unpackedSize")] = schema.And(int, lambda n: n >= 0)
+        fileArchive[schema.Optional("unpackedLink")] = bool
         httpArchive = baseArchive.copy()
         httpArchive["url"] = str
         httpArchive[schema.Optional("sslVerify")] = bool
+        httpArchive[schema.Optional("maxConnections")] = schema.And(int, lambda n: n > 0)
+        httpArchive[schema.Optional("chunkedUpload")] = bool
         shellArchive = baseArchive.copy()
         shellArchive.update({
             schema.Optional('download') : str,
@@ -2498,6 +2552,13 @@ class RecipeSet:
             schema.Optional('clean_checkout') : bool,
             schema.Optional('always_checkout') : [str],
             schema.Optional('jobs') : int,
+            schema.Optional('hash_jobs') : int,
+            schema.Optional('prefetch_jobs') : int,
+            schema.Optional('prefetch_rate') : int,
+            schema.Optional('archive_cache') : str,
+            schema.Optional('archive_cache_size') : int,
+            schema.Optional('upload_jobs') : int,
+            schema.Optional('no_wait_upload') : bool,
         })
 
     GRAPH_SCHEMA = schema.Schema(
@@ -2509,6 +2570,7 @@ class RecipeSet:
 
     STATIC_CONFIG_SCHEMA = schema.Schema({
         schema.Optional('bobMinimumVersion') : schema.Regex(r'^[0-9]+(\.[0-9]+){0,2}$'),
+        schema.Optional('hashAlgorithm') : schema.Or("sha1", "sha256", "blake2b"),
         schema.Optional('plugins') : [str],
         schema.Optional('policies') : schema.Schema(
             {
@@ -2555,6 +2617,7 @@ class RecipeSet:
         self.__plugins = {}
         self.__commandConfig = {}
         self.__uiConfig = {}
+        self.__hashAlgorithm = "sha1"
         self.__policies = {
             'relativeIncludes' : (
                 "0.13",
@@ -2882,6 +2945,8 @@ class RecipeSet:
             raise ParseError("Your Bob is too old. At least version "+minVer+" is required!")
         self.__loadPlugins(config.get("plugins", []))
         self.__createSchemas()
+        self.__hashAlgorithm = config.get("hashAlgorithm", "sha1")
+        getHashAlgorithm(self.__hashAlgorithm) # check availability
 
         # determine policies
         self.__policies = { name : (True if compareVersion(ver, minVer) <= 0 else None, warn)
@@ -3148,6 +3213,10 @@ class RecipeSet:
         return PackageSet(cacheKey, self.__aliases, self.__stringFunctions,
             lambda: self.__generatePackages(nameFormatter, env, cacheKey, sandboxEnabled))
 
+    def getHashAlgorithm(self):
+        """Get name of hash algorithm for workspaces and build-ids."""
+        return self.__hashAlgorithm
+
     def getPolicy(self, name, location=None):
         (policy, warning) = self.__policies[name]
         if policy is None:
@@ -0,0 +1,325 @@
+# Bob build tool
+# Copyright (C) 2019  Jan Klötzke
+#
+# SPDX-License-Identifier: GPL-3.0-or-later
+
+"""Change journal for incremental directory hashing.
+
+A watcher process records the relative paths of all changed entries of a
+directory tree in a journal file. The DirHasher uses the journal to
+re-examine only the changed parts of the tree. The journal has the following
+layout:
+
+    header: signature, token, length of root path, root path
+    records: relative path, terminated by NUL
+
+An empty record marks the whole tree as dirty. The watcher holds an exclusive
+lock on the journal as long as it is running. If the journal is not locked
+the watcher is gone and changes might have been missed. Every start of the
+watcher creates a new random token. The same happens if the watcher lost
+track of the tree, i.e. the event queue overflowed or the root directory was
+replaced. The token and the consumed offset are stored in the hash index to
+detect if the journal is still valid.
+
+Events might still be queued in the kernel when the journal is read. The
+reader thus creates a cookie file in a directory next to the journal that is
+watched too. The watcher records the cookie name with a leading slash after
+all preceding events. If the cookie does not show up in time the reader falls
+back to a full scan.
+"""
+
+from .errors import BuildError
+import errno
+import os
+import struct
+import sys
+import time
+
+try:
+    import fcntl
+except ImportError:
+    fcntl = None
+
+SIGNATURE = b'BOBJ'
+HEADER_FMT = '=4sQH'
+HEADER_SIZE = struct.calcsize(HEADER_FMT)
+
+def _readHeader(f):
+    header = f.read(HEADER_SIZE)
+    if len(header) < HEADER_SIZE: return (None, None)
+    (sig, token, rootLen) = struct.unpack(HEADER_FMT, header)
+    root = f.read(rootLen)
+    if sig != SIGNATURE or len(root) != rootLen or token == 0:
+        return (None, None)
+    return (token, root)
+
+class ChangeJournal:
+    """Reader side of the change journal."""
+
+    # Maximum time to wait for the watcher to record the cookie
+    COOKIE_TIMEOUT = 2.0
+
+    def __init__(self, path):
+        self.__path = path
+
+    def __sync(self, f, token, offset):
+        """Wait until the watcher has caught up with all pending events.
+
+        Returns the journal data starting at offset or None if the watcher
+        did not record the cookie in time.
+        """
+        name = "{}.{}".format(os.getpid(), os.urandom(8).hex())
+        cookie = os.path.join(self.__path + ".cookies", name)
+        try:
+            open(cookie, "wb").close()
+        except OSError:
+            return None
+
+        try:
+            marker = b'\0/' + name.encode("ascii") + b'\0'
+            deadline = time.monotonic() + ChangeJournal.COOKIE_TIMEOUT
+            delay = 0.001
+            while True:
+                f.seek(offset)
+                data = f.read()
+                # The journal must not have been reset while reading
+                f.seek(0)
+                if _readHeader(f)[0] != token: return None
+                if marker in b'\0' + data: return data
+                if time.monotonic() >= deadline: return None
+                time.sleep(delay)
+                delay = min(delay * 2, 0.05)
+        finally:
+            try:
+                os.unlink(cookie)
+            except OSError:
+                pass
+
+    def read(self, root, token, offset):
+        """Read dirty paths since last run.
+
+        Returns a tuple of the current token, the new offset and the set of
+        dirty paths. If the journal cannot be used the token is 0. The set is
+        None if a full scan is required.
+        """
+        if fcntl is None: return (0, 0, None)
+        try:
+            f = open(self.__path, "rb")
+        except OSError:
+            return (0, 0, None)
+
+        with f:
+            try:
+                fcntl.flock(f.fileno(), fcntl.LOCK_SH | fcntl.LOCK_NB)
+                # Not locked by a watcher. Changes might have been missed.
+                fcntl.flock(f.fileno(), fcntl.LOCK_UN)
+                return (0, 0, None)
+            except OSError as e:
+                if e.errno not in (errno.EAGAIN, errno.EACCES): raise
+
+            (curToken, curRoot) = _readHeader(f)
+            if curToken is None or curRoot != os.fsencode(os.path.realpath(root)):
+                return (0, 0, None)
+            start = f.tell()
+            if (curToken != token) or (offset < start):
+                # A full scan is needed to start tracking.
+                f.seek(0, os.SEEK_END)
+                return (curToken, f.tell(), None)
+
+            data = self.__sync(f, curToken, offset)
+            if data is None:
+                # Events might be pending. Do a full scan and start over.
+                f.seek(0)
+                curToken = _readHeader(f)[0]
+                if curToken is None: return (0, 0, None)
+                f.seek(0, os.SEEK_END)
+                return (curToken, f.tell(), None)
+
+            end = data.rfind(b'\0') + 1
+            dirty = set(p for p in data[:end].split(b'\0')[:-1]
+                        if not p.startswith(b'/'))
+            if b'' in dirty: dirty = None
+            return (curToken, offset + end, dirty)
+
+
+class JournalWatcher:
+    """Watch a directory tree with inotify and record changes in a journal.
+
+    Only available on Linux. The watcher stops if the root directory is
+    removed.
+    """
+
+    IN_MODIFY      = 0x00000002
+    IN_ATTRIB      = 0x00000004
+    IN_CLOSE_WRITE = 0x00000008
+    IN_MOVED_FROM  = 0x00000040
+    IN_MOVED_TO    = 0x00000080
+    IN_CREATE      = 0x00000100
+    IN_DELETE      = 0x00000200
+    IN_DELETE_SELF = 0x00000400
+    IN_MOVE_SELF   = 0x00000800
+    IN_Q_OVERFLOW  = 0x00004000
+    IN_IGNORED     = 0x00008000
+    IN_ONLYDIR     = 0x01000000
+    IN_DONT_FOLLOW = 0x02000000
+    IN_EXCL_UNLINK = 0x04000000
+    IN_ISDIR       = 0x40000000
+    IN_CLOEXEC     = 0o2000000
+
+    WATCH_MASK = (IN_MODIFY | IN_ATTRIB | IN_CLOSE_WRITE | IN_MOVED_FROM |
+        IN_MOVED_TO | IN_CREATE | IN_DELETE | IN_DELETE_SELF | IN_MOVE_SELF |
+        IN_ONLYDIR | IN_DONT_FOLLOW | IN_EXCL_UNLINK)
+
+    EVENT_FMT = '=iIII'
+    EVENT_SIZE = struct.calcsize(EVENT_FMT)
+
+    # Start over with a new token if the journal grows too big
+    MAX_JOURNAL_SIZE = 64 * 1024 * 1024
+
+    def __init__(self, root, journalPath, ignoreDirs=frozenset()):
+        if not sys.platform.startswith("linux"):
+            raise BuildError("Change journal is only supported on Linux!")
+        import ctypes, ctypes.util
+        self.__libc = ctypes.CDLL(ctypes.util.find_library("c"), use_errno=True)
+        self.__root = os.fsencode(os.path.realpath(root))
+        self.__journalPath = journalPath
+        self.__ignoreDirs = ignoreDirs
+        self.__watches = {}
+
+    def __addWatch(self, path):
+        import ctypes
+        wd = self.__libc.inotify_add_watch(self.__fd,
+            os.path.join(self.__root, path) if path else self.__root,
+            JournalWatcher.WATCH_MASK)
+        if wd < 0:
+            err = ctypes.get_errno()
+            if err in (errno.ENOENT, errno.ENOTDIR): return
+            raise BuildError("Cannot watch '{}': {}".format(
+                os.fsdecode(os.path.join(self.__root, path)), os.strerror(err)))
+        self.__watches[wd] = path
+
+    def __addTree(self, path):
+        self.__addWatch(path)
+        for (dirPath, dirs, files) in os.walk(os.path.join(self.__root, path)):
+            dirs[:] = [ d for d in dirs if d not in self.__ignoreDirs ]
+            for d in dirs:
+                self.__addWatch(os.path.relpath(os.path.join(dirPath, d), self.__root))
+
+    def __removeTree(self, path):
+        prefix = path + b'/'
+        for (wd, p) in list(self.__watches.items()):
+            if p == path or p.startswith(prefix):
+                self.__libc.inotify_rm_watch(self.__fd, wd)
+                del self.__watches[wd]
+
+    def __watchCookies(self):
+        import ctypes
+        cookieDir = self.__journalPath + ".cookies"
+        os.makedirs(cookieDir, exist_ok=True)
+        for name in os.listdir(cookieDir):
+            os.unlink(os.path.join(cookieDir, name))
+        self.__cookieWd = self.__libc.inotify_add_watch(self.__fd,
+            os.fsencode(cookieDir), JournalWatcher.IN_CLOSE_WRITE |
+            JournalWatcher.IN_ONLYDIR | JournalWatcher.IN_DONT_FOLLOW)
+        if self.__cookieWd < 0:
+            raise BuildError("Cannot watch '{}': {}".format(cookieDir,
+                os.strerror(ctypes.get_errno())))
+
+    def __reset(self):
+        """Start a new journal generation.
+
+        The header is only written after all watches are in place. Until
+        then readers will do a full scan.
+        """
+        self.__journal.seek(0)
+        self.__journal.truncate()
+        self.__journal.flush()
+        for wd in list(self.__watches):
+            self.__libc.inotify_rm_watch(self.__fd, wd)
+        self.__watches = {}
+        self.__addTree(b'')
+        token = struct.unpack("=Q", os.urandom(8))[0] | 1
+        self.__journal.write(struct.pack(HEADER_FMT, SIGNATURE, token,
+            len(self.__root)) + self.__root)
+        self.__journal.flush()
+
+    def __record(self, paths):
+        if not paths: return
+        self.__journal.write(b''.join(p + b'\0' for p in paths))
+        self.__journal.flush()
+        if self.__journal.tell() > JournalWatcher.MAX_JOURNAL_SIZE:
+            self.__reset()
+
+    def __process(self, buf):
+        dirty = []
+        cookies = []
+        reset = False
+        pos = 0
+        while pos + JournalWatcher.EVENT_SIZE <= len(buf):
+            (wd, mask, cookie, nameLen) = struct.unpack_from(JournalWatcher.EVENT_FMT, buf, pos)
+            pos += JournalWatcher.EVENT_SIZE
+            name = buf[pos:pos+nameLen].rstrip(b'\0')
+            pos += nameLen
+
+            if mask & JournalWatcher.IN_Q_OVERFLOW:
+                reset = True
+                continue
+            if wd == self.__cookieWd:
+                if mask & JournalWatcher.IN_CLOSE_WRITE:
+                    cookies.append(b'/' + name)
+                continue
+            base = self.__watches.get(wd)
+            if base is None: continue
+            if mask & JournalWatcher.IN_IGNORED:
+                del self.__watches[wd]
+                continue
+            if mask & (JournalWatcher.IN_DELETE_SELF | JournalWatcher.IN_MOVE_SELF):
+                if base:
+                    dirty.append(base)
+                elif os.path.isdir(self.__root):
+                    # Root was replaced. Start over on the new directory.
+                    reset = True
+                else:
+                    return False
+                continue
+
+            path = os.path.join(base, name) if base else name
+            dirty.append(path)
+            if mask & JournalWatcher.IN_ISDIR:
+                if mask & JournalWatcher.IN_MOVED_FROM:
+                    self.__removeTree(path)
+                elif mask & (JournalWatcher.IN_CREATE | JournalWatcher.IN_MOVED_TO):
+                    if name not in self.__ignoreDirs:
+                        self.__addTree(path)
+
+        if reset:
+            # Changes might have been missed or the watches are stale
+            self.__reset()
+            dirty = []
+        self.__record(sorted(set(dirty)) + cookies)
+        return True
+
+    def run(self):
+        """Watch the tree until interrupted or the root is removed."""
+        import ctypes
+        fd = os.open(self.__journalPath, os.O_RDWR | os.O_CREAT, 0o644)
+        self.__journal = os.fdopen(fd, "wb")
+        try:
+            try:
+                fcntl.flock(fd, fcntl.LOCK_EX | fcntl.LOCK_NB)
+            except OSError:
+                raise BuildError("Journal '{}' is already watched!".format(self.__journalPath))
+
+            self.__fd = self.__libc.inotify_init1(JournalWatcher.IN_CLOEXEC)
+            if self.__fd < 0:
+                raise BuildError("Cannot initialize inotify: " +
+                                 os.strerror(ctypes.get_errno()))
+            try:
+                self.__watchCookies()
+                self.__reset()
+                while self.__process(os.read(self.__fd, 65536)):
+                    pass
+            finally:
+                os.close(self.__fd)
+        finally:
+            self.__journal.close()
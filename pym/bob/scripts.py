@@ -7,7 +7,7 @@ from . import BOB_VERSION, _enableDebug, DEBUG
 from .errors import BobError
 from .state import finalize
 from .tty import colorize, Unbuffered, setColorMode, cleanup
-from .utils import asHexStr, hashPath
+from .utils import asHexStr, hashPath, getHashAlgorithm, HASH_ALGORITHMS
 import argparse
 import logging
 import sys
@@ -238,11 +238,35 @@ def hashTree():
         with '-s'. This cache holds the calculated file caches. Unmodified files
         will not be read again in subsequent runs.""")
     parser.add_argument('-s', '--state', help="State cache path")
+    parser.add_argument('-j', '--jobs', default=1, type=int, nargs='?', const=...,
+        help="Number of processes that hash files in parallel")
+    parser.add_argument('--algorithm', default='sha1', choices=sorted(HASH_ALGORITHMS),
+        help="Hash algorithm (default: sha1)")
+    parser.add_argument('--watch', action='store_true',
+        help="""Watch directory and record changes in a journal next to the
+            state cache. Subsequent hashing with the same state cache will only
+            examine the changed files. Runs until interrupted or the directory
+            is removed.""")
     parser.add_argument('dir', help="Directory")
     args = parser.parse_args()
 
+    if args.jobs is ...:
+        args.jobs = os.cpu_count()
+    elif args.jobs <= 0:
+        parser.error("--jobs argument must be greater than zero!")
+    if args.watch and not args.state:
+        parser.error("--watch requires a state cache!")
+
     def cmd():
-        digest = hashPath(args.dir, args.state)
+        if args.watch:
+            from .journal import JournalWatcher
+            from .utils import DirHasher
+            JournalWatcher(args.dir, args.state + ".journal",
+                           DirHasher.IGNORE_DIRS).run()
+            return 0
+
+        digest = hashPath(args.dir, args.state, jobs=args.jobs,
+                          algorithm=args.algorithm)
         print(asHexStr(digest))
         return 0
 
@@ -252,6 +276,8 @@ def hashEngine():
     parser = argparse.ArgumentParser(description="Create hash based on spec.")
     parser.add_argument('-o', dest="output", metavar="OUTPUT", default="-", help="Output file (default: stdout)")
     parser.add_argument('--state', help="State cache directory")
+    parser.add_argument('--algorithm', default='sha1', choices=sorted(HASH_ALGORITHMS),
+        help="Hash algorithm of directories (default: sha1)")
     parser.add_argument('spec', nargs='?', default="-", help="Spec input (default: stdin)")
     args = parser.parse_args()
 
@@ -262,7 +288,8 @@ def hashEngine():
             else:
                 inFile = open(args.spec, "r")
 
-            res = __process(inFile.readline().strip(), inFile, args.state)
+            res = __process(inFile.readline().strip(), inFile, args.state,
+                            args.algorithm)
             if args.output == "-":
                 sys.stdout.buffer.write(res)
             else:
@@ -322,22 +349,26 @@ def auditEngine():
 
     return catchErrors(cmd)
 
-def __process(l, inFile, stateDir):
+def __process(l, inFile, stateDir, algorithm):
     if l.startswith("="):
         return bytes.fromhex(l[1:])
     elif l.startswith("<"):
         with open(l[1:], "rb") as f:
             return f.read()
     elif l.startswith("{"):
-        import hashlib
-        return __processBlock(hashlib.new(l[1:]), inFile, stateDir)
+        if l[1:] in HASH_ALGORITHMS:
+            h = getHashAlgorithm(l[1:])()
+        else:
+            import hashlib
+            h = hashlib.new(l[1:])
+        return __processBlock(h, inFile, stateDir, algorithm)
     elif l.startswith("#"):
         import os.path
         if stateDir:
             stateFile = os.path.join(stateDir, l[1:].replace(os.sep, "_"))
         else:
             stateFile = None
-        return hashPath(l[1:], stateFile)
+        return hashPath(l[1:], stateFile, algorithm=algorithm)
     elif l.startswith("g"):
         from .scm.git import GitScm
         return bytes.fromhex(GitScm.processLiveBuildIdSpec(l[1:]))
@@ -345,13 +376,13 @@ def __process(l, inFile, stateDir):
         print("Malformed spec:", l, file=sys.stderr)
         sys.exit(1)
 
-def __processBlock(h, inFile, stateDir):
+def __processBlock(h, inFile, stateDir, algorithm):
     while True:
         l = inFile.readline().strip()
         if l.startswith("}"):
             return h.digest()
         else:
-            h.update(__process(l, inFile, stateDir))
+            h.update(__process(l, inFile, stateDir, algorithm))
 
 if __name__ == '__main__':
     if sys.argv[1] == 'bob':
@@ -4,12 +4,14 @@
 # SPDX-License-Identifier: GPL-3.0-or-later
 
 from .errors import ParseError
-from .tty import WarnOnce
+from .tty import WarnOnce, colorize
 import copy
 import errno
 import os
 import pickle
 import sqlite3
+import sys
+import time
 
 warnNoAttic = WarnOnce(
     "Project was created by old Bob version. Attic directories listing will be incomplete.",
@@ -27,23 +29,36 @@ class _BobState():
     #  5 -> 6: build state stores predicted live-build-ids too
     #  6 -> 7: amended directory state for source steps, store attic directories
     #  7 -> 8: normalize attic directories
+    #  8 -> 9: state is stored in SQLite database instead of pickle file
     MIN_VERSION = 2
-    CUR_VERSION = 8
+    CUR_VERSION = 9
 
     VERSION_SINCE_ATTIC_TRACKED = 7
+    VERSION_SINCE_DATABASE = 9
+
+    # Maximum time in seconds that changes of an asynchronous section are
+    # kept uncommitted.
+    COMMIT_INTERVAL = 2.0
+
+    # Sections of the state database that are simple dictionaries
+    DICT_SECTIONS = ("byNameDirs", "results", "inputs", "dirStates",
+                     "variantIds", "atticDirs")
 
     instance = None
     def __init__(self):
-        self.__path = ".bob-state.pickle"
+        self.__path = ".bob-state.sqlite3"
+        self.__picklePath = ".bob-state.pickle"
         self.__byNameDirs = {}
         self.__results = {}
         self.__inputs = {}
         self.__jenkins = {}
         self.__asynchronous = 0
-        self.__dirty = False
         self.__dirStates = {}
         self.__buildState = {}
         self.__lock = None
+        self.__db = None
+        self.__pending = False
+        self.__lastCommit = time.monotonic()
         self.__buildIdCache = None
         self.__variantIds = {}
         self.__atticDirs = {}
@@ -68,97 +83,218 @@ class _BobState():
         # load state if it exists
         try:
             if os.path.exists(self.__path):
-                try:
-                    with open(self.__path, 'rb') as f:
-                        state = pickle.load(f)
-                except OSError as e:
-                    raise ParseError("Error loading workspace state: " + str(e))
-                except pickle.PickleError as e:
-                    raise ParseError("Error decoding workspace state: " + str(e))
-
-                if state["version"] < _BobState.MIN_VERSION:
-                    raise ParseError("This version of Bob cannot read the workspace anymore. Sorry. :-(",
-                                     help="This workspace was created by an older version of Bob that is no longer supported.")
-                if state["version"] > _BobState.CUR_VERSION:
-                    raise ParseError("This version of Bob is too old for the workspace.",
-                                     help="A more recent version of Bob was previously used in this workspace. You have to use that version instead.")
-                self.__byNameDirs = state["byNameDirs"]
-                self.__results = state["results"]
-                self.__inputs = state["inputs"]
-                self.__jenkins = state.get("jenkins", {})
-                self.__dirStates = state.get("dirStates", {})
-                self.__buildState = state.get("buildState", {})
-                self.__variantIds = state.get("variantIds", {})
-                self.__atticDirs = state.get("atticDirs", {})
-                self.__createdWithVersion = state.get("createdWithVersion", 0)
-
-                # version upgrades
-                if state["version"] == 2:
-                    self.__byNameDirs = {
-                        digest : ((dir, False) if isinstance(dir, str) else dir)
-                        for (digest, dir) in self.__byNameDirs.items()
-                    }
-
-                if state["version"] <= 3:
-                    for j in self.__jenkins.values():
-                        jobs = j["jobs"]
-                        j["jobs"] = { k.lower() : v for (k,v) in jobs.items() }
-
-                if state["version"] <= 4:
-                    self.__buildState = { path : (vid, False)
-                        for path, vid in self.__buildState.items() }
-
-                if state["version"] <= 5:
-                    self.__buildState = {
-                        'wasRun' : self.__buildState,
-                        'predictedBuidId' : {}
-                    }
-                if state["version"] <= 7:
-                    self.__atticDirs = { os.path.normpath(k) : v
-                        for k, v in self.__atticDirs.items() }
+                self.__load()
+            elif os.path.exists(self.__picklePath):
+                if self.__loadPickle(): self.__migrate()
         except:
             self.finalize()
             raise
 
-    def __save(self):
-        if self.__asynchronous == 0:
-            state = {
-                "version" : _BobState.CUR_VERSION,
-                "byNameDirs" : self.__byNameDirs,
-                "results" : self.__results,
-                "inputs" : self.__inputs,
-                "jenkins" : self.__jenkins,
-                "dirStates" : self.__dirStates,
-                "buildState" : self.__buildState,
-                "variantIds" : self.__variantIds,
-                "atticDirs" : self.__atticDirs,
-                "createdWithVersion" : self.__createdWithVersion,
+    def __checkVersion(self, version):
+        if version < _BobState.MIN_VERSION:
+            raise ParseError("This version of Bob cannot read the workspace anymore. Sorry. :-(",
+                             help="This workspace was created by an older version of Bob that is no longer supported.")
+        if version > _BobState.CUR_VERSION:
+            raise ParseError("This version of Bob is too old for the workspace.",
+                             help="A more recent version of Bob was previously used in this workspace. You have to use that version instead.")
+
+    def __load(self):
+        try:
+            db = self.__openDb()
+            db.execute("SELECT section, key, value FROM state")
+            rows = db.fetchall()
+        except sqlite3.Error as e:
+            raise ParseError("Error loading workspace state: " + str(e))
+
+        sections = {}
+        try:
+            for (section, key, value) in rows:
+                sections.setdefault(section, {})[key] = pickle.loads(value)
+        except pickle.PickleError as e:
+            raise ParseError("Error decoding workspace state: " + str(e))
+
+        meta = sections.get("meta", {})
+        self.__checkVersion(meta.get("version", 0))
+        self.__byNameDirs = sections.get("byNameDirs", {})
+        self.__results = sections.get("results", {})
+        self.__inputs = sections.get("inputs", {})
+        self.__dirStates = sections.get("dirStates", {})
+        self.__variantIds = sections.get("variantIds", {})
+        self.__atticDirs = sections.get("atticDirs", {})
+        self.__buildState = meta.get("buildState", {})
+        self.__createdWithVersion = meta.get("createdWithVersion", 0)
+        self.__jenkins = {
+            name : {
+                "config" : config,
+                "jobs" : sections.get("jenkinsJobs:" + name, {}),
+                "byNameDirs" : sections.get("jenkinsDirs:" + name, {}),
+            } for (name, config) in sections.get("jenkins", {}).items()
+        }
+
+    def __loadPickle(self):
+        try:
+            with open(self.__picklePath, 'rb') as f:
+                state = pickle.load(f)
+        except OSError as e:
+            raise ParseError("Error loading workspace state: " + str(e))
+        except pickle.PickleError as e:
+            raise ParseError("Error decoding workspace state: " + str(e))
+
+        self.__checkVersion(state["version"])
+        if state["version"] >= _BobState.VERSION_SINCE_DATABASE:
+            # Stub of an already migrated state whose database is gone
+            return False
+        self.__byNameDirs = state["byNameDirs"]
+        self.__results = state["results"]
+        self.__inputs = state["inputs"]
+        self.__jenkins = state.get("jenkins", {})
+        self.__dirStates = state.get("dirStates", {})
+        self.__buildState = state.get("buildState", {})
+        self.__variantIds = state.get("variantIds", {})
+        self.__atticDirs = state.get("atticDirs", {})
+        self.__createdWithVersion = state.get("createdWithVersion", 0)
+
+        # version upgrades
+        if state["version"] == 2:
+            self.__byNameDirs = {
+                digest : ((dir, False) if isinstance(dir, str) else dir)
+                for (digest, dir) in self.__byNameDirs.items()
             }
-            tmpFile = self.__path+".new"
+
+        if state["version"] <= 3:
+            for j in self.__jenkins.values():
+                jobs = j["jobs"]
+                j["jobs"] = { k.lower() : v for (k,v) in jobs.items() }
+
+        if state["version"] <= 4:
+            self.__buildState = { path : (vid, False)
+                for path, vid in self.__buildState.items() }
+
+        if state["version"] <= 5:
+            self.__buildState = {
+                'wasRun' : self.__buildState,
+                'predictedBuidId' : {}
+            }
+        if state["version"] <= 7:
+            self.__atticDirs = { os.path.normpath(k) : v
+                for k, v in self.__atticDirs.items() }
+
+        return True
+
+    def __migrate(self):
+        """Convert pickled state into database.
+
+        The old pickle file is kept as backup but renamed so that it is not
+        used anymore. It is replaced by a stub that only holds the current
+        version. Older versions of Bob will thus refuse to work on the
+        workspace instead of treating it as fresh project.
+        """
+        put = [ (section, k, v)
+                for section in _BobState.DICT_SECTIONS
+                for (k, v) in getattr(self, "_BobState__" + section).items() ]
+        put.append(("meta", "buildState", self.__buildState))
+        put.append(("meta", "createdWithVersion", self.__createdWithVersion))
+        for (name, j) in self.__jenkins.items():
+            put.append(("jenkins", name, j["config"]))
+            put.extend(("jenkinsJobs:" + name, k, v) for (k, v) in j["jobs"].items())
+            put.extend(("jenkinsDirs:" + name, k, v) for (k, v) in j.get("byNameDirs", {}).items())
+        self.__commit(put)
+        try:
+            with open(self.__picklePath + ".new", "wb") as f:
+                pickle.dump({ "version" : self.CUR_VERSION }, f)
+            os.replace(self.__picklePath, self.__picklePath + ".old")
+            os.replace(self.__picklePath + ".new", self.__picklePath)
+        except OSError as e:
+            raise ParseError("Error migrating workspace state: " + str(e))
+
+    def __openDb(self):
+        if self.__db is None:
             try:
-                with open(tmpFile, "wb") as f:
-                    pickle.dump(state, f)
-                    f.flush()
-                    os.fsync(f.fileno())
-                os.replace(tmpFile, self.__path)
-            except OSError as e:
-                raise ParseError("Error saving workspace state: " + str(e))
-            self.__dirty = False
-        else:
-            self.__dirty = True
+                self.__db = sqlite3.connect(self.__path, isolation_level=None).cursor()
+                self.__db.execute("PRAGMA journal_mode=WAL")
+                self.__db.execute("""\
+                    CREATE TABLE IF NOT EXISTS state(
+                        section TEXT NOT NULL,
+                        key NOT NULL,
+                        value BLOB,
+                        PRIMARY KEY(section, key)
+                    )""")
+                self.__db.execute("INSERT OR IGNORE INTO state VALUES ('meta', 'version', ?)",
+                    (pickle.dumps(self.CUR_VERSION),))
+                self.__db.execute("INSERT OR IGNORE INTO state VALUES ('meta', 'createdWithVersion', ?)",
+                    (pickle.dumps(self.__createdWithVersion),))
+                if self.__asynchronous: self.__db.execute("BEGIN")
+            except sqlite3.Error as e:
+                self.__db = None
+                raise ParseError("Cannot open workspace state: " + str(e))
+        return self.__db
+
+    def __commit(self, put=(), delete=(), sync=False):
+        """Write changed entries to the database.
+
+        Outside of asynchronous sections every call is a transaction on its
+        own. Otherwise the changes are group-committed: they are made durable
+        when the last asynchronous section is left, when sync() is called or
+        when the commit interval has elapsed. Changes that must not be lost
+        because the workspace is modified right afterwards are committed
+        immediately by passing sync=True. Because all changes go through a
+        single transaction a crash will always restore a consistent prefix
+        of all changes.
+        """
+        db = self.__openDb()
+        try:
+            if not self.__asynchronous: db.execute("BEGIN")
+            db.executemany("INSERT OR REPLACE INTO state VALUES (?, ?, ?)",
+                ( (section, key, pickle.dumps(value, -1)) for (section, key, value) in put ))
+            db.executemany("DELETE FROM state WHERE section=? AND key=?", delete)
+            if not self.__asynchronous:
+                db.execute("END")
+                return
+        except sqlite3.Error as e:
+            if not self.__asynchronous:
+                try:
+                    db.execute("ROLLBACK")
+                except sqlite3.Error:
+                    pass # no transaction active
+            raise ParseError("Error saving workspace state: " + str(e))
+
+        self.__pending = True
+        if sync or (time.monotonic() - self.__lastCommit >= self.COMMIT_INTERVAL):
+            self.sync()
+
+    def sync(self):
+        """Make all changes of asynchronous sections durable."""
+        if not self.__pending: return
+        try:
+            self.__db.execute("END")
+            self.__db.execute("BEGIN")
+        except sqlite3.Error as e:
+            raise ParseError("Error saving workspace state: " + str(e))
+        self.__pending = False
+        self.__lastCommit = time.monotonic()
 
     def __openBIdCache(self):
         if self.__buildIdCache is None:
             try:
                 self.__buildIdCache = sqlite3.connect(".bob-buildids.sqlite3", isolation_level=None).cursor()
                 self.__buildIdCache.execute("CREATE TABLE IF NOT EXISTS buildids(key PRIMARY KEY, value)")
+                self.__buildIdCache.execute("CREATE TABLE IF NOT EXISTS fingerprints(key PRIMARY KEY, host, stamp, value)")
+                self.__buildIdCache.execute("CREATE TABLE IF NOT EXISTS artifactMisses(key PRIMARY KEY, archive, stamp)")
                 self.__buildIdCache.execute("BEGIN")
             except sqlite3.Error as e:
                 self.__buildIdCache = None
                 raise ParseError("Cannot access buildid cache: " + str(e))
 
     def finalize(self):
-        assert (self.__asynchronous == 0) and not self.__dirty
+        assert self.__asynchronous == 0
+        if self.__db is not None:
+            try:
+                self.__db.close()
+                self.__db.connection.close()
+                self.__db = None
+            except sqlite3.Error as e:
+                print(colorize("Warning: cannot close workspace state: "+str(e), "33"),
+                    file=sys.stderr)
         if self.__buildIdCache is not None:
             try:
                 self.__buildIdCache.execute("END")
@@ -167,29 +303,35 @@ class _BobState():
                 self.__buildIdCache = None
             except sqlite3.Error as e:
                 print(colorize("Warning: cannot commit buildid cache: "+str(e), "33"),
-                    file=stderr)
+                    file=sys.stderr)
         if self.__lock:
             try:
                 os.unlink(self.__lock)
             except FileNotFoundError:
-                from .tty import colorize
-                from sys import stderr
                 print(colorize("Warning: lock file was deleted while Bob was still running!", "33"),
-                    file=stderr)
+                    file=sys.stderr)
             except OSError as e:
-                from .tty import colorize
-                from sys import stderr
                 print(colorize("Warning: cannot unlock workspace: "+str(e), "33"),
-                    file=stderr)
+                    file=sys.stderr)
 
     def setAsynchronous(self):
+        if self.__asynchronous == 0 and self.__db is not None:
+            try:
+                self.__db.execute("BEGIN")
+            except sqlite3.Error as e:
+                raise ParseError("Error saving workspace state: " + str(e))
         self.__asynchronous += 1
 
     def setSynchronous(self):
         self.__asynchronous -= 1
         assert self.__asynchronous >= 0
-        if (self.__asynchronous == 0) and self.__dirty:
-            self.__save()
+        if (self.__asynchronous == 0) and (self.__db is not None):
+            try:
+                self.__db.execute("END")
+            except sqlite3.Error as e:
+                raise ParseError("Error saving workspace state: " + str(e))
+            self.__pending = False
+            self.__lastCommit = time.monotonic()
 
     def getByNameDirectory(self, baseDir, digest, isSourceDir):
         if digest in self.__byNameDirs:
@@ -199,7 +341,8 @@ class _BobState():
             res = "{}/{}".format(baseDir, num)
             self.__byNameDirs[baseDir] = num
             self.__byNameDirs[digest] = (res, isSourceDir)
-            self.__save()
+            self.__commit([("byNameDirs", baseDir, num),
+                           ("byNameDirs", digest, (res, isSourceDir))], sync=True)
             return res
 
     def getExistingByNameDirectory(self, digest):
@@ -217,7 +360,7 @@ class _BobState():
     def setResultHash(self, stepDigest, hash):
         if self.getResultHash(stepDigest) != hash:
             self.__results[stepDigest] = hash
-            self.__save()
+            self.__commit([("results", stepDigest, hash)])
 
     def getInputHashes(self, path):
         return self.__inputs.get(path)
@@ -225,12 +368,12 @@ class _BobState():
     def setInputHashes(self, path, hashes):
         if self.getInputHashes(path) != hashes:
             self.__inputs[path] = hashes
-            self.__save()
+            self.__commit([("inputs", path, hashes)])
 
     def delInputHashes(self, path):
         if path in self.__inputs:
             del self.__inputs[path]
-            self.__save()
+            self.__commit(delete=[("inputs", path)])
 
     def getDirectories(self):
         return list(self.__dirStates.keys())
@@ -251,7 +394,7 @@ class _BobState():
         For pacakge directories:    bytes
         """
         self.__dirStates[path] = digest
-        self.__save()
+        self.__commit([("dirStates", path, digest)], sync=True)
 
     def delDirectoryState(self, path):
         self.resetWorkspaceState(path, None)
@@ -262,31 +405,34 @@ class _BobState():
     def setVariantId(self, path, variantId):
         if self.getVariantId(path) != variantId:
             self.__variantIds[path] = variantId
-            self.__save()
+            self.__commit([("variantIds", path, variantId)])
 
     def resetWorkspaceState(self, path, dirState):
-        needSave = False
+        put = []
+        delete = []
         if path in self.__results:
             del self.__results[path]
-            needSave = True
+            delete.append(("results", path))
         if path in self.__inputs:
             del self.__inputs[path]
-            needSave = True
+            delete.append(("inputs", path))
         if self.__dirStates.get(path) != dirState:
             if dirState is None:
                 del self.__dirStates[path]
+                delete.append(("dirStates", path))
             else:
                 self.__dirStates[path] = dirState
-            needSave = True
+                put.append(("dirStates", path, dirState))
         if path in self.__variantIds:
             del self.__variantIds[path]
-            needSave = True
-        if needSave:
-            self.__save()
+            delete.append(("variantIds", path))
+        if put or delete:
+            self.__commit(put, delete, sync=True)
 
     def setAtticDirectoryState(self, path, state):
-        self.__atticDirs[os.path.normpath(path)] = state
-        self.__save()
+        path = os.path.normpath(path)
+        self.__atticDirs[path] = state
+        self.__commit([("atticDirs", path, state)], sync=True)
 
     def getAtticDirectoryState(self, path):
         if self.__createdWithVersion < self.VERSION_SINCE_ATTIC_TRACKED:
@@ -296,7 +442,7 @@ class _BobState():
     def delAtticDirectoryState(self, path):
         if path in self.__atticDirs:
             del self.__atticDirs[path]
-            self.__save()
+            self.__commit(delete=[("atticDirs", path)], sync=True)
 
     def getAtticDirectories(self):
         if self.__createdWithVersion < self.VERSION_SINCE_ATTIC_TRACKED:
@@ -312,12 +458,16 @@ class _BobState():
             "jobs" : {},
             "byNameDirs" : {},
         }
-        self.__save()
+        self.__commit([("jenkins", name, config)])
 
     def delJenkins(self, name):
         if name in self.__jenkins:
+            j = self.__jenkins[name]
             del self.__jenkins[name]
-            self.__save()
+            delete = [("jenkins", name)]
+            delete.extend(("jenkinsJobs:" + name, k) for k in j["jobs"])
+            delete.extend(("jenkinsDirs:" + name, k) for k in j.get("byNameDirs", {}))
+            self.__commit(delete=delete)
 
     def getJenkinsByNameDirectory(self, jenkins, baseDir, digest):
         byNameDirs = self.__jenkins[jenkins].setdefault('byNameDirs', {})
@@ -328,7 +478,8 @@ class _BobState():
             res = "{}/{}".format(baseDir, num)
             byNameDirs[baseDir] = num
             byNameDirs[digest] = res
-            self.__save()
+            self.__commit([("jenkinsDirs:" + jenkins, baseDir, num),
+                           ("jenkinsDirs:" + jenkins, digest, res)])
             return res
 
     def getJenkinsConfig(self, name):
@@ -336,29 +487,29 @@ class _BobState():
 
     def setJenkinsConfig(self, name, config):
         self.__jenkins[name]["config"] = copy.deepcopy(config)
-        self.__save()
+        self.__commit([("jenkins", name, config)])
 
     def getJenkinsAllJobs(self, name):
         return set(self.__jenkins[name]["jobs"].keys())
 
     def addJenkinsJob(self, jenkins, job, jobConfig):
         self.__jenkins[jenkins]["jobs"][job] = copy.deepcopy(jobConfig)
-        self.__save()
+        self.__commit([("jenkinsJobs:" + jenkins, job, jobConfig)])
 
     def delJenkinsJob(self, jenkins, job):
         del self.__jenkins[jenkins]["jobs"][job]
-        self.__save()
+        self.__commit(delete=[("jenkinsJobs:" + jenkins, job)])
 
     def getJenkinsJobConfig(self, jenkins, job):
         return copy.deepcopy(self.__jenkins[jenkins]['jobs'][job])
 
     def setJenkinsJobConfig(self, jenkins, job, jobConfig):
         self.__jenkins[jenkins]['jobs'][job] = copy.deepcopy(jobConfig)
-        self.__save()
+        self.__commit([("jenkinsJobs:" + jenkins, job, jobConfig)])
 
     def setBuildState(self, digest2Dir):
         self.__buildState = copy.deepcopy(digest2Dir)
-        self.__save()
+        self.__commit([("meta", "buildState", digest2Dir)])
 
     def getBuildState(self):
         return copy.deepcopy(self.__buildState)
@@ -386,6 +537,62 @@ class _BobState():
         except sqlite3.Error as e:
             raise ParseError("Cannot access buildid cache: " + str(e))
 
+    def getFingerprint(self, key, host, maxAge):
+        """Get cached result of fingerprint script.
+
+        The result is only returned if it was calculated on the same host
+        environment and is not older than maxAge seconds.
+        """
+        self.__openBIdCache()
+        try:
+            self.__buildIdCache.execute("SELECT host, stamp, value FROM fingerprints WHERE key=?", (key,))
+            ret = self.__buildIdCache.fetchone()
+        except sqlite3.Error as e:
+            raise ParseError("Cannot access buildid cache: " + str(e))
+        if ret is None or ret[0] != host: return None
+        if not (0 <= time.time() - ret[1] < maxAge): return None
+        return ret[2]
+
+    def setFingerprint(self, key, host, val):
+        self.__openBIdCache()
+        try:
+            self.__buildIdCache.execute("INSERT OR REPLACE INTO fingerprints VALUES (?, ?, ?, ?)",
+                (key, host, time.time(), val))
+        except sqlite3.Error as e:
+            raise ParseError("Cannot access buildid cache: " + str(e))
+
+    def isArtifactMissing(self, key, archive, maxAge):
+        """Check if an artifact was recently found to be missing.
+
+        The miss is only valid for the same archive configuration and if it
+        is not older than maxAge seconds.
+        """
+        self.__openBIdCache()
+        try:
+            self.__buildIdCache.execute("SELECT archive, stamp FROM artifactMisses WHERE key=?", (key,))
+            ret = self.__buildIdCache.fetchone()
+            if ret is None: return False
+            if ret[0] == archive and (0 <= time.time() - ret[1] < maxAge): return True
+            self.__buildIdCache.execute("DELETE FROM artifactMisses WHERE key=?", (key,))
+            return False
+        except sqlite3.Error as e:
+            raise ParseError("Cannot access buildid cache: " + str(e))
+
+    def setArtifactMissing(self, key, archive):
+        self.__openBIdCache()
+        try:
+            self.__buildIdCache.execute("INSERT OR REPLACE INTO artifactMisses VALUES (?, ?, ?)",
+                (key, archive, time.time()))
+        except sqlite3.Error as e:
+            raise ParseError("Cannot access buildid cache: " + str(e))
+
+    def delArtifactMissing(self, key):
+        self.__openBIdCache()
+        try:
+            self.__buildIdCache.execute("DELETE FROM artifactMisses WHERE key=?", (key,))
+        except sqlite3.Error as e:
+            raise ParseError("Cannot access buildid cache: " + str(e))
+
 def BobState():
     if _BobState.instance is None:
         _BobState.instance = _BobState()
@@ -4,16 +4,22 @@
 # SPDX-License-Identifier: GPL-3.0-or-later
 
 from .errors import BuildError, ParseError
+from .journal import ChangeJournal
 from binascii import hexlify
 from tempfile import NamedTemporaryFile
 import collections
+import concurrent.futures
 import hashlib
+import itertools
 import logging
+import mmap
 import os
 import shutil
 import stat
 import struct
 import sys
+import time
+import zlib
 
 def hashString(string):
     h = hashlib.md5()
@@ -114,8 +120,46 @@ def isWindows():
 
 ### directory hashing ###
 
-def hashFile(path):
-    m = hashlib.sha1()
+class _TruncatedHash:
+    """Hash object wrapper that truncates the digest to 20 bytes."""
+
+    def __init__(self, h):
+        self.__h = h
+
+    def update(self, data):
+        self.__h.update(data)
+
+    def digest(self):
+        return self.__h.digest()[:20]
+
+def _sha256(data=b''):
+    return _TruncatedHash(hashlib.sha256(data))
+
+def _blake2b(data=b''):
+    return hashlib.blake2b(data, digest_size=20)
+
+# All algorithms produce 20 byte digests so that build-ids keep their size.
+# The tags are used to version the hash index and the archive generation.
+HASH_ALGORITHMS = {
+    # name      : (constructor, index tag, archive generation tag)
+    'sha1'      : (hashlib.sha1, b'sha1', ''),
+    'sha256'    : (_sha256,      b's256', 's256'),
+    'blake2b'   : (_blake2b,     b'b2b\0', 'b2b'),
+}
+
+def getHashAlgorithm(name):
+    """Get constructor of hash algorithm.
+
+    The returned hash objects produce 20 byte digests.
+    """
+    if name not in HASH_ALGORITHMS:
+        raise ParseError("Unknown hash algorithm: " + name)
+    if name == 'blake2b' and not hasattr(hashlib, 'blake2b'):
+        raise ParseError("Hash algorithm 'blake2b' requires at least Python 3.6!")
+    return HASH_ALGORITHMS[name][0]
+
+def hashFile(path, hasher=hashlib.sha1):
+    m = hasher()
     try:
         with open(path, 'rb', buffering=0) as f:
             buf = f.read(16384)
@@ -140,117 +184,347 @@ class DirHasher:
     ])
 
     class FileIndex:
-        SIGNATURE        = b'BOB1'
-        CACHE_ENTRY_FMT  = '=QQLqLQ20sH'
-        CACHE_ENTRY_SIZE = struct.calcsize(CACHE_ENTRY_FMT)
-
-        class Stat:
-            def __init__(self):
-                self.name = b""
-                self.ctime = 0
-                self.mtime = 0
-                self.dev = 0
-                self.ino = 0
-                self.mode = 0
-                self.size = 0
-                self.digest = b''
-
-            def __repr__(self):
-                return "Stat(name={}, ctime={}, mtime={}, dev={}, ino={}, mode={}, size={}, digest={})".format(
-                    self.name, self.ctime, self.mtime, self.dev, self.ino, self.mode, self.size, self.digest)
-
-        def __init__(self, cachePath):
+        """Memory mapped index of file digests.
+
+        The index consists of a header, a table of fixed size records that
+        is sorted by the entry name and a blob of all names. The table is
+        searched by bisection, starting at the last position because the
+        directory walk looks up entries in sorted order. Changed entries
+        are updated in place. New entries are appended to a separate log
+        file. A checksum on every record detects partially written updates.
+        The index is only rewritten if the log or the number of stale
+        entries grows too big.
+
+        Besides files and symlinks the index holds the digests of directories.
+        Their entry names have a trailing path separator. Directory entries
+        hold the stat of the directory and a fingerprint of its direct
+        children in the 'aux' field. The header additionally stores how far
+        the change journal was consumed (see bob.journal).
+        """
+
+        SIGNATURE    = b'BOB5'          # followed by tag of hash algorithm
+        HEADER_FMT   = '=8sLQQQ'        # signature, entries, generation, journal token/offset
+        HEADER_SIZE  = struct.calcsize(HEADER_FMT)
+        JOURNAL_FMT  = '=QQ'
+        JOURNAL_OFFSET = struct.calcsize('=8sLQ')
+        RECORD_FMT   = '=LH'            # name offset, name length
+        RECORD_STAT  = 'QQQqLQ20sQ'     # ctime, mtime, dev, ino, mode, size, digest, aux
+        STAT_FMT     = '=' + RECORD_STAT + 'L'  # ...crc32
+        RECORD_SIZE  = struct.calcsize(RECORD_FMT + RECORD_STAT + 'L')
+        STAT_OFFSET  = struct.calcsize(RECORD_FMT)
+        STAT_SIZE    = struct.calcsize(STAT_FMT)
+
+        LOG_SIGNATURE  = b'BOBL'
+        LOG_HEADER_FMT = '=4sQ'         # signature, generation
+        LOG_HEADER_SIZE = struct.calcsize(LOG_HEADER_FMT)
+        LOG_ENTRY_FMT  = '=H' + RECORD_STAT  # name length, stat, digest, aux
+        LOG_ENTRY_SIZE = struct.calcsize(LOG_ENTRY_FMT)
+
+        # Compaction thresholds
+        LOG_MIN_ENTRIES = 256
+
+        SEP = os.fsencode(os.path.sep)
+        SEP_NEXT = bytes([SEP[0] + 1])
+
+        def __init__(self, cachePath, algorithm='sha1'):
+            self.__signature = DirHasher.FileIndex.SIGNATURE + HASH_ALGORITHMS[algorithm][1]
             self.__cachePath = cachePath
             self.__cacheDir = os.path.dirname(cachePath)
-
-        def open(self):
-            self.__inPos = 0
-            self.__inPosOld = 0
-            self.__outFile = None
-            self.__current = DirHasher.FileIndex.Stat()
+            self.__logPath = cachePath + ".log"
+
+        def open(self, readOnly=False):
+            self.__readOnly = readOnly
+            self.__file = None
+            self.__mm = None
+            self.__entries = 0
+            self.__generation = None
+            self.__journal = (0, 0)
+            self.__cursor = 0
+            self.__log = {}
+            self.__logVisited = set()
+            self.__logFile = None
+            self.__logSize = 0
             try:
-                if os.path.exists(self.__cachePath):
-                    self.__inFile = open(self.__cachePath, "rb")
-                    sig = self.__inFile.read(4)
-                    if sig == DirHasher.FileIndex.SIGNATURE:
-                        self.__mismatch = False
-                        self.__inPos = self.__inPosOld = 4
-                        self.__readEntry() # prefetch first entry
-                    else:
-                        logging.getLogger(__name__).info(
-                            "Wrong signature at '%s': %s", self.__cachePath, sig)
-                        self.__inFile.close()
-                        self.__inFile = None
-                        self.__mismatch = True
-                else:
-                    self.__inFile = None
-                    self.__mismatch = True
+                self.__openIndex()
+                if self.__generation is not None:
+                    self.__openLog()
             except OSError as e:
+                self.__closeFiles()
                 raise BuildError("Error opening hash cache: " + str(e))
+            self.__visited = bytearray(self.__entries)
+
+        def __openIndex(self):
+            try:
+                self.__file = open(self.__cachePath, "rb" if self.__readOnly else "r+b")
+            except FileNotFoundError:
+                return
+            header = self.__file.read(DirHasher.FileIndex.HEADER_SIZE)
+            if len(header) < DirHasher.FileIndex.HEADER_SIZE:
+                sig = header
+            else:
+                (sig, entries, generation, journalToken, journalOffset) = \
+                    struct.unpack(DirHasher.FileIndex.HEADER_FMT, header)
+            if sig != self.__signature:
+                logging.getLogger(__name__).info(
+                    "Wrong signature at '%s': %s", self.__cachePath, sig)
+                self.__file.close()
+                self.__file = None
+                return
+
+            self.__mm = mmap.mmap(self.__file.fileno(), 0,
+                access=mmap.ACCESS_READ if self.__readOnly else mmap.ACCESS_WRITE)
+            if len(self.__mm) < (DirHasher.FileIndex.HEADER_SIZE +
+                                 entries * DirHasher.FileIndex.RECORD_SIZE):
+                logging.getLogger(__name__).info(
+                    "Truncated hash cache at '%s'", self.__cachePath)
+                self.__mm.close()
+                self.__mm = None
+                self.__file.close()
+                self.__file = None
+                return
+
+            self.__entries = entries
+            self.__generation = generation
+            self.__journal = (journalToken, journalOffset)
+
+        def __openLog(self):
+            try:
+                with open(self.__logPath, "rb") as f:
+                    log = f.read()
+            except FileNotFoundError:
+                return
+            if len(log) < DirHasher.FileIndex.LOG_HEADER_SIZE: return
+            (sig, generation) = struct.unpack_from(DirHasher.FileIndex.LOG_HEADER_FMT, log)
+            if sig != DirHasher.FileIndex.LOG_SIGNATURE or generation != self.__generation:
+                return
+
+            # Read all complete entries. Later entries supersede earlier ones.
+            # Parsing stops at the first partially written record.
+            pos = DirHasher.FileIndex.LOG_HEADER_SIZE
+            while pos + DirHasher.FileIndex.LOG_ENTRY_SIZE <= len(log):
+                raw = struct.unpack_from(DirHasher.FileIndex.LOG_ENTRY_FMT, log, pos)
+                end = pos + DirHasher.FileIndex.LOG_ENTRY_SIZE + raw[0] + 4
+                if end > len(log): break
+                (crc,) = struct.unpack_from("=L", log, end - 4)
+                if crc != zlib.crc32(log[pos:end-4]): break
+                name = log[pos + DirHasher.FileIndex.LOG_ENTRY_SIZE:end-4]
+                self.__log[name] = (raw[1:7], raw[7], raw[8])
+                pos = end
+            self.__logSize = pos
+
+        def __closeFiles(self):
+            if self.__mm is not None:
+                self.__mm.close()
+                self.__mm = None
+            if self.__file is not None:
+                self.__file.close()
+                self.__file = None
+            if self.__logFile is not None:
+                self.__logFile.close()
+                self.__logFile = None
 
         def close(self):
             try:
-                if self.__inFile:
-                    self.__inFile.close()
-                if self.__outFile:
-                    self.__outFile.close()
-                    os.replace(self.__outFile.name, self.__cachePath)
+                if not self.__readOnly and self.__needCompaction():
+                    self.__compact()
+                self.__closeFiles()
             except OSError as e:
+                self.__closeFiles()
                 raise BuildError("Error closing hash cache: " + str(e))
 
-        def __readEntry(self):
-            if not self.__inFile: return False
-            raw = self.__inFile.read(DirHasher.FileIndex.CACHE_ENTRY_SIZE)
-            if len(raw) < DirHasher.FileIndex.CACHE_ENTRY_SIZE: return False
-            e = self.__current
-            (e.ctime, e.mtime, e.dev, e.ino, e.mode, e.size, e.digest,
-                nameLen) = struct.unpack(DirHasher.FileIndex.CACHE_ENTRY_FMT, raw)
-            e.name = self.__inFile.read(nameLen)
-            self.__inPosOld = self.__inPos
-            self.__inPos += DirHasher.FileIndex.CACHE_ENTRY_SIZE + nameLen
-            return True
-
-        def __writeEntry(self, name, st, digest):
-            if not self.__outFile:
-                self.__outFile = NamedTemporaryFile(mode="wb", dir=self.__cacheDir, delete=False)
-                if self.__inFile:
-                    pos = self.__inFile.tell()
-                    self.__inFile.seek(0)
-                    self.__outFile.write(self.__inFile.read(self.__inPosOld))
-                    self.__inFile.seek(pos)
+        def __needCompaction(self):
+            if self.__mm is None:
+                # No valid index yet. Create one if anything was hashed.
+                return bool(self.__log)
+            stale = self.__entries - self.__visited.count(1)
+            staleLog = len(self.__log) - len(self.__logVisited)
+            return ((len(self.__log) > max(DirHasher.FileIndex.LOG_MIN_ENTRIES,
+                                           self.__entries // 8)) or
+                    (stale + staleLog > self.__entries // 4))
+
+        def __compact(self):
+            entries = [ (name, ) + self.__log[name] for name in self.__logVisited ]
+            for i in range(self.__entries):
+                if not self.__visited[i]: continue
+                cached = self.__readRecord(i)
+                if cached is None: continue
+                entries.append((self.__nameAt(i), ) + cached)
+            entries.sort(key=lambda e: e[0])
+
+            generation = struct.unpack("=Q", os.urandom(8))[0]
+            with NamedTemporaryFile(mode="wb", dir=self.__cacheDir, delete=False) as f:
+                f.write(struct.pack(DirHasher.FileIndex.HEADER_FMT,
+                    self.__signature, len(entries), generation,
+                    *self.__journal))
+                nameOff = (DirHasher.FileIndex.HEADER_SIZE +
+                    len(entries) * DirHasher.FileIndex.RECORD_SIZE)
+                for (name, key, digest, aux) in entries:
+                    stat = struct.pack(DirHasher.FileIndex.STAT_FMT[:-1],
+                                       *(key + (digest, aux)))
+                    f.write(struct.pack(DirHasher.FileIndex.RECORD_FMT, nameOff, len(name)))
+                    f.write(stat)
+                    f.write(struct.pack("=L", zlib.crc32(stat)))
+                    nameOff += len(name)
+                for e in entries:
+                    f.write(e[0])
+            self.__closeFiles()
+            os.replace(f.name, self.__cachePath)
+            try:
+                os.unlink(self.__logPath)
+            except FileNotFoundError:
+                pass
+
+        def __nameAt(self, i):
+            (off, length) = struct.unpack_from(DirHasher.FileIndex.RECORD_FMT, self.__mm,
+                DirHasher.FileIndex.HEADER_SIZE + i * DirHasher.FileIndex.RECORD_SIZE)
+            return self.__mm[off:off+length]
+
+        def __readRecord(self, i):
+            pos = (DirHasher.FileIndex.HEADER_SIZE + i * DirHasher.FileIndex.RECORD_SIZE +
+                   DirHasher.FileIndex.STAT_OFFSET)
+            raw = self.__mm[pos:pos+DirHasher.FileIndex.STAT_SIZE]
+            res = struct.unpack(DirHasher.FileIndex.STAT_FMT, raw)
+            if res[8] != zlib.crc32(raw[:-4]):
+                # torn update
+                return None
+            return (res[0:6], res[6], res[7])
+
+        def __writeRecord(self, i, key, digest, aux):
+            pos = (DirHasher.FileIndex.HEADER_SIZE + i * DirHasher.FileIndex.RECORD_SIZE +
+                   DirHasher.FileIndex.STAT_OFFSET)
+            stat = struct.pack(DirHasher.FileIndex.STAT_FMT[:-1], *(key + (digest, aux)))
+            self.__mm[pos:pos+DirHasher.FileIndex.STAT_SIZE] = stat + \
+                struct.pack("=L", zlib.crc32(stat))
+
+        def __appendLog(self, name, key, digest, aux):
+            self.__log[name] = (key, digest, aux)
+            if self.__mm is None:
+                # Index is created from scratch when closing it
+                return
+            if self.__logFile is None:
+                if self.__logSize:
+                    self.__logFile = open(self.__logPath, "r+b")
+                    self.__logFile.seek(self.__logSize)
+                    self.__logFile.truncate()
                 else:
-                    self.__outFile.write(DirHasher.FileIndex.SIGNATURE)
-            self.__outFile.write(struct.pack(DirHasher.FileIndex.CACHE_ENTRY_FMT, float2ns(st.st_ctime),
-                float2ns(st.st_mtime), st.st_dev, st.st_ino, st.st_mode, st.st_size,
-                digest, len(name)))
-            self.__outFile.write(name)
-
-        def __match(self, name, st):
-            while self.__current.name < name:
-                if not self.__readEntry(): break
-            e = self.__current
-            res = ((e.name == name) and (e.ctime == float2ns(st.st_ctime)) and
-                (e.mtime == float2ns(st.st_mtime)) and (e.dev == st.st_dev) and
-                (e.ino == st.st_ino) and (e.mode == st.st_mode) and
-                (e.size == st.st_size))
-            #if not res: print("Mismatch", e.name, name, e, st)
-            return res
+                    self.__logFile = open(self.__logPath, "wb")
+                    self.__logFile.write(struct.pack(DirHasher.FileIndex.LOG_HEADER_FMT,
+                        DirHasher.FileIndex.LOG_SIGNATURE, self.__generation))
+            entry = struct.pack(DirHasher.FileIndex.LOG_ENTRY_FMT, len(name),
+                                *(key + (digest, aux))) + name
+            self.__logFile.write(entry + struct.pack("=L", zlib.crc32(entry)))
+
+        def __bisect(self, name, lo=0):
+            hi = self.__entries
+            while lo < hi:
+                mid = (lo + hi) // 2
+                if self.__nameAt(mid) < name:
+                    lo = mid + 1
+                else:
+                    hi = mid
+            return lo
+
+        def __find(self, name):
+            """Find table slot of 'name'.
+
+            Entries are usually looked up in sorted order. Try the next entry
+            first before falling back to a binary search.
+            """
+            lo = 0
+            i = self.__cursor
+            if i < self.__entries:
+                n = self.__nameAt(i)
+                if n == name:
+                    self.__cursor = i+1
+                    return i
+                elif n < name:
+                    lo = i+1
+            i = self.__bisect(name, lo)
+            self.__cursor = i
+            if i < self.__entries and self.__nameAt(i) == name:
+                self.__cursor = i+1
+                return i
+            return None
+
+        def __get(self, name):
+            slot = self.__find(name)
+            if slot is not None:
+                self.__visited[slot] = 1
+                return (slot, self.__readRecord(slot))
+            cached = self.__log.get(name)
+            if cached is not None: self.__logVisited.add(name)
+            return (None, cached)
+
+        def __put(self, slot, name, key, digest, aux=0):
+            if self.__readOnly: return
+            if slot is not None:
+                self.__writeRecord(slot, key, digest, aux)
+            else:
+                self.__appendLog(name, key, digest, aux)
+                self.__logVisited.add(name)
+
+        def __keep(self, path):
+            """Keep all entries below 'path' in the index."""
+            if path:
+                prefix = path + DirHasher.FileIndex.SEP
+                lo = self.__bisect(prefix)
+                hi = self.__bisect(path + DirHasher.FileIndex.SEP_NEXT, lo)
+                self.__logVisited.update(n for n in self.__log if n.startswith(prefix))
+            else:
+                lo = 0
+                hi = self.__entries
+                self.__logVisited.update(self.__log)
+            self.__visited[lo:hi] = b'\x01' * (hi - lo)
 
         def check(self, prefix, name, st, process):
-            if self.__match(name, st):
-                digest = self.__current.digest
-            else:
-                digest = process(os.path.join(prefix, name) if name else prefix)
-                self.__mismatch = True
-            if self.__mismatch:
-                self.__writeEntry(name, st, digest)
+            key = _statTuple(st)
+            (slot, cached) = self.__get(name)
+            if (cached is not None) and (cached[0] == key):
+                return cached[1]
+            digest = process(os.path.join(prefix, name) if name else prefix)
+            self.__put(slot, name, key, digest)
             return digest
 
+        def getDir(self, path):
+            """Get cached (stat, digest, fingerprint) tuple of directory."""
+            return self.__get(path + DirHasher.FileIndex.SEP)[1]
+
+        def keepDir(self, path):
+            """Keep all entries of a reused directory in the index.
+
+            The entries are not visited but are still valid.
+            """
+            self.__keep(path)
+
+        def putDir(self, path, key, digest, fingerprint):
+            name = path + DirHasher.FileIndex.SEP
+            (slot, cached) = self.__get(name)
+            if cached != (key, digest, fingerprint):
+                self.__put(slot, name, key, digest, fingerprint)
+
+        def readJournalState(self):
+            """Read journal token and offset without opening the index."""
+            try:
+                with open(self.__cachePath, "rb") as f:
+                    header = f.read(DirHasher.FileIndex.HEADER_SIZE)
+            except OSError:
+                return (0, 0)
+            if len(header) < DirHasher.FileIndex.HEADER_SIZE: return (0, 0)
+            header = struct.unpack(DirHasher.FileIndex.HEADER_FMT, header)
+            if header[0] != self.__signature: return (0, 0)
+            return header[3:5]
+
+        def setJournalState(self, token, offset):
+            self.__journal = (token, offset)
+            if self.__mm is not None and not self.__readOnly:
+                struct.pack_into(DirHasher.FileIndex.JOURNAL_FMT, self.__mm,
+                    DirHasher.FileIndex.JOURNAL_OFFSET, token, offset)
+
     class NullIndex:
         def __init__(self):
             pass
 
-        def open(self):
+        def open(self, readOnly=False):
             pass
 
         def close(self):
@@ -259,23 +533,47 @@ class DirHasher:
         def check(self, prefix, name, st, process):
             return process(os.path.join(prefix, name) if name else prefix)
 
-    def __init__(self, basePath=None, ignoreDirs=None):
+        def getDir(self, path):
+            return None
+
+        def keepDir(self, path):
+            pass
+
+        def putDir(self, path, key, digest, fingerprint):
+            pass
+
+    # Minimum number of files that need to be hashed before a process pool is
+    # used. Below that the overhead of spawning the workers does not pay off.
+    PARALLEL_THRESHOLD = 64
+
+    # Directories modified within this time before they were hashed are racy
+    RACY_NS = 2 * 1000000000
+    RACY_FLAG = 0x80000000
+
+    def __init__(self, basePath=None, ignoreDirs=None, jobs=1, algorithm='sha1'):
+        self.__hasher = getHashAlgorithm(algorithm)
+        self.__algorithm = algorithm
         if basePath:
-            self.__index = DirHasher.FileIndex(basePath)
+            self.__index = DirHasher.FileIndex(basePath, algorithm)
+            self.__journal = ChangeJournal(basePath + ".journal")
         else:
             self.__index = DirHasher.NullIndex()
+            self.__journal = None
         if ignoreDirs:
             self.__ignoreDirs = DirHasher.IGNORE_DIRS | frozenset(os.fsencode(i) for i in ignoreDirs)
         else:
             self.__ignoreDirs = DirHasher.IGNORE_DIRS
+        self.__jobs = max(jobs, 1)
+        self.__hashFile = self.__hashFileDefault
+        self.__dirty = None
 
-    def __hashEntry(self, prefix, entry, s):
+    def __hashEntry(self, prefix, entry, s, guided=False):
         if stat.S_ISREG(s.st_mode):
-            digest = self.__index.check(prefix, entry, s, hashFile)
+            digest = self.__index.check(prefix, entry, s, self.__hashFile)
         elif stat.S_ISDIR(s.st_mode):
-            digest = self.__hashDir(prefix, entry)
+            digest = self.__hashDir(prefix, entry, guided, s)
         elif stat.S_ISLNK(s.st_mode):
-            digest = self.__index.check(prefix, entry, s, DirHasher.__hashLink)
+            digest = self.__index.check(prefix, entry, s, self.__hashLink)
         elif stat.S_ISBLK(s.st_mode) or stat.S_ISCHR(s.st_mode):
             digest = struct.pack("<L", s.st_rdev)
         elif stat.S_ISFIFO(s.st_mode):
@@ -286,16 +584,18 @@ class DirHasher:
 
         return digest
 
-    @staticmethod
-    def __hashLink(path):
-        m = hashlib.sha1()
+    def __hashFileDefault(self, path):
+        return hashFile(path, self.__hasher)
+
+    def __hashLink(self, path):
+        m = self.__hasher()
         try:
             m.update(os.readlink(path))
         except OSError as e:
             logging.getLogger(__name__).warning("Cannot hash link: %s", str(e))
         return m.digest()
 
-    def __hashDir(self, prefix, path=b''):
+    def __listDir(self, prefix, path):
         entries = []
         try:
             dirEntries = os.listdir(os.path.join(prefix, path if path else b'.'))
@@ -318,22 +618,172 @@ class DirHasher:
                 entries.append((e, f, s))
             except OSError as err:
                 logging.getLogger(__name__).warning("Cannot stat '%s': %s", e, str(err))
-        entries = sorted(entries, key=lambda x: x[1])
+        return sorted(entries, key=lambda x: x[1])
+
+    @staticmethod
+    def __fingerprint(entries):
+        """Calculate fingerprint of the names and stat of directory entries."""
+        m = hashlib.sha1()
+        for (e, f, s) in entries:
+            m.update(f + struct.pack("=QQQqLQ", *_statTuple(s)))
+        return struct.unpack_from("=Q", m.digest())[0]
+
+    def __reuseDir(self, prefix, path, st):
+        """Try to reuse the cached directory digest.
+
+        The stat of the directory must not have changed. If the directory was
+        modified shortly before it was recorded the stat is not reliable and
+        the fingerprint of the directory entries is checked instead.
+        """
+        cached = self.__index.getDir(path)
+        if cached is None or st is None: return None
+        (key, digest, fingerprint) = cached
+        cur = _statTuple(st)
+        if key[4] & DirHasher.RACY_FLAG:
+            if key[:4] + (key[4] & ~DirHasher.RACY_FLAG, ) + key[5:] != cur: return None
+            if DirHasher.__fingerprint(self.__listDir(prefix, path)) != fingerprint:
+                return None
+            self.__index.putDir(path, self.__dirKey(st), digest, fingerprint)
+        elif key != cur:
+            return None
+        self.__index.keepDir(path)
+        return digest
+
+    @staticmethod
+    def __dirKey(st):
+        """Get index key of directory and flag it if its stat is racy.
+
+        Directories that were modified within the timestamp granularity of
+        the file system could still change without a visible stat change.
+        """
+        key = _statTuple(st)
+        if float2ns(time.time()) - key[1] < DirHasher.RACY_NS:
+            key = key[:4] + (key[4] | DirHasher.RACY_FLAG, ) + key[5:]
+        return key
+
+    def __hashDir(self, prefix, path=b'', guided=False, st=None):
+        # If guided by the change journal only dirty directories and their
+        # parents are listed. Everything else is taken from the index if
+        # the directory is unchanged.
+        if guided:
+            if path in self.__dirty:
+                guided = False
+            elif path not in self.__dirtyParents:
+                digest = self.__reuseDir(prefix, path, st)
+                if digest is not None: return digest
+                guided = False
+
+        entries = self.__listDir(prefix, path)
         dirList = [
-            (struct.pack("=L", s.st_mode) + self.__hashEntry(prefix, e, s) + f)
+            (struct.pack("=L", s.st_mode) + self.__hashEntry(prefix, e, s, guided) + f)
             for (e, f, s) in entries
         ]
         dirBlob = b"".join(dirList)
-        m = hashlib.sha1()
+        m = self.__hasher()
         m.update(dirBlob)
-        return m.digest()
+        digest = m.digest()
+        if st is not None:
+            self.__index.putDir(path, self.__dirKey(st), digest,
+                                DirHasher.__fingerprint(entries))
+        return digest
 
-    def hashDirectory(self, path):
+    def __setDirty(self, dirty):
+        self.__dirty = dirty
+        self.__dirtyParents = parents = set()
+        if dirty is None: return
+        for p in dirty:
+            while p:
+                p = os.path.dirname(p)
+                if p in parents: break
+                parents.add(p)
+
+    def __walk(self, walker, journal=None):
+        if self.__jobs > 1 and self.__hashFile == self.__hashFileDefault:
+            self.__prehash(walker)
         self.__index.open()
         try:
-            return self.__hashDir(os.fsencode(path))
+            ret = walker()
+            if journal is not None:
+                self.__index.setJournalState(journal[0], journal[1])
+            return ret
         finally:
             self.__index.close()
+            self.__hashFile = self.__hashFileDefault
+
+    def __prehash(self, walker):
+        """Calculate the digests of all unknown files in parallel.
+
+        The tree is walked once with a read-only index to collect all files
+        whose digest is not cached. These files are then hashed by a process
+        pool. The regular walk afterwards picks up the pre-calculated digests
+        so that the result is identical to the sequential hashing.
+        """
+        todo = []
+        def collect(path):
+            todo.append(path)
+            return b''
+
+        self.__hashFile = collect
+        self.__index.open(True)
+        try:
+            walker()
+        finally:
+            self.__index.close()
+            self.__hashFile = self.__hashFileDefault
+
+        if len(todo) < DirHasher.PARALLEL_THRESHOLD: return
+
+        with concurrent.futures.ProcessPoolExecutor(max_workers=self.__jobs) as executor:
+            chunk = max(1, min(256, len(todo) // (self.__jobs * 8)))
+            digests = dict(zip(todo, executor.map(_hashFileStat, todo,
+                itertools.repeat(self.__algorithm), chunksize=chunk)))
+
+        def lookup(path):
+            (before, digest) = digests.pop(path, (None, None))
+            # Fall back to sequential hashing if the file was modified in the
+            # meantime.
+            if (before is None) or (before != _statKey(path)):
+                digest = hashFile(path, self.__hasher)
+            return digest
+        self.__hashFile = lookup
+
+    def __useKnownDigests(self, path, digests):
+        """Take file digests from 'digests' instead of reading the files.
+
+        The dict is indexed by the file names relative to 'path'. Files that
+        are not in the dict are hashed regularly.
+        """
+        prefixLen = len(os.path.join(path, b''))
+        def lookup(name):
+            digest = digests.get(name[prefixLen:])
+            if digest is None:
+                digest = hashFile(name, self.__hasher)
+            return digest
+        self.__hashFile = lookup
+
+    def hashDirectory(self, path, digests=None):
+        """Calculate digest of directory.
+
+        The file digests can optionally be provided by 'digests' if they are
+        already known, e.g. because the files were just written. They are
+        recorded in the index as if the files had been read.
+        """
+        path = os.fsencode(path)
+        if digests is not None:
+            self.__useKnownDigests(path, digests)
+        if self.__journal is not None:
+            (token, offset) = self.__index.readJournalState()
+            journal = self.__journal.read(path, token, offset)
+            self.__setDirty(journal[2])
+        else:
+            journal = None
+            self.__setDirty(None)
+        try:
+            st = os.lstat(path)
+        except OSError:
+            st = None
+        return self.__walk(lambda: self.__hashDir(path, b'', self.__dirty is not None, st),
+                           journal)
 
     def hashPath(self, path):
         path = os.fsencode(path)
@@ -343,18 +793,32 @@ class DirHasher:
             logging.getLogger(__name__).warning("Cannot stat '%s': %s", path, str(err))
             return b''
 
-        self.__index.open()
-        try:
-            return self.__hashEntry(path, b'', s)
-        finally:
-            self.__index.close()
+        if stat.S_ISDIR(s.st_mode):
+            return self.hashDirectory(path)
+        self.__setDirty(None)
+        return self.__walk(lambda: self.__hashEntry(path, b'', s))
+
+def _statTuple(st):
+    return (float2ns(st.st_ctime), float2ns(st.st_mtime), st.st_dev,
+            st.st_ino, st.st_mode, st.st_size)
+
+def _statKey(path):
+    try:
+        return _statTuple(os.lstat(path))
+    except OSError:
+        return None
 
+def _hashFileStat(path, algorithm):
+    """Hash file in worker process and return stat before hashing."""
+    before = _statKey(path)
+    return (before, hashFile(path, getHashAlgorithm(algorithm)))
 
-def hashDirectory(path, index=None, ignoreDirs=None):
-    return DirHasher(index, ignoreDirs).hashDirectory(path)
+def hashDirectory(path, index=None, ignoreDirs=None, jobs=1, algorithm='sha1',
+                  digests=None):
+    return DirHasher(index, ignoreDirs, jobs, algorithm).hashDirectory(path, digests)
 
-def hashPath(path, index=None, ignoreDirs=None):
-    return DirHasher(index, ignoreDirs).hashPath(path)
+def hashPath(path, index=None, ignoreDirs=None, jobs=1, algorithm='sha1'):
+    return DirHasher(index, ignoreDirs, jobs, algorithm).hashPath(path)
 
 def binStat(path):
     st = os.stat(path)
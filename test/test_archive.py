@@ -8,6 +8,9 @@ from tempfile import NamedTemporaryFile, TemporaryDirectory
 from unittest import TestCase
 from unittest.mock import MagicMock, patch
 import asyncio
+import errno
+import glob
+import gzip
 import http.server
 import os, os.path
 import socketserver
@@ -15,9 +18,19 @@ import stat
 import subprocess
 import tarfile
 import threading
+import time
+import unittest
 
-from bob.archive import DummyArchive, SimpleHttpArchive, getArchiver
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+
+from bob.archive import ArtifactCache, ArtifactPrefetcher, DummyArchive, \
+    LocalArchive, MultiArchive, ParallelGzipWriter, SimpleHttpArchive, UploadQueue, \
+    getArchiver
 from bob.errors import BuildError
+from bob.utils import hashDirectory
 
 DOWNLOAD_ARITFACT = b'\x00'*20
 NOT_EXISTS_ARTIFACT = b'\x01'*20
@@ -133,7 +146,7 @@ class BaseTester:
         with open(os.path.join(workspace, "data"), "rb") as f:
             self.assertEqual(f.read(), b'DATA')
 
-    def __getArchiveInstance(self, spec):
+    def __getArchiveInstance(self, spec, algorithm="sha1"):
         # let concrete class amend properties
         self._setArchiveSpec(spec)
 
@@ -144,6 +157,8 @@ class BaseTester:
         recipes.archiveSpec.return_value = [ { 'backend' : 'none' }, spec ]
         recipes.envWhiteList = MagicMock()
         recipes.envWhiteList.return_value = []
+        recipes.getHashAlgorithm = MagicMock()
+        recipes.getHashAlgorithm.return_value = algorithm
         return getArchiver(recipes)
 
     def __getSingleArchiveInstance(self, spec):
@@ -154,6 +169,8 @@ class BaseTester:
         recipes.archiveSpec.return_value = spec
         recipes.envWhiteList = MagicMock()
         recipes.envWhiteList.return_value = []
+        recipes.getHashAlgorithm = MagicMock()
+        recipes.getHashAlgorithm.return_value = "sha1"
         return getArchiver(recipes)
 
     def setUp(self):
@@ -292,6 +309,126 @@ class BaseTester:
         ret = a.upload(None, "unused", "unused", "unused")
         self.assertEqual(ret, "")
 
+    def testDownloadHashed(self):
+        """Downloaded content is hashed while it is extracted"""
+
+        archive = self.__getArchiveInstance({})
+        archive.wantDownload(True)
+
+        with TemporaryDirectory() as tmp:
+            audit = os.path.join(tmp, "audit.json.gz")
+            content = os.path.join(tmp, "workspace")
+            index = os.path.join(tmp, "cache.bin")
+            self.assertTrue(run(archive.downloadPackage(DummyStep(), DOWNLOAD_ARITFACT,
+                b'', audit, content, index)))
+            self.__testWorkspace(audit, content)
+
+            # all digests must be taken from the index
+            with patch('bob.utils.hashFile', side_effect=AssertionError("file read")):
+                digest = hashDirectory(content, index)
+            self.assertEqual(digest, hashDirectory(content))
+
+    def testPrefetch(self):
+        """Prefetch artifacts and unpack them later"""
+
+        archive = self.__getArchiveInstance({})
+        archive.wantDownload(True)
+
+        cwd = os.getcwd()
+        with TemporaryDirectory() as tmp:
+            os.chdir(tmp)
+            try:
+                prefetcher = ArtifactPrefetcher(archive, 2, 1024*1024)
+                prefetcher.start()
+                self.assertTrue(run(prefetcher.prefetch(DummyStep(), DOWNLOAD_ARITFACT, b'')))
+                self.assertFalse(run(prefetcher.prefetch(DummyStep(), NOT_EXISTS_ARTIFACT, b'')))
+
+                # Not prefetched artifacts are not prefetched later anymore
+                self.assertIsNone(run(prefetcher.take(WRONG_VERSION_ARTIFACT, b'')))
+                self.assertIsNone(run(prefetcher.prefetch(DummyStep(), WRONG_VERSION_ARTIFACT, b'')))
+
+                audit = os.path.join(tmp, "audit.json.gz")
+                content = os.path.join(tmp, "workspace")
+                staged = run(prefetcher.take(DOWNLOAD_ARITFACT, b''))
+                self.assertTrue(os.path.isfile(staged))
+                self.assertTrue(run(prefetcher.unpack(DummyStep(), staged, audit, content)))
+                self.__testWorkspace(audit, content)
+                self.assertFalse(os.path.exists(staged))
+
+                self.assertFalse(run(prefetcher.take(NOT_EXISTS_ARTIFACT, b'')))
+                self.assertFalse(run(prefetcher.unpack(DummyStep(), False, audit, content)))
+
+                run(prefetcher.stop())
+                self.assertEqual([ d for d in os.listdir(tmp) if d.startswith(".bob-prefetch") ], [])
+            finally:
+                os.chdir(cwd)
+
+    def testArtifactCache(self):
+        """Artifacts are downloaded only once through the cache"""
+        stats = MagicMock(artifactCacheHits=0, artifactCacheMisses=0)
+        with TemporaryDirectory() as tmp:
+            cache = ArtifactCache(self.__getArchiveInstance({}), os.path.join(tmp, "cache"),
+                                  1024*1024, statistic=stats)
+            cache.wantDownload(True)
+
+            audit = os.path.join(tmp, "audit1.json.gz")
+            content = os.path.join(tmp, "workspace1")
+            self.assertTrue(run(cache.downloadPackage(DummyStep(), DOWNLOAD_ARITFACT,
+                b'', audit, content)))
+            self.__testWorkspace(audit, content)
+            self.assertFalse(run(cache.downloadPackage(DummyStep(), NOT_EXISTS_ARTIFACT,
+                b'', audit, content)))
+            self.assertEqual((stats.artifactCacheHits, stats.artifactCacheMisses), (0, 2))
+
+            # remove from archive, must be served from the cache
+            os.unlink(self.dummyFileName)
+            audit = os.path.join(tmp, "audit2.json.gz")
+            content = os.path.join(tmp, "workspace2")
+            self.assertTrue(run(cache.downloadPackage(DummyStep(), DOWNLOAD_ARITFACT,
+                b'', audit, content)))
+            self.__testWorkspace(audit, content)
+
+            staged = os.path.join(tmp, "staged")
+            self.assertTrue(run(cache.prefetchPackage(DummyStep(), DOWNLOAD_ARITFACT,
+                b'', staged, None, 0)))
+            self.assertTrue(os.path.isfile(staged))
+            self.assertEqual((stats.artifactCacheHits, stats.artifactCacheMisses), (2, 2))
+
+            # only the cached artifact is left
+            cached = [ os.path.join(root, f)
+                       for (root, dirs, files) in os.walk(os.path.join(tmp, "cache"))
+                       for f in files if f != ArtifactCache.LOCK_FILE ]
+            self.assertEqual(len(cached), 1)
+
+    def testProbe(self):
+        """Existence checks do not download anything"""
+        archive = self.__getSingleArchiveInstance({})
+        archive.wantDownload(True)
+
+        found = run(archive.probePackage(DOWNLOAD_ARITFACT, b''))
+        missing = run(archive.probePackage(NOT_EXISTS_ARTIFACT, b''))
+        if found is None:
+            # backend cannot tell without downloading
+            self.assertIsNone(missing)
+        else:
+            self.assertTrue(found)
+            self.assertFalse(missing)
+            self.assertTrue(run(archive.probeLocalLiveBuildId(DOWNLOAD_ARITFACT)))
+            self.assertFalse(run(archive.probeLocalLiveBuildId(NOT_EXISTS_ARTIFACT)))
+
+        # bulk queries
+        artifacts = [ (DOWNLOAD_ARITFACT, b''), (NOT_EXISTS_ARTIFACT, b''),
+                      (TAINTED_ARTIFACT, TAINTED_ARTIFACT_FP_BIN), (TAINTED_ARTIFACT, b'') ]
+        found = run(archive.probePackages(artifacts))
+        if found[0] is None:
+            self.assertEqual(found, [None] * 4)
+        else:
+            self.assertEqual(found, [True, False, True, False])
+
+        archive.wantDownload(False)
+        self.assertFalse(run(archive.probePackage(DOWNLOAD_ARITFACT, b'')))
+        self.assertEqual(run(archive.probePackages(artifacts)), [False] * 4)
+
     def testdoDownloadPackage(self):
         """Local download tests"""
 
@@ -376,6 +513,84 @@ class BaseTester:
         with self.assertRaises(BuildError):
             run(archive.uploadLocalLiveBuildId(DummyStep(), ERROR_UPLOAD_ARTIFACT, b'\x00'))
 
+    def testHashAlgorithm(self):
+        """Artifacts of other hash algorithms are kept apart"""
+
+        archive = self.__getArchiveInstance({}, "blake2b")
+        archive.wantDownload(True)
+        archive.wantUpload(True)
+        with TemporaryDirectory() as tmp:
+            audit = os.path.join(tmp, "audit.json.gz")
+            content = os.path.join(tmp, "workspace")
+            with open(audit, "wb") as f:
+                f.write(b"AUDIT")
+            os.mkdir(content)
+            with open(os.path.join(content, "data"), "wb") as f:
+                f.write(b"DATA")
+
+            # sha1 artifacts are not found
+            self.assertFalse(run(archive.downloadPackage(DummyStep(), DOWNLOAD_ARITFACT, b'', audit, content)))
+
+            bid = UPLOAD1_ARTIFACT
+            run(archive.uploadPackage(DummyStep(), bid, b'', audit, content))
+            self.__testArtifact(bid, "b2b.tgz")
+
+    def __testCompressedRoundTrip(self, spec, suffix):
+        archive = self.__getArchiveInstance(spec)
+        archive.wantDownload(True)
+        archive.wantUpload(True)
+        with TemporaryDirectory() as tmp:
+            audit = os.path.join(tmp, "audit.json.gz")
+            content = os.path.join(tmp, "workspace")
+            with open(audit, "wb") as f:
+                f.write(b"AUDIT")
+            os.mkdir(content)
+            with open(os.path.join(content, "data"), "wb") as f:
+                f.write(b"DATA")
+            run(archive.uploadPackage(DummyStep(), UPLOAD1_ARTIFACT, b'', audit, content))
+
+        bid = hexlify(UPLOAD1_ARTIFACT).decode("ascii")
+        name = os.path.join(self.repo.name, bid[0:2], bid[2:4], bid[4:] + suffix)
+        self.assertTrue(os.path.exists(name))
+
+        with TemporaryDirectory() as tmp:
+            audit = os.path.join(tmp, "audit.json.gz")
+            content = os.path.join(tmp, "workspace")
+            self.assertTrue(run(archive.downloadPackage(DummyStep(), UPLOAD1_ARTIFACT,
+                b'', audit, content)))
+            self.__testWorkspace(audit, content)
+
+        return name
+
+    def testCompressionThreads(self):
+        """Multi-threaded gzip compression creates regular artifacts"""
+        name = self.__testCompressedRoundTrip({ "compressionThreads" : 4 }, "-1.tgz")
+        self.__testArtifactByName(name)
+
+    @unittest.skipIf(zstandard is None, "requires zstandard")
+    def testCompressionZstd(self):
+        """Zstd compressed artifacts are stored in their own generation"""
+        self.__testCompressedRoundTrip({ "compression" : "zstd" }, "-2.tgz")
+
+    @unittest.skipIf(zstandard is None, "requires zstandard")
+    def testCompressionZstdFallback(self):
+        """Gzip compressed artifacts of Jenkins builds are used as fallback"""
+        archive = self.__getSingleArchiveInstance({ "compression" : "zstd" })
+        archive.wantDownload(True)
+        with TemporaryDirectory() as tmp:
+            audit = os.path.join(tmp, "audit.json.gz")
+            content = os.path.join(tmp, "workspace")
+            self.assertTrue(run(archive.downloadPackage(DummyStep(), DOWNLOAD_ARITFACT,
+                b'', audit, content)))
+            self.__testWorkspace(audit, content)
+            self.assertFalse(run(archive.downloadPackage(DummyStep(), NOT_EXISTS_ARTIFACT,
+                b'', audit, content)))
+
+        self.assertEqual(run(archive.downloadLocalLiveBuildId(DummyStep(), DOWNLOAD_ARITFACT)),
+            b'\x00'*20)
+        self.assertNotEqual(run(archive.probePackage(DOWNLOAD_ARITFACT, b'')), False)
+        self.assertNotEqual(run(archive.probePackages([(DOWNLOAD_ARITFACT, b'')])), [False])
+
     def testUploadPackageNoFail(self):
         """The nofail option must prevent fatal error on upload failures"""
 
@@ -499,6 +714,87 @@ class BaseTester:
         run(archive.uploadLocalLiveBuildId(DummyStep(), b'\x00'*20, b'\x00'*20))
 
 
+class SlowArchive(LocalArchive):
+    def _probeDownloadFile(self, buildId, suffix, generation):
+        time.sleep(0.5)
+        return super()._probeDownloadFile(buildId, suffix, generation)
+
+class TestMultiArchive(TestCase):
+
+    def setUp(self):
+        self.repos = [ TemporaryDirectory() for i in range(2) ]
+
+    def tearDown(self):
+        for i in self.repos: i.cleanup()
+
+    def __createArtifact(self, repo):
+        bid = hexlify(DOWNLOAD_ARITFACT).decode("ascii")
+        name = os.path.join(repo.name, bid[0:2], bid[2:4], bid[4:] + "-1.tgz")
+        os.makedirs(os.path.dirname(name))
+        with tarfile.open(name, "w|gz", format=tarfile.PAX_FORMAT,
+                          pax_headers={ 'bob-archive-vsn' : "1" }) as tar:
+            with NamedTemporaryFile() as audit:
+                tar.add(audit.name, "meta/audit.json.gz")
+            with TemporaryDirectory() as content:
+                tar.add(content, "content")
+
+    def __getArchive(self, *classes):
+        archives = [ cls({ "backend" : "file", "path" : repo.name })
+                     for (cls, repo) in zip(classes, self.repos) ]
+        for i in archives:
+            i.downloadPackage = MagicMock(wraps=i.downloadPackage)
+        ret = MultiArchive(archives)
+        ret.wantDownload(True)
+        return (ret, archives)
+
+    def __download(self, archive, bid=DOWNLOAD_ARITFACT):
+        with TemporaryDirectory() as tmp:
+            return run(archive.downloadPackage(DummyStep(), bid, b'',
+                os.path.join(tmp, "audit.json.gz"), os.path.join(tmp, "content")))
+
+    def testFastestWins(self):
+        """The fastest archive that has the artifact is used"""
+        for i in self.repos: self.__createArtifact(i)
+        (multi, archives) = self.__getArchive(SlowArchive, LocalArchive)
+        self.assertTrue(self.__download(multi))
+        archives[0].downloadPackage.assert_not_called()
+        archives[1].downloadPackage.assert_called_once()
+
+        # slow archive was measured and is probed last next time
+        (slow, fast) = multi.getLatencies()
+        self.assertLess(fast, slow)
+
+    def testFallbackByLatency(self):
+        """Backends that cannot confirm the artifact are tried fastest first"""
+        for i in self.repos: self.__createArtifact(i)
+        (multi, archives) = self.__getArchive(SlowArchive, LocalArchive)
+        self.assertTrue(self.__download(multi))
+        archives[1].downloadPackage.reset_mock()
+
+        for i in archives: i._probeDownloadFile = MagicMock(return_value=None)
+        self.assertTrue(self.__download(multi))
+        archives[0].downloadPackage.assert_not_called()
+        archives[1].downloadPackage.assert_called_once()
+
+    def testHedgedMiss(self):
+        """Missing artifacts are taken from the other archive"""
+        self.__createArtifact(self.repos[1])
+        (multi, archives) = self.__getArchive(LocalArchive, SlowArchive)
+        self.assertTrue(self.__download(multi))
+        archives[0].downloadPackage.assert_not_called()
+        archives[1].downloadPackage.assert_called_once()
+
+        self.assertFalse(self.__download(multi, NOT_EXISTS_ARTIFACT))
+        archives[1].downloadPackage.assert_called_once()
+
+    def testProbeMany(self):
+        """Bulk queries combine the results of all archives"""
+        self.__createArtifact(self.repos[1])
+        (multi, archives) = self.__getArchive(LocalArchive, LocalArchive)
+        self.assertEqual(run(multi.probePackages([(DOWNLOAD_ARITFACT, b''),
+                                                  (NOT_EXISTS_ARTIFACT, b'')])),
+                         [True, False])
+
 class TestDummyArchive(TestCase):
 
     def testOptions(self):
@@ -530,16 +826,26 @@ class TestDummyArchive(TestCase):
         run(DummyArchive().uploadLocalLiveBuildId(DummyStep(), b'\x00'*20, b'\x00'*20))
 
 
-def createHttpHandler(repoPath):
+def createHttpHandler(repoPath, connections=None):
 
     class Handler(http.server.BaseHTTPRequestHandler):
 
+        protocol_version = "HTTP/1.1"
+        chunked = True
+        transfers = []
+
+        def setup(self):
+            super().setup()
+            if connections is not None: connections.append(self.client_address)
+
         def getCommon(self):
             path = repoPath + self.path
             try:
                 f = open(path, "rb")
             except FileNotFoundError:
-                self.send_error(404, "not found")
+                self.send_response(404)
+                self.send_header("Content-Length", "0")
+                self.end_headers()
                 return None
             except OSError:
                 self.send_error(500, "internal error")
@@ -547,6 +853,7 @@ def createHttpHandler(repoPath):
 
             self.send_response(200)
             self.send_header("Content-type", "application/octet-stream")
+            self.send_header("Content-Length", str(os.fstat(f.fileno()).st_size))
             self.end_headers()
             return f
 
@@ -560,15 +867,35 @@ def createHttpHandler(repoPath):
                 self.wfile.write(f.read())
                 f.close()
 
+        def readChunked(self):
+            content = b''
+            while True:
+                length = int(self.rfile.readline().strip(), 16)
+                content += self.rfile.read(length)
+                self.rfile.readline()
+                if length == 0: return content
+
         def do_PUT(self):
-            length = int(self.headers['Content-Length'])
-            content  = self.rfile.read(length)
+            if self.headers.get('Transfer-Encoding') == "chunked":
+                self.transfers.append("chunked")
+                if not self.chunked:
+                    self.close_connection = True
+                    self.send_response(411)
+                    self.send_header("Content-Length", "0")
+                    self.end_headers()
+                    return
+                content = self.readChunked()
+            else:
+                self.transfers.append("plain")
+                length = int(self.headers['Content-Length'])
+                content  = self.rfile.read(length)
 
             exists = False
             path = repoPath + self.path
             if os.path.exists(path):
                 if "If-None-Match" in self.headers:
                     self.send_response(412)
+                    self.send_header("Content-Length", "0")
                     self.end_headers()
                     return
                 else:
@@ -579,24 +906,306 @@ def createHttpHandler(repoPath):
                 with open(path, "wb") as f:
                     f.write(content)
                 self.send_response(200 if exists else 201)
+                self.send_header("Content-Length", "0")
                 self.end_headers()
             except OSError:
                 self.send_error(500, "internal error")
 
     return Handler
 
+class TestParallelGzipWriter(TestCase):
+
+    def testRoundTrip(self):
+        """Blocks form a single regular gzip stream"""
+        data = os.urandom(ParallelGzipWriter.BLOCK_SIZE // 2) * 5 + b'tail'
+        with NamedTemporaryFile() as f:
+            with ParallelGzipWriter(f, 6, 4) as gz:
+                for i in range(0, len(data), 100000):
+                    gz.write(data[i:i+100000])
+            f.seek(0)
+            self.assertEqual(gzip.decompress(f.read()), data)
+
+    def testEmpty(self):
+        with NamedTemporaryFile() as f:
+            with ParallelGzipWriter(f, 6, 2):
+                pass
+            f.seek(0)
+            self.assertEqual(gzip.decompress(f.read()), b'')
+
+    def testErrorAfterClose(self):
+        """An exception after close() is propagated unchanged"""
+        with NamedTemporaryFile() as f:
+            with self.assertRaises(RuntimeError):
+                with ParallelGzipWriter(f, 6, 2) as gz:
+                    gz.close()
+                    raise RuntimeError()
+
+class TestArtifactCacheEviction(TestCase):
+
+    def testLeastRecentlyUsed(self):
+        with TemporaryDirectory() as tmp:
+            for (i, name) in enumerate(["a", "b", "c"]):
+                with open(os.path.join(tmp, name), "wb") as f:
+                    f.write(b'x' * 100)
+                os.utime(os.path.join(tmp, name), (1000+i, 1000+i))
+            os.utime(os.path.join(tmp, "a"))
+
+            ArtifactCache._evict(tmp, 200)
+            self.assertEqual(sorted(f for f in os.listdir(tmp) if f != ArtifactCache.LOCK_FILE),
+                             ["a", "c"])
+
+    def testKeepPinned(self):
+        """Pinned artifacts are never evicted unless they are stale"""
+        with TemporaryDirectory() as tmp:
+            for name in ["a", "a.0000.tmp", "b.1111.tmp"]:
+                with open(os.path.join(tmp, name), "wb") as f:
+                    f.write(b'x' * 100)
+            os.utime(os.path.join(tmp, "b.1111.tmp"), (1000, 1000))
+
+            ArtifactCache._evict(tmp, 0)
+            self.assertEqual(sorted(f for f in os.listdir(tmp) if f != ArtifactCache.LOCK_FILE),
+                             ["a.0000.tmp"])
+
+class FlakyArchive:
+    """Fails the first 'failures' uploads of every artifact"""
+    def __init__(self, failures):
+        self.failures = failures
+        self.tries = {}
+        self.active = 0
+        self.maxActive = 0
+
+    async def uploadPackage(self, step, buildId, fingerprint, audit, content):
+        self.active += 1
+        self.maxActive = max(self.maxActive, self.active)
+        try:
+            await asyncio.sleep(0.01)
+        finally:
+            self.active -= 1
+        tries = self.tries[buildId] = self.tries.get(buildId, 0) + 1
+        if tries <= self.failures:
+            raise BuildError("failed")
+        return buildId != UPLOAD2_ARTIFACT
+
+class UploadStatistic:
+    artifactsUploaded = 0
+    artifactsUploadSkipped = 0
+    artifactsUploadFailed = 0
+
+@patch('bob.archive.UploadQueue.BACKOFF', 0.001)
+class TestUploadQueue(TestCase):
+
+    def testBackground(self):
+        """Queued uploads run in parallel up to the job limit"""
+        archive = FlakyArchive(0)
+        stats = UploadStatistic()
+        async def upload():
+            q = UploadQueue(archive, 2, statistic=stats)
+            for bid in [UPLOAD1_ARTIFACT, UPLOAD2_ARTIFACT, DOWNLOAD_ARITFACT]:
+                q.put(DummyStep(), bid, b'', None, "content")
+            self.assertEqual(archive.tries, {})
+            return await q.drain()
+        self.assertEqual(run(upload()), [])
+        self.assertEqual(archive.maxActive, 2)
+        self.assertEqual((stats.artifactsUploaded, stats.artifactsUploadSkipped,
+                          stats.artifactsUploadFailed), (2, 1, 0))
+
+    def testRetry(self):
+        archive = FlakyArchive(2)
+        stats = UploadStatistic()
+        q = UploadQueue(archive, 1, 2, stats)
+        self.assertTrue(run(q.upload(DummyStep(), UPLOAD1_ARTIFACT, b'', None, "content")))
+        self.assertEqual(archive.tries[UPLOAD1_ARTIFACT], 3)
+        self.assertEqual(stats.artifactsUploaded, 1)
+
+    def testFailed(self):
+        """Errors of background uploads are returned by drain()"""
+        archive = FlakyArchive(3)
+        stats = UploadStatistic()
+        async def upload():
+            q = UploadQueue(archive, 1, 2, stats)
+            q.put(DummyStep(), UPLOAD1_ARTIFACT, b'', None, "content")
+            return await q.drain()
+        errors = run(upload())
+        self.assertEqual(len(errors), 1)
+        self.assertEqual(errors[0].stack, ["a", "b"])
+        self.assertEqual(archive.tries[UPLOAD1_ARTIFACT], 3)
+        self.assertEqual(stats.artifactsUploadFailed, 1)
+
+    def testCancel(self):
+        archive = FlakyArchive(0)
+        async def upload():
+            q = UploadQueue(archive, 1)
+            q.put(DummyStep(), UPLOAD1_ARTIFACT, b'', None, "content")
+            q.put(DummyStep(), DOWNLOAD_ARITFACT, b'', None, "content")
+            await asyncio.sleep(0)
+            dropped = q.cancel()
+            return (dropped, await q.drain())
+        self.assertEqual(run(upload()), (2, []))
+
 class TestLocalArchive(BaseTester, TestCase):
 
     def _setArchiveSpec(self, spec):
         spec['backend'] = "file"
         spec["path"] = self.repo.name
 
+    def __writeArtifact(self, bid, data):
+        bid = hexlify(bid).decode("ascii")
+        name = os.path.join(self.repo.name, bid[0:2], bid[2:4], bid[4:] + "-1.tgz")
+        os.makedirs(os.path.dirname(name), exist_ok=True)
+        with TemporaryDirectory() as content:
+            with open(os.path.join(content, "data"), "wb") as f:
+                f.write(data)
+            pax = { 'bob-archive-vsn' : "1" }
+            with tarfile.open(name + ".new", "w|gz", format=tarfile.PAX_FORMAT,
+                              pax_headers=pax) as tar:
+                with NamedTemporaryFile() as audit:
+                    tar.add(audit.name, "meta/audit.json.gz")
+                tar.add(content, "content")
+        os.replace(name + ".new", name)
+
+    def __storeEntries(self, unpacked):
+        return sorted(os.path.relpath(e, unpacked) for e in
+                      glob.glob(os.path.join(unpacked, "??", "??", "*")))
+
+    def __downloadData(self, archive, bid, tmp, index=None):
+        audit = os.path.join(tmp, "audit.json.gz")
+        content = os.path.join(tmp, "workspace")
+        if not run(archive.downloadPackage(DummyStep(), bid, None, audit,
+                                           content, index)):
+            return None
+        with open(os.path.join(content, "data"), "rb") as f:
+            return f.read()
+
+    def testUnpackedStore(self):
+        """Artifacts are materialized from the unpacked store"""
+        with TemporaryDirectory() as unpacked, TemporaryDirectory() as tmp:
+            archive = LocalArchive({ "backend" : "file", "path" : self.repo.name,
+                                     "unpackedPath" : unpacked })
+            archive.wantDownload(True)
+            audit = os.path.join(tmp, "audit.json.gz")
+            content = os.path.join(tmp, "workspace")
+            self.assertTrue(run(archive.downloadPackage(DummyStep(),
+                DOWNLOAD_ARITFACT, None, audit, content)))
+            with open(os.path.join(content, "data"), "rb") as f:
+                self.assertEqual(f.read(), b'DATA')
+            # not hard linked by default
+            st = os.stat(os.path.join(content, "data"))
+            self.assertEqual(st.st_nlink, 1)
+            self.assertEqual(stat.S_IMODE(st.st_mode), 0o644)
+
+            index = os.path.join(tmp, "index")
+            content2 = os.path.join(tmp, "workspace2")
+            with patch('bob.archive.ArtifactReader') as reader:
+                self.assertTrue(run(archive.downloadPackage(DummyStep(),
+                    DOWNLOAD_ARITFACT, None, audit, content2, index)))
+                reader.assert_not_called()
+            with open(audit, "rb") as f:
+                self.assertEqual(f.read(), b'AUDIT')
+            with open(os.path.join(content2, "data"), "rb") as f:
+                self.assertEqual(f.read(), b'DATA')
+            self.assertEqual(hashDirectory(content2, index), hashDirectory(content))
+
+            self.assertFalse(run(archive.downloadPackage(DummyStep(),
+                NOT_EXISTS_ARTIFACT, None, audit, content2)))
+
+    def testUnpackedStoreOutdated(self):
+        """Entries of replaced or removed artifacts are not used and pruned"""
+        with TemporaryDirectory() as unpacked, TemporaryDirectory() as tmp:
+            archive = LocalArchive({ "backend" : "file", "path" : self.repo.name,
+                                     "unpackedPath" : unpacked })
+            archive.wantDownload(True)
+            self.assertEqual(self.__downloadData(archive, DOWNLOAD_ARITFACT, tmp), b'DATA')
+
+            self.__writeArtifact(DOWNLOAD_ARITFACT, b'CHANGED')
+            self.assertEqual(self.__downloadData(archive, DOWNLOAD_ARITFACT, tmp), b'CHANGED')
+            entries = self.__storeEntries(unpacked)
+            self.assertEqual(len(entries), 1)
+
+            os.unlink(self.dummyFileName)
+            self.assertIsNone(self.__downloadData(archive, DOWNLOAD_ARITFACT, tmp))
+
+            # Adding another entry prunes the orphaned one
+            self.__writeArtifact(b'\x01'*20, b'1')
+            self.assertEqual(self.__downloadData(archive, b'\x01'*20, tmp), b'1')
+            self.assertEqual(len(self.__storeEntries(unpacked)), 1)
+            self.assertNotIn(entries[0], self.__storeEntries(unpacked))
+
+    def testUnpackedStorePrune(self):
+        """Least recently used entries are removed above the size limit"""
+        with TemporaryDirectory() as unpacked, TemporaryDirectory() as tmp:
+            archive = LocalArchive({ "backend" : "file", "path" : self.repo.name,
+                                     "unpackedPath" : unpacked, "unpackedSize" : 2 })
+            archive.wantDownload(True)
+            for i in (1, 2, 3):
+                self.__writeArtifact(bytes([i])*20, str(i).encode())
+
+            self.assertEqual(self.__downloadData(archive, b'\x01'*20, tmp), b'1')
+            first = self.__storeEntries(unpacked)
+            self.assertEqual(self.__downloadData(archive, b'\x02'*20, tmp), b'2')
+            self.assertEqual(len(self.__storeEntries(unpacked)), 2)
+
+            self.assertEqual(self.__downloadData(archive, b'\x01'*20, tmp), b'1')
+            self.assertEqual(self.__downloadData(archive, b'\x03'*20, tmp), b'3')
+            entries = self.__storeEntries(unpacked)
+            self.assertEqual(len(entries), 2)
+            self.assertIn(first[0], entries)
+
+    def testUnpackedStoreLink(self):
+        """Files are hard linked from the unpacked store on request"""
+        with TemporaryDirectory() as unpacked, TemporaryDirectory() as tmp:
+            archive = LocalArchive({ "backend" : "file", "path" : self.repo.name,
+                                     "unpackedPath" : unpacked, "unpackedLink" : True })
+            archive.wantDownload(True)
+            content = os.path.join(tmp, "workspace")
+            with patch('bob.archive.fcntl', None):
+                self.assertEqual(self.__downloadData(archive, DOWNLOAD_ARITFACT, tmp), b'DATA')
+            st = os.stat(os.path.join(content, "data"))
+            self.assertEqual(st.st_nlink, 2)
+            self.assertEqual(st.st_mode & 0o222, 0)
+
+    def testUnpackedStoreModes(self):
+        """Copied files from the unpacked store keep their original mode"""
+        name = os.path.join(self.repo.name, "01", "01", "01"*18 + "-1.tgz")
+        os.makedirs(os.path.dirname(name))
+        with TemporaryDirectory() as content:
+            for (f, mode) in (("data", 0o644), ("exec", 0o755)):
+                f = os.path.join(content, f)
+                with open(f, "wb") as fd:
+                    fd.write(b'DATA')
+                os.chmod(f, mode)
+            pax = { 'bob-archive-vsn' : "1" }
+            with tarfile.open(name, "w|gz", format=tarfile.PAX_FORMAT, pax_headers=pax) as tar:
+                tar.add(self.dummyFileName, "meta/audit.json.gz")
+                tar.add(content, "content")
+
+        def noLink(src, dst):
+            raise OSError(errno.EXDEV, "Cross-device link")
+
+        with TemporaryDirectory() as unpacked, TemporaryDirectory() as tmp:
+            archive = LocalArchive({ "backend" : "file", "path" : self.repo.name,
+                                     "unpackedPath" : unpacked })
+            archive.wantDownload(True)
+            audit = os.path.join(tmp, "audit.json.gz")
+            content = os.path.join(tmp, "workspace")
+            with patch('bob.archive.fcntl', None), patch('bob.archive.os.link', noLink):
+                self.assertTrue(run(archive.downloadPackage(DummyStep(),
+                    b'\x01'*20, None, audit, content)))
+            self.assertEqual(stat.S_IMODE(os.stat(os.path.join(content, "data")).st_mode),
+                             0o644)
+            self.assertEqual(stat.S_IMODE(os.stat(os.path.join(content, "exec")).st_mode),
+                             0o755)
+
 
 class TestHttpArchive(BaseTester, TestCase):
 
     def setUp(self):
         super().setUp()
-        self.httpd = socketserver.ThreadingTCPServer(("localhost", 0), createHttpHandler(self.repo.name))
+        self.connections = []
+        self.httpd = socketserver.ThreadingTCPServer(("localhost", 0),
+            createHttpHandler(self.repo.name, self.connections))
+        # kept-alive connections must not block the shutdown
+        self.httpd.daemon_threads = True
+        self.httpd.block_on_close = False
         self.ip, self.port = self.httpd.server_address
         self.server = threading.Thread(target=self.httpd.serve_forever)
         self.server.daemon = True
@@ -611,6 +1220,65 @@ class TestHttpArchive(BaseTester, TestCase):
         spec['backend'] = "http"
         spec["url"] = "http://{}:{}".format(self.ip, self.port)
 
+    def testConnectionReuse(self):
+        """Connections are kept alive between transfers"""
+        spec = { 'url' : "http://{}:{}".format(self.ip, self.port) }
+        archive = SimpleHttpArchive(spec, None)
+        archive.setHashAlgorithm("sha1")
+        archive.wantDownload(True)
+        archive.wantUpload(True)
+        archive._getConnectionPool().discardIdle()
+
+        with TemporaryDirectory() as tmp:
+            for i in range(3):
+                audit = os.path.join(tmp, "audit.json.gz")
+                content = os.path.join(tmp, "workspace")
+                self.assertTrue(run(archive.downloadPackage(DummyStep(),
+                    DOWNLOAD_ARITFACT, b'', audit, content)))
+                self.assertFalse(run(archive.downloadPackage(DummyStep(),
+                    NOT_EXISTS_ARTIFACT, b'', audit, content)))
+        self.assertEqual(len(self.connections), 1)
+
+    def __uploadChunked(self):
+        spec = { 'url' : "http://{}:{}".format(self.ip, self.port),
+                 'chunkedUpload' : True }
+        archive = SimpleHttpArchive(spec, None)
+        archive.setHashAlgorithm("sha1")
+        archive.wantUpload(True)
+        handler = self.httpd.RequestHandlerClass
+        handler.transfers = []
+
+        with TemporaryDirectory() as tmp:
+            audit = os.path.join(tmp, "audit.json.gz")
+            content = os.path.join(tmp, "workspace")
+            with open(audit, "wb") as f:
+                f.write(b"AUDIT")
+            os.mkdir(content)
+            with open(os.path.join(content, "data"), "wb") as f:
+                f.write(os.urandom(300 * 1024))
+            run(archive.uploadPackage(DummyStep(), UPLOAD1_ARTIFACT, b'', audit, content))
+            run(archive.uploadLocalLiveBuildId(DummyStep(), UPLOAD1_ARTIFACT, b'\x00'))
+
+            # exists already
+            run(archive.uploadPackage(DummyStep(), UPLOAD1_ARTIFACT, b'', audit, content))
+
+        bid = hexlify(UPLOAD1_ARTIFACT).decode("ascii")
+        name = os.path.join(self.repo.name, bid[0:2], bid[2:4], bid[4:] + "-1.tgz")
+        with tarfile.open(name, errorlevel=1) as tar:
+            self.assertEqual(tar.pax_headers.get('bob-archive-vsn'), "1")
+            self.assertEqual(len(tar.extractfile("content/data").read()), 300 * 1024)
+
+        return handler.transfers
+
+    def testChunkedUpload(self):
+        """Artifacts are streamed with chunked encoding"""
+        self.assertEqual(self.__uploadChunked(), ["chunked", "plain"])
+
+    def testChunkedUploadFallback(self):
+        """Servers that reject chunked uploads get regular uploads"""
+        self.httpd.RequestHandlerClass.chunked = False
+        self.assertEqual(self.__uploadChunked(), ["chunked", "plain", "plain"])
+
     def testInvalidServer(self):
         """Test download on non-existent server"""
 
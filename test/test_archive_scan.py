@@ -0,0 +1,207 @@
+# Bob build tool
+# Copyright (C) 2019  Jan Klötzke
+#
+# SPDX-License-Identifier: GPL-3.0-or-later
+
+from tempfile import TemporaryDirectory
+from unittest import TestCase
+from unittest.mock import patch
+import os
+import pickle
+import sqlite3
+import tarfile
+
+from bob.audit import Audit
+from bob.cmds.archive import ArchiveScanner, doArchiveClean, readArtifact
+from bob.errors import BobError
+from bob.utils import asHexStr, binStat
+
+def createArtifact(bid, valid=True, meta={}, deps=[], gen="-1"):
+    name = asHexStr(bid)
+    name = os.path.join(name[0:2], name[2:4], name[4:] + gen + ".tgz")
+    os.makedirs(os.path.dirname(name), exist_ok=True)
+    os.makedirs("audits", exist_ok=True)
+    with TemporaryDirectory() as tmp:
+        audit = os.path.join(tmp, "audit.json.gz")
+        if valid:
+            a = Audit.create(bid, bid, bid, None)
+            a.addDefine("step", "dist")
+            for (k, v) in meta.items(): a.addDefine(k, v)
+            for d in deps: a.addArg(os.path.join("audits", asHexStr(d) + ".json.gz"))
+            a.save(audit)
+            a.save(os.path.join("audits", asHexStr(bid) + ".json.gz"))
+        else:
+            with open(audit, "wb") as f:
+                f.write(b'garbage')
+        pax = { 'bob-archive-vsn' : "1" }
+        with tarfile.open(name, "w|gz", format=tarfile.PAX_FORMAT, pax_headers=pax) as tar:
+            tar.add(audit, "meta/audit.json.gz")
+            tar.add(tmp, "content")
+    return name
+
+class TestArchiveScanner(TestCase):
+
+    def setUp(self):
+        self.cwd = os.getcwd()
+        self.tmp = TemporaryDirectory()
+        os.chdir(self.tmp.name)
+
+    def tearDown(self):
+        os.chdir(self.cwd)
+        self.tmp.cleanup()
+
+    def testParallel(self):
+        bids = [ bytes([i]) * 20 for i in range(10) ]
+        for bid in bids: createArtifact(bid)
+        with ArchiveScanner() as scanner:
+            scanner.scan(False, 4)
+            self.assertEqual(sorted(bid for (bid, taint) in scanner.getBuildIds()),
+                             bids)
+
+    def testIncremental(self):
+        """Only new or changed artifacts are read"""
+        createArtifact(b'\x01'*20)
+        with ArchiveScanner() as scanner:
+            scanner.scan(False)
+        createArtifact(b'\x02'*20)
+        with patch('bob.cmds.archive.readArtifact', side_effect=readArtifact) as read:
+            with ArchiveScanner() as scanner:
+                scanner.scan(False)
+                self.assertEqual(len(scanner.getBuildIds()), 2)
+            self.assertEqual(read.call_count, 1)
+
+    @patch('bob.cmds.archive.ArchiveScanner.BATCH_SIZE', 1)
+    def testResume(self):
+        """An interrupted scan keeps what was already scanned"""
+        for i in range(5): createArtifact(bytes([i]) * 20)
+        broken = createArtifact(b'\xff'*20, False)
+        with ArchiveScanner() as scanner:
+            with self.assertRaises(BobError):
+                scanner.scan(False)
+            done = len(scanner.getBuildIds())
+
+        os.unlink(broken)
+        with patch('bob.cmds.archive.readArtifact', side_effect=readArtifact) as read:
+            with ArchiveScanner() as scanner:
+                scanner.scan(False)
+                self.assertEqual(len(scanner.getBuildIds()), 5)
+            self.assertEqual(read.call_count, 5 - done)
+
+    def __createTree(self):
+        # a <- b <- c and unrelated d
+        createArtifact(b'\x0a'*20, meta={"package" : "a"})
+        createArtifact(b'\x0b'*20, meta={"package" : "b"}, deps=[b'\x0a'*20])
+        createArtifact(b'\x0c'*20, meta={"package" : "c"}, deps=[b'\x0b'*20])
+        createArtifact(b'\x0d'*20, meta={"package" : "d"})
+
+    def __remaining(self):
+        with ArchiveScanner() as scanner:
+            return sorted(bid[0] for (bid, taint) in scanner.getBuildIds())
+
+    def testClean(self):
+        """Referenced artifacts are retained"""
+        self.__createTree()
+        doArchiveClean(["-j", "2", 'meta.package == "b"'])
+        self.assertEqual(self.__remaining(), [0x0a, 0x0b])
+        self.assertEqual(sorted(os.listdir("0a")), ["0a"])
+        self.assertEqual(os.listdir(os.path.join("0c", "0c")), [])
+
+    def testGenerations(self):
+        """All generations of an artifact are tracked and cleaned"""
+        self.__createTree()
+        b1 = createArtifact(b'\x0b'*20, meta={"package" : "b"}, gen="-2")
+        d1 = createArtifact(b'\x0d'*20, meta={"package" : "d"}, gen="-2")
+        with ArchiveScanner() as scanner:
+            scanner.scan(False)
+            self.assertEqual(len(scanner.getBuildIds()), 4)
+        with patch('bob.cmds.archive.readArtifact', side_effect=readArtifact) as read:
+            with ArchiveScanner() as scanner:
+                scanner.scan(False)
+            self.assertEqual(read.call_count, 0)
+
+        doArchiveClean(["-n", 'meta.package == "b"'])
+        self.assertEqual(self.__remaining(), [0x0a, 0x0b])
+        self.assertTrue(os.path.exists(b1))
+        self.assertFalse(os.path.exists(d1))
+        self.assertEqual(os.listdir(os.path.join("0d", "0d")), [])
+
+    def testCleanExpressions(self):
+        self.__createTree()
+        with ArchiveScanner() as scanner:
+            scanner.scan(False)
+        doArchiveClean(["-n", '!(meta.package < "c") || meta.missing != meta.package'])
+        self.assertEqual(self.__remaining(), [0x0a, 0x0b, 0x0c, 0x0d])
+        doArchiveClean(["-n", 'meta.package > "b" && meta.missing == metaEnv.missing'])
+        self.assertEqual(self.__remaining(), [0x0a, 0x0b, 0x0c, 0x0d])
+        doArchiveClean(["-n", 'meta.package == "a" || meta.missing > "a"'])
+        self.assertEqual(self.__remaining(), [0x0a])
+
+    def testCleanInvalidReference(self):
+        self.__createTree()
+        with self.assertRaises(BobError):
+            doArchiveClean(['meta == "a"'])
+        self.assertEqual(len(self.__remaining()), 4)
+
+    def testMigrate(self):
+        """Pickled variables of old databases are converted"""
+        db = sqlite3.connect(".bob-archive.sqlite3", isolation_level=None)
+        db.executescript("""
+            CREATE TABLE meta(key TEXT PRIMARY KEY NOT NULL, value);
+            INSERT INTO meta VALUES ('vsn', 1);
+            CREATE TABLE files(bid BLOB NOT NULL, taint BLOB NOT NULL,
+                stat BLOB, vars BLOB, PRIMARY KEY(bid, taint));
+            CREATE TABLE refs(bid BLOB NOT NULL, ref BLOB NOT NULL,
+                PRIMARY KEY (bid, ref));
+            """)
+        vrs = { 'meta' : { 'package' : 'a' }, 'build' : {}, 'metaEnv' : { 'X' : 'y' } }
+        db.execute("INSERT INTO files VALUES (?, ?, NULL, ?)",
+            (b'\x01'*20, b'', pickle.dumps(vrs)))
+        db.close()
+
+        with ArchiveScanner() as scanner:
+            self.assertEqual(scanner.getVars(b'\x01'*20, b''),
+                { 'meta' : { 'package' : 'a' }, 'metaEnv' : { 'X' : 'y' } })
+
+    def __createDatabase(self, vsn, files):
+        db = sqlite3.connect(".bob-archive.sqlite3", isolation_level=None)
+        db.executescript("""
+            CREATE TABLE meta(key TEXT PRIMARY KEY NOT NULL, value);
+            CREATE TABLE refs(bid BLOB NOT NULL, ref BLOB NOT NULL,
+                PRIMARY KEY (bid, ref));
+            """)
+        db.execute("INSERT INTO meta VALUES ('vsn', ?)", (vsn,))
+        if vsn < 2:
+            db.execute("""CREATE TABLE files(bid BLOB NOT NULL, taint BLOB NOT NULL,
+                stat BLOB, vars BLOB, PRIMARY KEY(bid, taint))""")
+        else:
+            db.execute("""CREATE TABLE files(bid BLOB NOT NULL, taint BLOB NOT NULL,
+                gen TEXT NOT NULL, stat BLOB, vars BLOB, PRIMARY KEY(bid, taint, gen))""")
+        for f in files:
+            db.execute("INSERT INTO files VALUES ({})".format(", ".join("?" * len(f))), f)
+        db.close()
+
+    def testMigrateGenerations(self):
+        """Old databases without generations are converted"""
+        name = createArtifact(b'\x01'*20, meta={"package" : "a"}, gen="-2")
+        vrs = { 'meta' : { 'package' : 'a' } }
+        self.__createDatabase(1, [(b'\x01'*20, b'', binStat(name), pickle.dumps(vrs))])
+
+        createArtifact(b'\x01'*20, meta={"package" : "a"})
+        with patch('bob.cmds.archive.readArtifact', side_effect=readArtifact) as read:
+            with ArchiveScanner() as scanner:
+                scanner.scan(False)
+                self.assertEqual(scanner.getBuildIds(), [(b'\x01'*20, b'')])
+                self.assertEqual(scanner.getVars(b'\x01'*20, b'')["meta"]["package"], "a")
+            self.assertEqual(read.call_count, 1)
+        doArchiveClean(["-n", 'meta.package == "b"'])
+        self.assertEqual(os.listdir(os.path.join("01", "01")), [])
+
+    def testMigrateVars(self):
+        """Pickled variables of databases with generations are converted"""
+        vrs = { 'meta' : { 'package' : 'a' } }
+        self.__createDatabase(2, [(b'\x01'*20, b'', "-2", None, pickle.dumps(vrs))])
+        with ArchiveScanner() as scanner:
+            self.assertEqual(scanner.getVars(b'\x01'*20, b''), vrs)
+        doArchiveClean(["-n", 'meta.package == "a"'])
+        with ArchiveScanner() as scanner:
+            self.assertEqual(scanner.getBuildIds(), [(b'\x01'*20, b'')])
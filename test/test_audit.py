@@ -0,0 +1,123 @@
+# Bob build tool
+# Copyright (C) 2019  Jan Klötzke
+#
+# SPDX-License-Identifier: GPL-3.0-or-later
+
+from tempfile import TemporaryDirectory
+from unittest import TestCase
+import gzip
+import json
+import os
+
+from bob.audit import Audit, AuditStore, exportAudit
+from bob.cmds.archive import doArchiveAudit
+from bob.errors import BuildError, ParseError
+
+class TestAuditStore(TestCase):
+
+    def setUp(self):
+        self.cwd = os.getcwd()
+        self.tmp = TemporaryDirectory()
+        os.chdir(self.tmp.name)
+
+    def tearDown(self):
+        os.chdir(self.cwd)
+        self.tmp.cleanup()
+
+    def __create(self, bid, deps=[], store=None):
+        audit = Audit.create(bid, bid, bid, None, store)
+        audit.addDefine("step", "dist")
+        for d in deps: audit.addArg(d + ".json.gz")
+        audit.save(bid.hex() + ".json.gz")
+        return audit
+
+    def __load(self, name):
+        with gzip.open(name, 'rt') as f:
+            return json.load(f)
+
+    def __createTree(self, store):
+        # a <- b <- c, a <- c
+        a = self.__create(b'\x0a'*20, store=store)
+        b = self.__create(b'\x0b'*20, ["0a"*20], store)
+        c = self.__create(b'\x0c'*20, ["0a"*20, "0b"*20], store)
+        return (a, b, c)
+
+    def testLinked(self):
+        """Referenced artifacts are stored once and resolved lazily"""
+        (a, b, c) = self.__createTree(AuditStore("store"))
+        self.assertEqual(self.__load("0c"*20 + ".json.gz")["store"], "store")
+        stored = sorted(d + f[:-8] for d in os.listdir("store")
+                                   for f in os.listdir(os.path.join("store", d)))
+        self.assertEqual(stored, sorted([a.getId().hex(), b.getId().hex()]))
+        self.assertFalse(os.path.exists("0c"*20 + ".json.gz.pickle"))
+
+        c = Audit.fromFile("0c"*20 + ".json.gz")
+        self.assertTrue(c.isLinked())
+        self.assertEqual(c.getReferencedBuildIds(), [b'\x0a'*20, b'\x0b'*20])
+        self.assertEqual(c.getArtifact(a.getId()).getBuildId(), b'\x0a'*20)
+
+    def testConvert(self):
+        """Linked and self-contained audit trails can be converted"""
+        (a, b, c) = self.__createTree(AuditStore("store"))
+        data = exportAudit("0c"*20 + ".json.gz")
+        tree = json.loads(gzip.decompress(data).decode('utf8'))
+        self.assertEqual(sorted(r["artifact-id"] for r in tree["references"]),
+                         sorted([a.getId().hex(), b.getId().hex()]))
+
+        doArchiveAudit(["0c"*20 + ".json.gz", "export.json.gz"])
+        self.assertEqual(exportAudit("export.json.gz"), None)
+        self.assertEqual(Audit.fromFile("export.json.gz").getId(), c.getId())
+
+        doArchiveAudit(["-s", "other", "export.json.gz", "import.json.gz"])
+        self.assertEqual(self.__load("import.json.gz")["store"], "other")
+        imported = Audit.fromFile("import.json.gz")
+        self.assertEqual(imported.getReferencedBuildIds(), [b'\x0a'*20, b'\x0b'*20])
+
+    def testSelfContained(self):
+        (a, b, c) = self.__createTree(None)
+        tree = self.__load("0c"*20 + ".json.gz")
+        self.assertEqual(len(tree["references"]), 2)
+        self.assertFalse(os.path.exists("store"))
+
+    def testMissing(self):
+        """Missing references are detected when they are resolved"""
+        self.__createTree(AuditStore("store"))
+        for (root, dirs, files) in os.walk("store"):
+            for f in files: os.unlink(os.path.join(root, f))
+        c = Audit.fromFile("0c"*20 + ".json.gz")
+        with self.assertRaises(ParseError):
+            c.getReferencedBuildIds()
+
+    def testCollectGarbage(self):
+        """Only records reachable from the roots are kept"""
+        store = AuditStore("store")
+        (a, b, c) = self.__createTree(store)
+        d = self.__create(b'\x0d'*20, ["0b"*20], store)
+        self.__create(b'\x0e'*20, ["0d"*20], store)
+
+        # b is reachable through a reference of d
+        self.assertEqual(store.collectGarbage([d.getId()], True), [])
+        removed = store.collectGarbage(c.getArtifact().getReferences(), True)
+        self.assertEqual(len(removed), 1)
+        self.assertTrue(os.path.exists(removed[0]))
+
+        self.assertEqual(store.collectGarbage(c.getArtifact().getReferences()), removed)
+        self.assertFalse(os.path.exists(removed[0]))
+        self.assertNotIn(d.getId(), store)
+        self.assertEqual(Audit.fromFile("0c"*20 + ".json.gz").getReferencedBuildIds(),
+                         [b'\x0a'*20, b'\x0b'*20])
+
+        self.assertEqual(len(store.collectGarbage([])), 2)
+        self.assertNotIn(a.getId(), store)
+
+    def testScanScm(self):
+        """Scanned SCMs are equivalent to directly added ones"""
+        with open("file", "w") as f:
+            f.write("data")
+        a = Audit.create(b'\x01'*20, b'\x01'*20, b'\x01'*20, None)
+        a.addScm("url", ".", "file")
+        b = Audit.create(b'\x01'*20, b'\x01'*20, b'\x01'*20, None)
+        b.addScmAudit(Audit.scanScm("url", ".", "file"))
+        self.assertEqual(a.getArtifact().dump()["scms"], b.getArtifact().dump()["scms"])
+        with self.assertRaises(BuildError):
+            Audit.scanScm("unknown", ".", "file")
@@ -0,0 +1,68 @@
+# Bob build tool
+# Copyright (C) 2019  Jan Klötzke
+#
+# SPDX-License-Identifier: GPL-3.0-or-later
+
+from tempfile import TemporaryDirectory
+from unittest import TestCase
+import os
+import time
+
+from bob.cmds.build.builder import fingerprintHostId
+from bob.state import BobState, finalize
+
+class TestFingerprintHostId(TestCase):
+
+    def setUp(self):
+        self.tmp = TemporaryDirectory()
+        self.tool = os.path.join(self.tmp.name, "bob-test-tool")
+        with open(self.tool, "w") as f:
+            f.write("#!/bin/sh\n")
+        os.chmod(self.tool, 0o755)
+        self.env = { "PATH" : self.tmp.name, "CC" : "gcc", "FOO" : "bar" }
+
+    def tearDown(self):
+        self.tmp.cleanup()
+
+    def testStable(self):
+        h = fingerprintHostId("bob-test-tool --version", self.env)
+        self.assertEqual(h, fingerprintHostId("bob-test-tool --version", self.env))
+
+    def testProgramChanged(self):
+        """Updating a called program changes the host id"""
+        h = fingerprintHostId("bob-test-tool --version", self.env)
+        st = os.stat(self.tool)
+        os.utime(self.tool, ns=(st.st_atime_ns, st.st_mtime_ns + 1000000000))
+        self.assertNotEqual(h, fingerprintHostId("bob-test-tool --version", self.env))
+
+    def testEnvironment(self):
+        """Only variables that are used by the script are relevant"""
+        h = fingerprintHostId("${CC:-cc} --version", self.env)
+        self.env["FOO"] = "baz"
+        self.assertEqual(h, fingerprintHostId("${CC:-cc} --version", self.env))
+        self.env["CC"] = "clang"
+        self.assertNotEqual(h, fingerprintHostId("${CC:-cc} --version", self.env))
+
+class TestFingerprintCache(TestCase):
+
+    def setUp(self):
+        self.cwd = os.getcwd()
+        self.tmp = TemporaryDirectory()
+        os.chdir(self.tmp.name)
+
+    def tearDown(self):
+        finalize()
+        os.chdir(self.cwd)
+        self.tmp.cleanup()
+
+    def testPersisted(self):
+        BobState().setFingerprint(b'key', b'host', b'result')
+        finalize()
+        self.assertEqual(BobState().getFingerprint(b'key', b'host', 60), b'result')
+
+    def testInvalidation(self):
+        BobState().setFingerprint(b'key', b'host', b'result')
+        self.assertEqual(BobState().getFingerprint(b'key', b'other', 60), None)
+        self.assertEqual(BobState().getFingerprint(b'unknown', b'host', 60), None)
+        time.sleep(0.01)
+        self.assertEqual(BobState().getFingerprint(b'key', b'host', 0.001), None)
@@ -4,7 +4,7 @@ from unittest.mock import MagicMock
 import os
 
 from bob.errors import ParseError
-from bob.input import Recipe
+from bob.input import PackageMatcher, PackageMatchIndex, Recipe
 from bob.stringparser import Env
 
 class TestDependencies(TestCase):
@@ -301,3 +301,91 @@ class TestRelocatable(TestCase):
         }
         p = self.parseAndPrepare("foo", recipe, allRelocatable=True)
         self.assertTrue(p.isRelocatable())
+
+
+class State:
+    def __init__(self, value):
+        self.value = value
+
+    def __eq__(self, other):
+        return self.value == other.value
+
+    def copy(self):
+        return State(self.value)
+
+class TestPackageMatchIndex(TestCase):
+
+    def tool(self, variantId):
+        ret = MagicMock()
+        ret.coreStep.variantId = variantId
+        return ret
+
+    def matcher(self, name, env={}, tools={}, states={}, sandbox=None):
+        """Create matcher where all 'env' and 'tools' keys were used."""
+        env = Env(env)
+        env.touchReset()
+        for n in env.detach().keys(): env.get(n)
+        tools = Env(tools)
+        tools.touchReset()
+        for n in tools.detach().keys(): tools.get(n)
+        return PackageMatcher(name, env, tools, states, sandbox, set())
+
+    def find(self, index, env={}, tools={}, states={}, sandbox=None):
+        m = index.find(env, tools, states, sandbox)
+        return m.corePackage if m is not None else None
+
+    def testKeySets(self):
+        """Matchers with different env and tool names are found"""
+        a, b = self.tool(b'a'), self.tool(b'b')
+        index = PackageMatchIndex()
+        index.add(self.matcher("none"))
+        index.add(self.matcher("env", env={"FOO" : "1"}))
+        index.add(self.matcher("tools", tools={"t" : a}))
+
+        self.assertEqual(self.find(index, {"FOO" : "1"}, {"t" : b}), "env")
+        self.assertEqual(self.find(index, {"FOO" : "2"}, {"t" : a}), "tools")
+        self.assertEqual(self.find(index, {"FOO" : "2"}, {"t" : b}), "none")
+
+    def testMissing(self):
+        """Missing variables and tools only match unset ones"""
+        index = PackageMatchIndex()
+        index.add(self.matcher("missing", env={"FOO" : None}, tools={"t" : None}))
+        index.add(self.matcher("set", env={"FOO" : "1"}, tools={"t" : self.tool(b'a')}))
+
+        self.assertEqual(self.find(index), "missing")
+        self.assertEqual(self.find(index, {"FOO" : "1"}), None)
+        self.assertEqual(self.find(index, tools={"t" : self.tool(b'a')}), None)
+        self.assertEqual(self.find(index, {"FOO" : "1"}, {"t" : self.tool(b'a')}), "set")
+        self.assertEqual(self.find(index, {"FOO" : "1"}, {"t" : self.tool(b'b')}), None)
+
+    def testSandbox(self):
+        index = PackageMatchIndex()
+        index.add(self.matcher("host"))
+        index.add(self.matcher("sandbox", sandbox=self.tool(b's')))
+
+        self.assertEqual(self.find(index), "host")
+        self.assertEqual(self.find(index, sandbox=self.tool(b's')), "sandbox")
+        self.assertEqual(self.find(index, sandbox=self.tool(b'x')), None)
+
+    def testStates(self):
+        """Plugin states are compared inside a bucket"""
+        index = PackageMatchIndex()
+        index.add(self.matcher("a", env={"FOO" : "1"}, states={"p" : State("a")}))
+        index.add(self.matcher("b", env={"FOO" : "1"}, states={"p" : State("b")}))
+
+        self.assertEqual(self.find(index, {"FOO" : "1"}, states={"p" : State("a")}), "a")
+        self.assertEqual(self.find(index, {"FOO" : "1"}, states={"p" : State("b")}), "b")
+        self.assertEqual(self.find(index, {"FOO" : "1"}, states={"p" : State("c")}), None)
+
+    def testPrecedence(self):
+        """The most recently added matcher wins"""
+        index = PackageMatchIndex()
+        index.add(self.matcher("old", env={"FOO" : "1"}))
+        index.add(self.matcher("new", env={"FOO" : "1"}))
+        self.assertEqual(self.find(index, {"FOO" : "1"}), "new")
+
+        # across groups too, even if the group was created earlier
+        index.add(self.matcher("other", env={"BAR" : "1"}))
+        self.assertEqual(self.find(index, {"FOO" : "1", "BAR" : "1"}), "other")
+        index.add(self.matcher("newest", env={"FOO" : "1"}))
+        self.assertEqual(self.find(index, {"FOO" : "1", "BAR" : "1"}), "newest")
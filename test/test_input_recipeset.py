@@ -556,3 +556,24 @@ class TestToolEnvironment(RecipesTmp, TestCase):
 
         packages = self.generate()
         self.assertRaises(ParseError, packages.getRootPackage)
+
+class TestHashAlgorithm(RecipesTmp, TestCase):
+
+    def testDefault(self):
+        """sha1 is used by default"""
+        recipes = RecipeSet()
+        recipes.parse()
+        self.assertEqual(recipes.getHashAlgorithm(), "sha1")
+
+    def testConfig(self):
+        """The hash algorithm is taken from config.yaml"""
+        self.writeConfig({ "hashAlgorithm" : "blake2b" })
+        recipes = RecipeSet()
+        recipes.parse()
+        self.assertEqual(recipes.getHashAlgorithm(), "blake2b")
+
+    def testInvalid(self):
+        """Unknown hash algorithms are rejected"""
+        self.writeConfig({ "hashAlgorithm" : "md5" })
+        recipes = RecipeSet()
+        self.assertRaises(ParseError, recipes.parse)
@@ -5,6 +5,7 @@
 
 import os, re
 import tempfile
+import unittest
 from xml.etree import ElementTree
 from unittest import TestCase
 from bob.utils import removePath
@@ -17,6 +18,11 @@ from jenkins.jenkins_mock import JenkinsMock
 from bob.cmds.jenkins import doJenkins
 from bob.state import finalize
 
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+
 class TestJenkinsPush(TestCase):
     def executeBobJenkinsCmd(self, arg):
         doJenkins(arg.split(' '), self.cwd)
@@ -187,3 +193,55 @@ buildScript: |
 
         self.executeBobJenkinsCmd("rm myTestJenkins")
         assert(len(self.jenkinsMock.getServerData()) == 0)
+
+    def testParallelPush(self):
+        """Jobs are pushed in parallel but triggered in build order"""
+        os.mkdir("recipes")
+        with open(os.path.join("recipes", "root.yaml"), "w") as f:
+            print("root: True\ndepends: [app1, app2, app3]\nbuildScript: 'true'", file=f)
+        for i in range(1, 4):
+            with open(os.path.join("recipes", "app{}.yaml".format(i)), "w") as f:
+                print("depends: [lib{}]\nbuildScript: 'app{}'".format(i, i), file=f)
+            with open(os.path.join("recipes", "lib{}.yaml".format(i)), "w") as f:
+                print("buildScript: 'lib{}'".format(i), file=f)
+
+        self.executeBobJenkinsCmd("add myTestJenkins http://localhost:8080 -r root")
+        self.executeBobJenkinsCmd("push -q -j 4 myTestJenkins")
+        send = self.jenkinsMock.getServerData()
+        self.assertEqual(len(send), 14) # 7 jobs, create + schedule
+
+        created = set(re.match(r"/createItem\?name=(.*)$", path).group(1)
+                      for (path, data) in send[:7])
+        self.assertEqual(created, {"root", "app1", "app2", "app3", "lib1", "lib2", "lib3"})
+        scheduled = [ re.match(r"/job/(.*)/build$", path).group(1) for (path, data) in send[7:] ]
+        for i in range(1, 4):
+            self.assertLess(scheduled.index("lib{}".format(i)), scheduled.index("app{}".format(i)))
+        self.assertEqual(scheduled[-1], "root")
+
+        # only the description with the date changes
+        for (path, data) in send[:7]:
+            name = re.match(r"/createItem\?name=(.*)$", path).group(1)
+            self.jenkinsMock.addServerData('/job/{}/config.xml'.format(name), data)
+        self.executeBobJenkinsCmd("push -q -j 4 myTestJenkins")
+        send = self.jenkinsMock.getServerData()
+        self.assertEqual(len(send), 7)
+        for (path, data) in send:
+            self.assertTrue(path.endswith("/description"))
+
+    @unittest.skipIf(zstandard is None, "requires zstandard")
+    def testZstdArchive(self):
+        """Jenkins always uses gzip compressed artifacts"""
+        os.mkdir("recipes")
+        with open(os.path.join("recipes", "root.yaml"), "w") as f:
+            print("root: True\nbuildScript: 'true'\npackageScript: 'true'", file=f)
+        with open("default.yaml", "w") as f:
+            print("archive:\n  backend: http\n  url: \"http://localhost:8001/upload\"\n"
+                  "  compression: zstd", file=f)
+
+        self.executeBobJenkinsCmd("add myTestJenkins http://localhost:8080 -r root --download --upload")
+        self.executeBobJenkinsCmd("push -q myTestJenkins")
+        config = self.jenkinsMock.getServerData()[0][1].decode('utf-8')
+        self.assertIn('bob-archive-vsn=1', config)
+        self.assertIn('BOB_UPLOAD_BID="$(hexdump -ve \'/1 "%02x"\' ', config)
+        gens = re.findall(r'BOB_(?:UP|DOWN)LOAD_BID="\$\(hexdump [^)]*\)([^"]*)"', config)
+        self.assertEqual(set(gens), {"-1"})
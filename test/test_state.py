@@ -0,0 +1,187 @@
+# Bob build tool
+# Copyright (C) 2019  Jan Klötzke
+#
+# SPDX-License-Identifier: GPL-3.0-or-later
+
+from tempfile import TemporaryDirectory
+from unittest import TestCase
+import os
+import pickle
+import sqlite3
+import time
+
+from bob.errors import ParseError
+from bob.state import BobState, finalize
+
+class TestState(TestCase):
+
+    def setUp(self):
+        self.cwd = os.getcwd()
+        self.tmp = TemporaryDirectory()
+        os.chdir(self.tmp.name)
+
+    def tearDown(self):
+        finalize()
+        os.chdir(self.cwd)
+        self.tmp.cleanup()
+
+    def testPersist(self):
+        """Changes are persisted and deletions are honored"""
+        s = BobState()
+        self.assertEqual(s.getByNameDirectory("work/a", b'\x01', True), "work/a/1")
+        self.assertEqual(s.getByNameDirectory("work/a", b'\x02', False), "work/a/2")
+        s.setResultHash("work/a/1", b'\x11')
+        s.setInputHashes("work/a/1", [b'\x12'])
+        s.setInputHashes("work/a/2", [b'\x13'])
+        s.setDirectoryState("work/a/1", {"." : (b'\x14', None)})
+        s.setVariantId("work/a/1", b'\x15')
+        s.delInputHashes("work/a/2")
+        s.setBuildState({ 'wasRun' : {}, 'predictedBuidId' : {} })
+        finalize()
+
+        s = BobState()
+        self.assertEqual(s.getExistingByNameDirectory(b'\x01'), "work/a/1")
+        self.assertEqual(s.getByNameDirectory("work/a", b'\x03', True), "work/a/3")
+        self.assertEqual(s.getResultHash("work/a/1"), b'\x11')
+        self.assertEqual(s.getInputHashes("work/a/1"), [b'\x12'])
+        self.assertEqual(s.getInputHashes("work/a/2"), None)
+        self.assertEqual(s.getDirectoryState("work/a/1", True), {"." : (b'\x14', None)})
+        self.assertEqual(s.getVariantId("work/a/1"), b'\x15')
+        self.assertEqual(s.getBuildState(), { 'wasRun' : {}, 'predictedBuidId' : {} })
+
+        s.resetWorkspaceState("work/a/1", None)
+        finalize()
+        s = BobState()
+        self.assertEqual(s.getResultHash("work/a/1"), None)
+        self.assertEqual(s.getInputHashes("work/a/1"), None)
+        self.assertEqual(s.getVariantId("work/a/1"), None)
+        self.assertEqual(s.getDirectories(), [])
+
+    def testJenkins(self):
+        s = BobState()
+        s.addJenkins("test", { "url" : "http://localhost" })
+        s.addJenkinsJob("test", "job1", { "hash" : 1 })
+        s.addJenkinsJob("test", "job2", { "hash" : 2 })
+        s.delJenkinsJob("test", "job1")
+        self.assertEqual(s.getJenkinsByNameDirectory("test", "dir", b'\x01'), "dir/1")
+        finalize()
+
+        s = BobState()
+        self.assertEqual(set(s.getAllJenkins()), {"test"})
+        self.assertEqual(s.getJenkinsConfig("test"), { "url" : "http://localhost" })
+        self.assertEqual(s.getJenkinsAllJobs("test"), {"job2"})
+        self.assertEqual(s.getJenkinsByNameDirectory("test", "dir", b'\x01'), "dir/1")
+        s.delJenkins("test")
+        finalize()
+
+        s = BobState()
+        self.assertEqual(set(s.getAllJenkins()), set())
+
+    def testAsynchronous(self):
+        """Changes in asynchronous sections are committed at the end"""
+        s = BobState()
+        s.setResultHash("a", b'\x01')
+        s.setAsynchronous()
+        s.setResultHash("b", b'\x02')
+        s.setSynchronous()
+        finalize()
+        s = BobState()
+        self.assertEqual(s.getResultHash("a"), b'\x01')
+        self.assertEqual(s.getResultHash("b"), b'\x02')
+
+    def testGroupCommit(self):
+        """Changes are group-committed and survive a crash as a prefix"""
+        s = BobState()
+        s.setAsynchronous()
+        s.setResultHash("a", b'\x01')
+        s.sync()
+        s.setResultHash("b", b'\x02')
+
+        # uncommitted changes are not visible to other connections
+        db = sqlite3.connect(".bob-state.sqlite3")
+        keys = set(k for (k,) in db.execute("SELECT key FROM state WHERE section='results'"))
+        self.assertEqual(keys, {"a"})
+
+        # workspace structure changes are committed immediately
+        s.setDirectoryState("work", b'\x03')
+        keys = set(k for (k,) in db.execute("SELECT key FROM state WHERE section IN ('results', 'dirStates')"))
+        self.assertEqual(keys, {"a", "b", "work"})
+        db.close()
+        s.setSynchronous()
+
+    def testArtifactMissing(self):
+        """Artifact misses expire and depend on the archive"""
+        s = BobState()
+        s.setArtifactMissing(b'artifact', b'archive')
+        finalize()
+        s = BobState()
+        self.assertTrue(s.isArtifactMissing(b'artifact', b'archive', 60))
+        self.assertFalse(s.isArtifactMissing(b'artifact', b'other', 60))
+        self.assertFalse(s.isArtifactMissing(b'unknown', b'archive', 60))
+
+        s.setArtifactMissing(b'artifact', b'archive')
+        s.delArtifactMissing(b'artifact')
+        self.assertFalse(s.isArtifactMissing(b'artifact', b'archive', 60))
+
+        s.setArtifactMissing(b'artifact', b'archive')
+        time.sleep(0.01)
+        self.assertFalse(s.isArtifactMissing(b'artifact', b'archive', 0.001))
+
+    def testMigratePickle(self):
+        """Old pickled state is migrated automatically"""
+        state = {
+            "version" : 8,
+            "byNameDirs" : { "work/a" : 1, b'\x01' : ("work/a/1", True) },
+            "results" : { "work/a/1" : b'\x11' },
+            "inputs" : {},
+            "jenkins" : { "test" : { "config" : {}, "jobs" : { "job" : 1 },
+                                     "byNameDirs" : {} } },
+            "dirStates" : { "work/a/1" : {} },
+            "buildState" : { 'wasRun' : {}, 'predictedBuidId' : {} },
+            "variantIds" : {},
+            "atticDirs" : {},
+            "createdWithVersion" : 7,
+        }
+        with open(".bob-state.pickle", "wb") as f:
+            pickle.dump(state, f)
+
+        s = BobState()
+        self.assertEqual(s.getExistingByNameDirectory(b'\x01'), "work/a/1")
+        finalize()
+
+        # A stub is left behind so that older versions refuse to work
+        with open(".bob-state.pickle", "rb") as f:
+            self.assertEqual(pickle.load(f), { "version" : 9 })
+        with open(".bob-state.pickle.old", "rb") as f:
+            self.assertEqual(pickle.load(f), state)
+
+        s = BobState()
+        self.assertEqual(s.getByNameDirectory("work/a", b'\x02', True), "work/a/2")
+        self.assertEqual(s.getResultHash("work/a/1"), b'\x11')
+        self.assertEqual(s.getJenkinsAllJobs("test"), {"job"})
+        self.assertEqual(s.getDirectories(), ["work/a/1"])
+
+    def testMigratedStub(self):
+        """A left over stub of a migrated state is ignored"""
+        with open(".bob-state.pickle", "wb") as f:
+            pickle.dump({ "version" : 9 }, f)
+        s = BobState()
+        self.assertEqual(s.getDirectories(), [])
+
+    def testRollback(self):
+        """Failed changes are rolled back outside of asynchronous sections"""
+        s = BobState()
+        s.setResultHash("work/a/1", b'\x11')
+        with self.assertRaises(ParseError):
+            s.setResultHash(("work", "a", "2"), b'\x12')
+        s.setResultHash("work/a/3", b'\x13')
+        finalize()
+
+        s = BobState()
+        self.assertEqual(s.getResultHash("work/a/1"), b'\x11')
+        self.assertEqual(s.getResultHash("work/a/3"), b'\x13')
+
+    def testTooNew(self):
+        with open(".bob-state.pickle", "wb") as f:
+            pickle.dump({ "version" : 1000 }, f)
+        self.assertRaises(ParseError, BobState)
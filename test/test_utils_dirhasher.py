@@ -4,13 +4,15 @@
 # SPDX-License-Identifier: GPL-3.0-or-later
 
 from tempfile import NamedTemporaryFile, TemporaryDirectory
-from unittest import TestCase
+from unittest import TestCase, skipIf
 from unittest.mock import MagicMock, mock_open, patch
 import binascii
+import time
+import struct
 
 import os
 import sys
-from bob.utils import hashFile, hashDirectory
+from bob.utils import hashFile, hashDirectory, hashPath, DirHasher
 
 class TestHashFile(TestCase):
     def testBigFile(self):
@@ -95,14 +97,14 @@ class TestHashDir(TestCase):
                 sum1 = hashDirectory(tmp, index.name)
 
                 with open(index.name, "rb") as f:
-                    assert f.read(4) == b'BOB1'
+                    assert f.read(4) == b'BOB5'
 
                 with open(os.path.join(tmp, "foo"), 'wb') as f:
                     f.write(b'qwer')
                 sum2 = hashDirectory(tmp, index.name)
 
                 with open(index.name, "rb") as f:
-                    assert f.read(4) == b'BOB1'
+                    assert f.read(4) == b'BOB5'
 
                 assert sum1 != sum2
 
@@ -132,7 +134,7 @@ class TestHashDir(TestCase):
                     hashDirectory(tmp, index.name)
 
                 with open(index.name, "rb") as f:
-                    assert f.read(4) == b'BOB1'
+                    assert f.read(4) == b'BOB5'
 
     def testBlockDev(self):
         """Test that index handles block devices"""
@@ -190,3 +192,328 @@ class TestHashDir(TestCase):
 
         assert h == b"\x9b\x98~\xa5\xd5\xc4\x1e\xe29'\x8d\x1e\xe1\x12\xdd\xf4\xa51\xf5d"
 
+
+    def testParallel(self):
+        """Parallel hashing must yield the same digest as sequential hashing"""
+
+        with NamedTemporaryFile() as index:
+            with TemporaryDirectory() as tmp:
+                for d in range(4):
+                    os.mkdir(os.path.join(tmp, "d"+str(d)))
+                    for f in range(40):
+                        with open(os.path.join(tmp, "d"+str(d), str(f)), 'wb') as fd:
+                            fd.write(str(d*f).encode() * f)
+                os.symlink("d1", os.path.join(tmp, "link"))
+
+                sum1 = hashDirectory(tmp)
+                sum2 = hashDirectory(tmp, index.name, jobs=4)
+                assert sum1 == sum2
+                assert sum1 == hashPath(tmp, jobs=4)
+
+                # cached entries must be used and still match
+                with open(os.path.join(tmp, "d2", "7"), 'wb') as fd:
+                    fd.write(b'changed')
+                sum1 = hashDirectory(tmp)
+                sum2 = hashDirectory(tmp, index.name, jobs=4)
+                assert sum1 == sum2
+                assert sum2 == hashDirectory(tmp, index.name)
+
+    def testAlgorithms(self):
+        """Other algorithms yield 20 byte digests and do not share the index"""
+
+        with NamedTemporaryFile() as index:
+            with TemporaryDirectory() as tmp:
+                for f in range(10):
+                    with open(os.path.join(tmp, str(f)), 'wb') as fd:
+                        fd.write(str(f).encode() * f)
+
+                sha1 = hashDirectory(tmp, index.name)
+                for algorithm in ("sha256", "blake2b"):
+                    sum1 = hashDirectory(tmp, algorithm=algorithm)
+                    assert len(sum1) == 20
+                    assert sum1 != sha1
+                    assert sum1 == hashDirectory(tmp, index.name, algorithm=algorithm)
+                    assert sum1 == hashDirectory(tmp, index.name, algorithm=algorithm, jobs=4)
+                    assert sum1 == hashPath(tmp, algorithm=algorithm)
+                assert sha1 == hashDirectory(tmp, index.name)
+
+class TestFileIndex(TestCase):
+    """Test the memory mapped index and its delta log"""
+
+    def setUp(self):
+        self.umask = os.umask(0o022)
+        self.tmp = TemporaryDirectory()
+        self.ws = os.path.join(self.tmp.name, "ws")
+        self.index = os.path.join(self.tmp.name, "cache.bin")
+        os.mkdir(self.ws)
+        for i in range(10):
+            self.writeFile(str(i), str(i))
+
+    def tearDown(self):
+        self.tmp.cleanup()
+        os.umask(self.umask)
+
+    def writeFile(self, name, content):
+        with open(os.path.join(self.ws, name), 'w') as f:
+            f.write(content)
+
+    def testUpdateInPlace(self):
+        """Changed files are updated without rewriting the index"""
+        hashDirectory(self.ws, self.index)
+        ino = os.stat(self.index).st_ino
+        self.writeFile("3", "changed")
+        h = hashDirectory(self.ws, self.index)
+        self.assertEqual(ino, os.stat(self.index).st_ino)
+        self.assertFalse(os.path.exists(self.index + ".log"))
+        self.assertEqual(h, hashDirectory(self.ws))
+        self.assertEqual(h, hashDirectory(self.ws, self.index))
+
+    def testAppendLog(self):
+        """New files are appended to the log and found again"""
+        hashDirectory(self.ws, self.index)
+        ino = os.stat(self.index).st_ino
+        self.writeFile("new", "file")
+        h = hashDirectory(self.ws, self.index)
+        self.assertEqual(ino, os.stat(self.index).st_ino)
+        self.assertTrue(os.path.exists(self.index + ".log"))
+
+        with patch('bob.utils.hashFile') as hashFile:
+            self.assertEqual(h, hashDirectory(self.ws, self.index))
+            hashFile.assert_not_called()
+
+    def testTornRecord(self):
+        """A corrupted record is treated as cache miss"""
+        h = hashDirectory(self.ws, self.index)
+        with open(self.index, "r+b") as f:
+            f.seek(DirHasher.FileIndex.HEADER_SIZE + DirHasher.FileIndex.STAT_OFFSET)
+            f.write(b'\xff' * 8)
+        self.assertEqual(h, hashDirectory(self.ws, self.index))
+
+    def testCompaction(self):
+        """Deleted files are eventually dropped from the index"""
+        hashDirectory(self.ws, self.index)
+        for i in range(5):
+            os.unlink(os.path.join(self.ws, str(i)))
+        h = hashDirectory(self.ws, self.index)
+        with open(self.index, "rb") as f:
+            (sig, entries) = struct.unpack(DirHasher.FileIndex.HEADER_FMT,
+                f.read(DirHasher.FileIndex.HEADER_SIZE))[0:2]
+        self.assertEqual(sig, b'BOB5sha1')
+        self.assertEqual(entries, 6) # 5 files + root directory
+        self.assertEqual(h, hashDirectory(self.ws))
+
+@skipIf(sys.platform != "linux", "requires Linux")
+class TestChangeJournal(TestCase):
+    """Test hashing guided by the change journal"""
+
+    def setUp(self):
+        self.tmp = TemporaryDirectory()
+        self.ws = os.path.join(self.tmp.name, "ws")
+        self.index = os.path.join(self.tmp.name, "cache.bin")
+        self.journal = None
+        for d in range(4):
+            os.makedirs(os.path.join(self.ws, "d"+str(d)))
+            for f in range(4):
+                self.writeFile(os.path.join("d"+str(d), str(f)), str(d*f))
+        # Make directories old enough so that their stat can be trusted
+        old = time.time() - 60
+        for d in range(4):
+            os.utime(os.path.join(self.ws, "d"+str(d)), (old, old))
+        os.utime(self.ws, (old, old))
+
+    def tearDown(self):
+        self.stopJournal()
+        self.tmp.cleanup()
+
+    def writeFile(self, name, content):
+        with open(os.path.join(self.ws, name), 'w') as f:
+            f.write(content)
+
+    def startJournal(self):
+        """Fake a running watcher that acknowledges all cookies"""
+        import fcntl, threading
+        from bob.journal import HEADER_FMT, SIGNATURE
+        root = os.fsencode(os.path.realpath(self.ws))
+        self.journal = open(self.index + ".journal", "wb")
+        fcntl.flock(self.journal.fileno(), fcntl.LOCK_EX)
+        self.journal.write(struct.pack(HEADER_FMT, SIGNATURE, 42, len(root)) + root)
+        self.journal.flush()
+
+        cookieDir = self.index + ".journal.cookies"
+        os.makedirs(cookieDir)
+        self.journalLock = threading.Lock()
+        self.journalStop = threading.Event()
+        def ackCookies():
+            seen = set()
+            while not self.journalStop.wait(0.001):
+                cookies = set(e.name for e in os.scandir(cookieDir)) - seen
+                seen |= cookies
+                self.record(*("/" + c for c in cookies))
+        self.journalThread = threading.Thread(target=ackCookies)
+        self.journalThread.start()
+
+    def stopJournal(self):
+        if self.journal is None: return
+        self.journalStop.set()
+        self.journalThread.join()
+        self.journal.close()
+        self.journal = None
+
+    def record(self, *paths):
+        with self.journalLock:
+            self.journal.write(b''.join(os.fsencode(p) + b'\0' for p in paths))
+            self.journal.flush()
+
+    def journalToken(self):
+        from bob.journal import _readHeader
+        try:
+            with open(self.index + ".journal", "rb") as f:
+                return _readHeader(f)[0]
+        except FileNotFoundError:
+            return None
+
+    def startWatcher(self, script="", *args):
+        import subprocess
+        env = os.environ.copy()
+        env["PYTHONPATH"] = os.path.join(os.path.dirname(__file__), "..", "pym")
+        watcher = subprocess.Popen([sys.executable, "-c",
+            "import os, struct, sys; from bob.journal import JournalWatcher\n" +
+            script + "\nJournalWatcher(sys.argv[1], sys.argv[2]).run()",
+            self.ws, self.index + ".journal"] + list(args), env=env)
+        self.addCleanup(watcher.wait)
+        self.addCleanup(watcher.terminate)
+        for i in range(100):
+            if self.journalToken() is not None: break
+            time.sleep(0.05)
+        return watcher
+
+    def hash(self):
+        listed = []
+        origListdir = os.listdir
+        def listdir(path):
+            listed.append(os.path.relpath(path, os.fsencode(self.ws)))
+            return origListdir(path)
+        with patch('os.listdir', listdir):
+            h = hashDirectory(self.ws, self.index)
+        self.assertEqual(h, hashDirectory(self.ws))
+        return sorted(listed)
+
+    def testGuided(self):
+        """Only dirty directories and their parents are listed"""
+        self.startJournal()
+        self.assertEqual(len(self.hash()), 5)
+        self.assertEqual(self.hash(), [])
+
+        self.writeFile(os.path.join("d1", "3"), "changed")
+        self.record(os.path.join("d1", "3"))
+        self.assertEqual(self.hash(), [b'.', b'd1'])
+
+        os.makedirs(os.path.join(self.ws, "d2", "new", "sub"))
+        self.writeFile(os.path.join("d2", "new", "sub", "x"), "x")
+        self.record(os.path.join("d2", "new"))
+        self.assertEqual(self.hash(), [b'.', b'd2', b'd2/new', b'd2/new/sub'])
+
+        # d2 was just modified. Its fingerprint is verified.
+        os.unlink(os.path.join(self.ws, "d0", "0"))
+        self.record(os.path.join("d0", "0"))
+        self.assertEqual(self.hash(), [b'.', b'd0', b'd2'])
+
+    def testMissedEvent(self):
+        """Reused directories with changed stat are rescanned"""
+        self.startJournal()
+        self.hash()
+        self.writeFile(os.path.join("d0", "0"), "changed")
+        self.record(os.path.join("d0", "0"))
+        self.writeFile(os.path.join("d1", "new"), "new")
+        self.assertEqual(self.hash(), [b'.', b'd0', b'd1'])
+
+    def testOverflow(self):
+        """An empty record forces a full scan"""
+        self.startJournal()
+        self.hash()
+        self.record("")
+        self.assertEqual(len(self.hash()), 5)
+        self.assertEqual(self.hash(), [])
+
+    def testNoWatcher(self):
+        """Without a running watcher a full scan is done"""
+        self.startJournal()
+        self.hash()
+        self.stopJournal()
+        self.assertEqual(len(self.hash()), 5)
+
+    def testCookieTimeout(self):
+        """A full scan is done if the watcher does not respond"""
+        self.startJournal()
+        self.hash()
+        self.journalStop.set()
+        self.journalThread.join()
+        self.writeFile(os.path.join("d1", "3"), "changed")
+        with patch('bob.journal.ChangeJournal.COOKIE_TIMEOUT', 0.1):
+            self.assertEqual(len(self.hash()), 5)
+
+    def testWatcher(self):
+        """The inotify watcher records changes"""
+        self.startWatcher()
+        self.assertEqual(len(self.hash()), 5)
+
+        os.makedirs(os.path.join(self.ws, "d3", "new"))
+        self.writeFile(os.path.join("d3", "new", "x"), "x")
+        self.writeFile(os.path.join("d1", "3"), "changed")
+        self.assertEqual(self.hash(), [b'.', b'd1', b'd3', b'd3/new'])
+
+        self.writeFile(os.path.join("d3", "new", "x"), "y")
+        self.assertEqual(self.hash(), [b'.', b'd3', b'd3/new'])
+
+    def testWatcherOverflow(self):
+        """The watcher starts over if events were lost"""
+        flag = os.path.join(self.tmp.name, "overflow")
+        self.startWatcher("""
+origRead = os.read
+def read(fd, n):
+    buf = origRead(fd, n)
+    if os.path.exists(sys.argv[3]):
+        os.unlink(sys.argv[3])
+        buf = struct.pack('=iIII', -1, JournalWatcher.IN_Q_OVERFLOW, 0, 0)
+    return buf
+os.read = read
+""", flag)
+        self.assertEqual(len(self.hash()), 5)
+        token = self.journalToken()
+
+        # The creation of the directory is lost
+        open(flag, "w").close()
+        os.makedirs(os.path.join(self.ws, "d3", "new"))
+        for i in range(100):
+            if self.journalToken() not in (None, token): break
+            time.sleep(0.05)
+        self.writeFile(os.path.join("d3", "new", "x"), "x")
+        self.assertEqual(len(self.hash()), 6)
+
+        self.writeFile(os.path.join("d3", "new", "x"), "y")
+        self.assertEqual(self.hash(), [b'.', b'd3', b'd3/new'])
+
+    def testWatcherRenameRoot(self):
+        """Changes in a replaced root directory are not missed"""
+        import shutil
+        self.startWatcher()
+        self.assertEqual(len(self.hash()), 5)
+
+        os.rename(self.ws, self.ws + ".old")
+        shutil.copytree(self.ws + ".old", self.ws)
+        self.assertEqual(len(self.hash()), 5)
+
+        # Content changes do not update the directory. They must be recorded.
+        self.writeFile(os.path.join("d1", "3"), "changed")
+        self.hash()
+        self.writeFile(os.path.join("d1", "3"), "again")
+        self.hash()
+
+    def testWatcherRootRemoved(self):
+        """The watcher stops if the root directory is removed"""
+        import fcntl, shutil
+        watcher = self.startWatcher()
+        shutil.rmtree(self.ws)
+        self.assertEqual(watcher.wait(5), 0)
+        with open(self.index + ".journal", "rb") as f:
+            fcntl.flock(f.fileno(), fcntl.LOCK_SH | fcntl.LOCK_NB)